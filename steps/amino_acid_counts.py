@@ -0,0 +1,375 @@
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+def add_counts(tensor:np.ndarray, flat_indices:np.ndarray, sign:int):
+    """
+    This function adds (or subtracts) one for each flat index to a tensor, touching only the cells which are counted
+
+    Args:
+        tensor (np.ndarray): The tensor to update in place, which must be contiguous
+        flat_indices (np.ndarray): The flat index into the tensor of each item to count, indices can repeat
+        sign (int): 1 to add the items to the counts, -1 to remove them
+    """
+    # the repeated indices are counted first, so each touched cell is updated once. A bincount over the whole tensor would cost as much as the
+    # tensor for every batch, however small the batch
+    cells, cell_counts = np.unique(flat_indices, return_counts=True)
+    tensor.reshape(-1)[cells] += sign * cell_counts
+
+
+class AminoAcidCounts():
+    """
+    This class holds the amino acid counts for the peptides bound by each allele as a dense integer tensor
+
+    The tensor is indexed by (allele, peptide length, position, amino acid), where the amino acid index is the index in the AMINO_ACIDS constant.
+    Peptides are queued as they are added and encoded in batches, so the counting is vectorised rather than done one residue at a time.
+
+    Attributes:
+        amino_acids (List[str]): The list of amino acids, the order defines the amino acid axis of the tensor
+        allele_numbers (List[str]): The slugified allele numbers, the order defines the allele axis of the tensor
+        counts (np.ndarray): The count tensor with the shape (alleles, maximum length + 1, maximum length, amino acids)
+        totals (np.ndarray): The number of peptides with the shape (alleles, maximum length + 1)
+        unknown_residues (int): The number of residues of the counted peptides which are not in the amino acid list, so have no place in the
+            tensor
+    """
+
+    def __init__(self, amino_acids:List[str], batch_size:int=65536):
+        self.amino_acids = list(amino_acids)
+        self.batch_size = batch_size
+        self.allele_numbers = []
+        self.allele_index = {}
+        # the order in which each allele first saw each peptide length, used to keep the JSON output in the existing order
+        self.peptide_lengths = {}
+        self.counts = np.zeros((0, 1, 0, len(self.amino_acids)), dtype=np.int64)
+        self.totals = np.zeros((0, 1), dtype=np.int64)
+        self.unknown_residues = 0
+        # lookup table from the ASCII code of a residue to its amino acid index, anything not in the list maps to -1
+        self.lookup = np.full(256, -1, dtype=np.int64)
+        for i, amino_acid in enumerate(self.amino_acids):
+            self.lookup[ord(amino_acid)] = i
+        # queued peptides waiting to be counted (or uncounted), keyed by peptide length
+        self.pending = {}
+        self.pending_removals = {}
+        self.pending_count = 0
+
+
+    def add_allele(self, allele_number:str) -> int:
+        """
+        This function adds an allele to the allele axis of the tensor if it is not already there
+
+        Args:
+            allele_number (str): The slugified allele number
+
+        Returns:
+            int: The index of the allele in the tensor
+        """
+        if allele_number not in self.allele_index:
+            self.allele_index[allele_number] = len(self.allele_numbers)
+            self.allele_numbers.append(allele_number)
+            self.peptide_lengths[allele_number] = {}
+        return self.allele_index[allele_number]
+
+
+    def add(self, allele_number:str, peptide:str):
+        """
+        This function queues a peptide to be added to the counts for an allele
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide (str): The peptide sequence
+        """
+        allele_index = self.add_allele(allele_number)
+        self.peptide_lengths[allele_number][str(len(peptide))] = None
+        self.queue(self.pending, allele_index, peptide)
+
+
+    def remove(self, allele_number:str, peptide:str):
+        """
+        This function queues a peptide to be removed from the counts for an allele
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide (str): The peptide sequence
+        """
+        self.queue(self.pending_removals, self.allele_index[allele_number], peptide)
+
+
+    def queue(self, pending:Dict, allele_index:int, peptide:str):
+        """
+        This function adds a peptide to a queue of peptides to be counted and flushes the queues when they are full
+
+        Args:
+            pending (Dict): The queue to add the peptide to
+            allele_index (int): The index of the allele in the tensor
+            peptide (str): The peptide sequence
+        """
+        batch = pending.setdefault(len(peptide), ([], []))
+        batch[0].append(allele_index)
+        batch[1].append(peptide)
+        self.pending_count += 1
+        if self.pending_count >= self.batch_size:
+            self.flush()
+
+
+    def encode(self, peptides:List[str], peptide_length:int) -> np.ndarray:
+        """
+        This function encodes a batch of peptides of the same length as a matrix of amino acid indices
+
+        Args:
+            peptides (List[str]): The peptide sequences
+            peptide_length (int): The length of each peptide
+
+        Returns:
+            np.ndarray: An integer matrix with the shape (peptides, length), residues not in the amino acid list are -1
+        """
+        residues = np.frombuffer(''.join(peptides).encode('ascii', 'replace'), dtype=np.uint8)
+        return self.lookup[residues].reshape(len(peptides), peptide_length)
+
+
+    def grow(self, allele_count:int, max_length:int):
+        """
+        This function enlarges the tensors to hold the given number of alleles and maximum peptide length
+
+        Args:
+            allele_count (int): The number of alleles
+            max_length (int): The maximum peptide length
+        """
+        allele_count = max(allele_count, self.counts.shape[0])
+        max_length = max(max_length, self.counts.shape[2])
+        if (allele_count, max_length) == (self.counts.shape[0], self.counts.shape[2]):
+            return
+        counts = np.zeros((allele_count, max_length + 1, max_length, len(self.amino_acids)), dtype=np.int64)
+        counts[:self.counts.shape[0], :self.counts.shape[1], :self.counts.shape[2]] = self.counts
+        totals = np.zeros((allele_count, max_length + 1), dtype=np.int64)
+        totals[:self.totals.shape[0], :self.totals.shape[1]] = self.totals
+        self.counts = counts
+        self.totals = totals
+
+
+    def flush(self):
+        """
+        This function encodes and counts all the queued peptides
+        """
+        if self.pending_count == 0:
+            return
+        self.grow(len(self.allele_numbers), max(list(self.pending) + list(self.pending_removals)))
+        for peptide_length, (allele_indices, peptides) in self.pending.items():
+            self.count_batch(np.asarray(allele_indices, dtype=np.int64), peptides, peptide_length, 1)
+        for peptide_length, (allele_indices, peptides) in self.pending_removals.items():
+            self.count_batch(np.asarray(allele_indices, dtype=np.int64), peptides, peptide_length, -1)
+        self.pending = {}
+        self.pending_removals = {}
+        self.pending_count = 0
+
+
+    def count_batch(self, allele_indices:np.ndarray, peptides:List[str], peptide_length:int, sign:int):
+        """
+        This function adds (or subtracts) the residues of a batch of peptides of the same length to the count tensor
+
+        Args:
+            allele_indices (np.ndarray): The index of the allele for each peptide
+            peptides (List[str]): The peptide sequences
+            peptide_length (int): The length of each peptide
+            sign (int): 1 to add the peptides to the counts, -1 to remove them
+        """
+        n_lengths, n_positions, n_amino_acids = self.counts.shape[1:]
+        codes = self.encode(peptides, peptide_length)
+        # build flat indices into the count tensor for every residue in the batch and count them in one go
+        positions = np.arange(peptide_length)
+        flat_indices = ((allele_indices[:, None] * n_lengths + peptide_length) * n_positions + positions) * n_amino_acids + codes
+        # residues which are not in the amino acid list have no place in the tensor, they are left out of the counts but are counted themselves
+        is_known = codes >= 0
+        self.unknown_residues += sign * int(is_known.size - np.count_nonzero(is_known))
+        add_counts(self.counts, flat_indices[is_known], sign)
+        add_counts(self.totals, allele_indices * n_lengths + peptide_length, sign)
+
+
+    def merge(self, other:'AminoAcidCounts'):
+        """
+        This function adds the counts from another set of counts to this one
+
+        The other counts are assumed to come after the counts in this set, so the allele order is the same as if all the peptides had been added here
+
+        Args:
+            other (AminoAcidCounts): The counts to merge into this set
+        """
+        self.flush()
+        other.flush()
+        allele_indices = np.array([self.add_allele(allele_number) for allele_number in other.allele_numbers], dtype=np.int64)
+        for allele_number, peptide_lengths in other.peptide_lengths.items():
+            self.peptide_lengths[allele_number].update(peptide_lengths)
+        self.grow(len(self.allele_numbers), other.counts.shape[2])
+        n_lengths, n_positions = other.counts.shape[1:3]
+        self.counts[allele_indices, :n_lengths, :n_positions] += other.counts
+        self.totals[allele_indices, :n_lengths] += other.totals
+        self.unknown_residues += other.unknown_residues
+
+
+    def percentages(self) -> np.ndarray:
+        """
+        This function returns the percentage of peptides with each amino acid at each position
+
+        Returns:
+            np.ndarray: A float tensor with the same shape as the counts, NaN where there are no peptides of that length
+        """
+        self.flush()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.counts / self.totals[:, :, None, None] * 100
+
+
+    def probabilities(self, pseudocount:float=1.0) -> np.ndarray:
+        """
+        This function returns the probability of each amino acid at each position, with a pseudocount added to every count
+
+        This is the same transformation logomaker applies to a counts matrix, P = (N + pseudocount) / (total + amino acids * pseudocount)
+
+        Args:
+            pseudocount (float): The pseudocount added to the count of each amino acid at each position
+
+        Returns:
+            np.ndarray: A float tensor with the same shape as the counts
+        """
+        self.flush()
+        counts = self.counts + pseudocount
+        return counts / counts.sum(axis=3, keepdims=True)
+
+
+    def information(self, probabilities:np.ndarray) -> np.ndarray:
+        """
+        This function returns the information content in bits of each amino acid at each position, against a uniform background
+
+        The information content at a position is shared between the amino acids in proportion to their probability, which is the height of 
+        each letter in a logoplot, as in logomaker
+
+        Args:
+            probabilities (np.ndarray): The probability tensor returned by the probabilities function
+
+        Returns:
+            np.ndarray: A float tensor with the same shape as the counts
+        """
+        # the smallest positive float is added before taking logs, as logomaker does, so a zero probability does not give an error
+        small = np.finfo(float).tiny
+        background = 1 / len(self.amino_acids)
+        relative_entropy = (probabilities * (np.log2(probabilities + small) - np.log2(background + small))).sum(axis=3, keepdims=True)
+        return probabilities * relative_entropy
+
+
+    def counted_alleles(self) -> List[str]:
+        """
+        This function returns the alleles which have peptides counted, in the order of the entries of to_dict()
+
+        Returns:
+            List[str]: The slugified allele numbers, alleles whose peptides have all been removed are left out
+        """
+        return [allele_number for allele_number in self.allele_numbers if self.peptide_lengths[allele_number]]
+
+
+    def to_dict(self, allele_numbers:Optional[Set[str]]=None) -> Dict[str, Dict[str, Dict[str, Dict[str, Dict]]]]:
+        """
+        This function returns the counts and percentages in the shape used for amino_acid_distributions.json
+
+        Only amino acids which are seen at a position are included, in the order of the amino acid list
+
+        Args:
+            allele_numbers (Optional[Set[str]]): The alleles to include, or None for every allele
+
+        Returns:
+            Dict[str, Dict[str, Dict[str, Dict[str, Dict]]]]: The counts and percentages keyed by allele, peptide length, position and amino acid
+        """
+        percentages = self.percentages()
+        amino_acid_distributions = {}
+        for allele_number in self.counted_alleles():
+            if allele_numbers is not None and allele_number not in allele_numbers:
+                continue
+            i = self.allele_index[allele_number]
+            amino_acid_distributions[allele_number] = {}
+            for peptide_length in self.peptide_lengths[allele_number]:
+                length = int(peptide_length)
+                amino_acid_distributions[allele_number][peptide_length] = {}
+                for position in range(length):
+                    position_counts = self.counts[i, length, position]
+                    position_percentages = percentages[i, length, position]
+                    amino_acid_distributions[allele_number][peptide_length][str(position + 1)] = {
+                        self.amino_acids[j]:{'count':int(position_counts[j]), 'percentage':float(position_percentages[j])} for j in np.flatnonzero(position_counts)
+                    }
+        return amino_acid_distributions
+
+
+    def to_columns(self, allele_ids:Dict[str, int]) -> Dict[str, np.ndarray]:
+        """
+        This function returns the counts and percentages as columns for the columnar warehouse
+
+        The rows are in the same order as the entries of to_dict(), only amino acids which are seen at a position are included
+
+        Args:
+            allele_ids (Dict[str, int]): The id for each allele number
+
+        Returns:
+            Dict[str, np.ndarray]: The allele_id, peptide_length, position, amino_acid_id, count and percentage columns
+        """
+        percentages = self.percentages()
+        blocks = {'allele_id':[], 'peptide_length':[], 'position':[], 'amino_acid_id':[], 'count':[], 'percentage':[]}
+        for allele_number, i in self.allele_index.items():
+            # alleles whose peptides have all been removed have no peptide lengths, so have no rows
+            for peptide_length in self.peptide_lengths[allele_number]:
+                length = int(peptide_length)
+                positions, amino_acid_ids = np.nonzero(self.counts[i, length, :length])
+                blocks['allele_id'].append(np.full(len(positions), allele_ids[allele_number]))
+                blocks['peptide_length'].append(np.full(len(positions), length))
+                blocks['position'].append(positions + 1)
+                blocks['amino_acid_id'].append(amino_acid_ids)
+                blocks['count'].append(self.counts[i, length, positions, amino_acid_ids])
+                blocks['percentage'].append(percentages[i, length, positions, amino_acid_ids])
+        dtypes = {'allele_id':np.int32, 'peptide_length':np.int16, 'position':np.int16, 'amino_acid_id':np.int8, 'count':np.int64, 'percentage':np.float64}
+        return {column_name:np.concatenate(blocks[column_name]).astype(dtype) if blocks[column_name] else np.zeros(0, dtype=dtype) for column_name, dtype in dtypes.items()}
+
+
+    def save(self, filepath:str):
+        """
+        This function saves the count tensor so later steps can use the matrix directly
+
+        Args:
+            filepath (str): The path to the .npz file
+        """
+        self.flush()
+        np.savez_compressed(filepath, counts=self.counts, totals=self.totals, allele_numbers=np.array(self.allele_numbers, dtype=str), amino_acids=np.array(self.amino_acids, dtype=str))
+
+
+    def to_state(self) -> Tuple[Dict[str, np.ndarray], Dict]:
+        """
+        This function returns the arrays and the labels the counts are saved as between runs of the processing step
+
+        Returns:
+            Tuple[Dict[str, np.ndarray], Dict]: The counts and totals tensors, and the amino acids, alleles, peptide lengths of each allele in the
+            order they were first seen, and the number of unknown residues
+        """
+        self.flush()
+        metadata = {
+            'amino_acids':self.amino_acids,
+            'allele_numbers':self.allele_numbers,
+            'peptide_lengths':{allele_number:list(peptide_lengths) for allele_number, peptide_lengths in self.peptide_lengths.items()},
+            'unknown_residues':self.unknown_residues
+        }
+        return {'counts':self.counts, 'totals':self.totals}, metadata
+
+
+def load_amino_acid_counts(arrays:Dict[str, np.ndarray], metadata:Dict) -> AminoAcidCounts:
+    """
+    This function rebuilds a set of counts from the arrays and labels returned by to_state
+
+    Args:
+        arrays (Dict[str, np.ndarray]): The counts and totals tensors
+        metadata (Dict): The amino acids, alleles, peptide lengths and number of unknown residues
+
+    Returns:
+        AminoAcidCounts: The counts
+    """
+    amino_acid_counts = AminoAcidCounts(metadata['amino_acids'])
+    for allele_number in metadata['allele_numbers']:
+        amino_acid_counts.add_allele(allele_number)
+        amino_acid_counts.peptide_lengths[allele_number] = dict.fromkeys(metadata['peptide_lengths'][allele_number])
+    amino_acid_counts.counts = arrays['counts']
+    amino_acid_counts.totals = arrays['totals']
+    amino_acid_counts.unknown_residues = metadata['unknown_residues']
+    return amino_acid_counts
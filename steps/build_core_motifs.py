@@ -0,0 +1,128 @@
+from typing import Dict
+
+from warehouse import ShardedWarehouse, write_table
+from core_frame import CORE_LENGTH, core_frames, indel_positions, project_to_core, core_counts, core_matrices
+from build_scoring_matrices import log_odds_matrices
+from packed_peptides import encoding_table, packed_residues
+
+import time
+
+import numpy as np
+
+
+def build_core_motifs(**kwargs) -> Dict[str,str]:
+    """
+    This function builds a motif for each allele from its peptides of every length, by projecting them onto a common 9 position binding core
+
+    The peptides of each length are placed in the frame which scores best against the nonamer scoring matrix of the allele (or against the
+    scoring matrix of all the alleles' nonamers, for an allele without any). The combined counts, percentages, probabilities and information
+    of the core for each allele are written to the core_motifs table, and the number of peptides placed in each frame to the core_frames table,
+    in the columnar warehouse.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        Dict[str,str]: A dictionary containing the action log for this step.
+
+    Keyword Args:
+        config (dict): The configuration dictionary.
+        verbose (bool): Whether to print verbose output.
+        force (bool): Whether to force the step to run ignoring any previous results.
+        output_path (str): The path to the output directory.
+        console (Console): A Rich console object for printing Rich output.
+    """
+    config = kwargs['config']
+    verbose = kwargs['verbose']
+    force = kwargs['force']
+    output_path = kwargs['output_path']
+    console = kwargs['console']
+    function_name = kwargs['function_name']
+
+    constants = config['CONSTANTS']
+    peptide_lengths = [str(peptide_length) for peptide_length in constants['CORE_PEPTIDE_LENGTHS']]
+
+    warehouse_folder = f"{output_path}/motifs"
+    shards = ShardedWarehouse(warehouse_folder)
+    amino_acids = shards.amino_acids
+    table = encoding_table(amino_acids)
+
+    # the frames are scored against the nonamer scoring matrix of each allele, alleles without nonamers use the matrix of every allele's
+    # nonamers pooled together
+    nonamer_counts = {allele_slug:shards.shard(allele_slug, str(CORE_LENGTH))['counts'] for allele_slug in shards.alleles if shards.has_shard(allele_slug, str(CORE_LENGTH))}
+    scoring_matrices = {}
+    pooled_scoring_matrix = np.zeros((CORE_LENGTH, len(amino_acids)))
+    if nonamer_counts:
+        stacked_counts = np.stack(list(nonamer_counts.values())).astype(np.float64)
+        scoring_matrices = dict(zip(nonamer_counts, log_odds_matrices(stacked_counts, constants['SCORING_PSEUDOCOUNT'])))
+        pooled_scoring_matrix = log_odds_matrices(stacked_counts.sum(axis=0, keepdims=True), constants['SCORING_PSEUDOCOUNT'])[0]
+
+    frames = {peptide_length:core_frames(int(peptide_length)) for peptide_length in peptide_lengths}
+    allele_counts = []
+    allele_gaps = []
+    allele_peptide_counts = []
+    frame_columns = {'allele_id':[], 'peptide_length':[], 'frame':[], 'indel_position':[], 'peptide_count':[]}
+    projected = {}
+    start_time = time.perf_counter()
+    for allele_id, allele_slug in enumerate(shards.alleles):
+        scoring_matrix = scoring_matrices.get(allele_slug, pooled_scoring_matrix)
+        counts = np.zeros((CORE_LENGTH, len(amino_acids)), dtype=np.int64)
+        gaps = np.zeros(CORE_LENGTH, dtype=np.int64)
+        peptide_count = 0
+        for peptide_length in shards.lengths(allele_slug):
+            if peptide_length not in frames or not len(frames[peptide_length]):
+                continue
+            length = int(peptide_length)
+            # the packed peptides are decoded straight to amino acid ids, characters which are not amino acids become -1
+            encoded = table[packed_residues(shards.shard(allele_slug, peptide_length)['peptides'], length)]
+            core, chosen = project_to_core(encoded, frames[peptide_length], scoring_matrix)
+            length_counts, length_gaps = core_counts(core, len(amino_acids))
+            counts += length_counts
+            gaps += length_gaps
+            peptide_count += len(core)
+            projected[peptide_length] = projected.get(peptide_length, 0) + len(core)
+
+            # the number of peptides placed in each frame shows where the peptides of each length bulge out or leave a gap
+            frame_counts = np.bincount(chosen, minlength=len(frames[peptide_length]))
+            frame_columns['allele_id'].extend([allele_id] * len(frame_counts))
+            frame_columns['peptide_length'].extend([length] * len(frame_counts))
+            frame_columns['frame'].extend(range(len(frame_counts)))
+            frame_columns['indel_position'].extend(indel_positions(frames[peptide_length]).tolist())
+            frame_columns['peptide_count'].extend(frame_counts.tolist())
+        allele_counts.append(counts)
+        allele_gaps.append(gaps)
+        allele_peptide_counts.append(peptide_count)
+    seconds = round(time.perf_counter() - start_time, 3)
+
+    counts = np.stack(allele_counts) if allele_counts else np.zeros((0, CORE_LENGTH, len(amino_acids)), dtype=np.int64)
+    columns = {
+        'allele_id':np.arange(len(shards.alleles), dtype=np.int32),
+        'peptide_count':np.array(allele_peptide_counts, dtype=np.int64),
+        'counts':counts,
+        'gaps':np.stack(allele_gaps) if allele_gaps else np.zeros((0, CORE_LENGTH), dtype=np.int64),
+        **core_matrices(counts)
+    }
+    # the amino acids label the last axis of each of the matrices
+    dictionaries = {
+        'allele_id':shards.alleles,
+        **{matrix_name:amino_acids for matrix_name in ['counts', 'percentages', 'probabilities', 'information']}
+    }
+    write_table(warehouse_folder, 'core_motifs', columns, dictionaries, verbose)
+    frame_dtypes = {'allele_id':np.int32, 'peptide_length':np.int16, 'frame':np.int16, 'indel_position':np.int16, 'peptide_count':np.int64}
+    write_table(warehouse_folder, 'core_frames', {column_name:np.array(frame_columns[column_name], dtype=dtype) for column_name, dtype in frame_dtypes.items()}, {'allele_id':shards.alleles}, verbose)
+
+    peptides_projected = sum(projected.values())
+    if verbose:
+        for peptide_length, peptide_count in sorted(projected.items(), key=lambda item: int(item[0])):
+            print (f"Projected {peptide_count} {peptide_length}mers onto the core")
+        print (f"Built core motifs for {len(shards.alleles)} alleles from {peptides_projected} peptides in {seconds}s")
+
+    # create the action log which will be included in the log file for this run of the pipeline
+    action_log = {
+        'alleles_processed':len(shards.alleles),
+        'peptides_projected':projected,
+        'seconds':seconds,
+        'peptides_per_second':round(peptides_projected / seconds) if seconds else None
+    }
+
+    return action_log
@@ -1,17 +1,21 @@
-from typing import Dict
+from typing import Dict, List
 
 from pipeline import create_folder
 
 from helpers.files import write_json, read_json
 
-import os 
+from warehouse import ShardedWarehouse
+from incremental import AlleleManifest, hash_content
+from plot_rendering import render_plots, figure_template, write_plot_outputs, plot_output_paths
+from logo_rendering import stack_glyphs, svg_logo, draw_logo
 
-from io import BytesIO
-import base64
+import os 
 
 import logomaker
-import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 import numpy as np
+import pandas as pd
 
 
 colors = {
@@ -39,6 +43,84 @@ colors = {
 
 
 
+def style_logoplot(fig:Figure, ax:Axes):
+    """
+    This function styles the figure and axes used for every logoplot
+
+    Args:
+        fig (Figure): The logoplot figure
+        ax (Axes): The logoplot axes
+    """
+    ax.tick_params(axis='both', which='major', labelsize=40)
+
+    ax.set_xlabel('Peptide position', fontsize=60, labelpad=10)
+    ax.set_ylabel('Bits', fontsize=60, labelpad=40)
+
+
+def style_native_logoplot(fig:Figure, ax:Axes):
+    """
+    This function styles the figure and axes used to rasterise the logoplots drawn by the native renderer
+
+    Args:
+        fig (Figure): The logoplot figure
+        ax (Axes): The logoplot axes
+    """
+    style_logoplot(fig, ax)
+    ax.spines[['right', 'top']].set_visible(False)
+
+
+def render_native_logoplot(information:np.ndarray, amino_acids:List[str], output_stems:Dict[str,str]):
+    """
+    This function renders the logoplot for an allele and peptide length with the native renderer, the svg is composed directly from the cached
+    glyph outlines and the png is only rasterised if it is one of the output formats
+
+    Args:
+        information (np.ndarray): The precomputed information content in bits of each amino acid at each position
+        amino_acids (List[str]): The amino acids, in the order of the columns of the information matrix
+        output_stems (Dict[str,str]): The path of the output files, without the file extension, for each output format
+    """
+    glyphs, ymax = stack_glyphs(information, amino_acids, vpad=0.1)
+
+    if 'svg' in output_stems:
+        with open(f"{output_stems['svg']}.svg", 'w') as f:
+            f.write(svg_logo(glyphs, len(information), ymax, colors))
+
+    raster_stems = {plot_format:output_stem for plot_format, output_stem in output_stems.items() if plot_format != 'svg'}
+    if raster_stems:
+        fig, ax = figure_template('native_logoplot', style_native_logoplot, figsize=(25,20))
+        draw_logo(ax, glyphs, len(information), ymax, colors)
+        write_plot_outputs(fig, raster_stems)
+
+
+def render_logoplot(information:np.ndarray, amino_acids:List[str], output_stems:Dict[str,str], renderer:str='logomaker'):
+    """
+    This function renders the logoplot for an allele and peptide length and writes it in each of the output formats
+
+    Args:
+        information (np.ndarray): The precomputed information content in bits of each amino acid at each position
+        amino_acids (List[str]): The amino acids, in the order of the columns of the information matrix
+        output_stems (Dict[str,str]): The path of the output files, without the file extension, for each output format
+        renderer (str): The logo renderer to use, either 'logomaker' or 'native'
+    """
+    if renderer == 'native':
+        return render_native_logoplot(information, amino_acids, output_stems)
+
+    # create the information matrix, with positions numbered from 1
+    info_mat = pd.DataFrame(information, index=range(1, len(information) + 1), columns=amino_acids)
+
+    # get the pre-styled logoplot figure, which is reused for every logoplot rendered by this process
+    fig, ax = figure_template('logoplot', style_logoplot, figsize=(25,20))
+
+    # create the logoplot
+    logoplot = logomaker.Logo(info_mat, ax=ax, vpad=0.1, color_scheme=colors, show_spines=False)
+
+    logoplot.style_spines(visible=False)
+    logoplot.style_spines(spines=['left', 'bottom'], visible=True)
+
+    # render the logoplot once for each format, and write the png, its base64 encoded data and the svg
+    write_plot_outputs(fig, output_stems)
+
+
 def build_logoplots(**kwargs) -> Dict[str,str]:
     """
     This function processes the output of the processed class I data downloaded from the MHC Motif Atlas into logoplots for each allele/length
@@ -55,6 +137,7 @@ def build_logoplots(**kwargs) -> Dict[str,str]:
         force (bool): Whether to force the step to run ignoring any previous results.
         output_path (str): The path to the output directory.
         console (Console): A Rich console object for printing Rich output.
+        jobs (int): The number of worker processes to render the logoplots with (defaults to 1, rendering serially).
     """
     config = kwargs['config']
     verbose = kwargs['verbose']
@@ -62,92 +145,85 @@ def build_logoplots(**kwargs) -> Dict[str,str]:
     output_path = kwargs['output_path']
     console = kwargs['console']
     function_name = kwargs['function_name']
+    jobs = int(kwargs.get('jobs') or 1)
 
-    # Create the filenames for the input file (the output of the previous step)
-    input_filename = f"{output_path}/motifs/alleles.json"
+    # Create the folder for the input shards (the output of the processing step)
+    warehouse_folder = f"{output_path}/motifs"
 
-    # Read the input file
-    alleles = read_json(input_filename)
+    # Open the sharded warehouse, each shard is only loaded if its logoplot needs to be rebuilt
+    shards = ShardedWarehouse(warehouse_folder)
+    alleles = shards.alleles
 
-    # Create the logoplots folders
-    create_folder(f"{output_path}/motifs/logoplots/png", verbose)
-    create_folder(f"{output_path}/motifs/logoplots/svg", verbose)
+    # Create the logoplots folders, one for each output format
+    plot_formats = config['CONSTANTS']['PLOT_FORMATS']
+    for plot_format in plot_formats:
+        create_folder(f"{output_path}/motifs/logoplots/{plot_format}", verbose)
+
+    # Load the record of the shard content each logoplot was built from, so only the logoplots whose data has changed are rebuilt
+    logoplot_manifest = AlleleManifest(f"{output_path}/motifs/logoplots/manifest.json")
+
+    # The logo renderer, either logomaker or the native renderer which composes the svg directly
+    renderer = config['CONSTANTS']['LOGOPLOT_RENDERER']
+    if renderer not in ['logomaker', 'native']:
+        raise ValueError(f"Unknown logoplot renderer {renderer}, it must be either logomaker or native")
 
     # Create counters for number of alleles and motifs processed
     i = 0
     j = 0
 
+    # Create lists for the logoplots to render, and for the alleles and content hashes they are rendered from
+    render_tasks = []
+    rebuilt = []
+
     # Iterate throught the alleles
     for allele in alleles:
 
-        # set the length to 9, at the moment we're only creating logoplots for nonamers
-        length = '9'
-        
-        # create a file stem for the png of the logoplot
-        # TODO check if we're using the text representation of the png
-        logoplot_png_stem = f"{output_path}/motifs/logoplots/png/{allele}_{length}"
-
-        # set a boolean for whether the plot already exists or not
-        logoplot_exists = False
-
-        # check if the logoplot already exists
-        if os.path.exists(f"{logoplot_png_stem}.png") and os.path.exists(f"{logoplot_png_stem}.txt"):
-            logoplot_exists = True
-
-        # if the force flag is set or the logoplot doesn't exist, create the logoplot
-        if force or not logoplot_exists:
-
-            # generate a set of peptides for the allele and length
-            peptides = alleles[allele][length]
-
-            # create a matrix of the peptides
-            counts_mat = logomaker.alignment_to_matrix(peptides)
-            counts_mat.index = range(1, int(length) + 1)
-            
-            # transform the matrix to information content
-            info_mat = logomaker.transform_matrix(counts_mat, from_type='counts', to_type='information')
-            
-            # initialise a set of variables for the logoplot, the png, and the png data
-            logoplot = None
-            logo_png = None
-            logo_png_data = None
-
-            # create the logoplot
-            logoplot = logomaker.Logo(info_mat, vpad=0.1, color_scheme=colors, show_spines=False, figsize=(25,20))
-            logoplot.ax.tick_params(axis='both', which='major', labelsize=40)
-
-            logoplot.ax.set_xlabel('Peptide position', fontsize=60, labelpad=10)
-            logoplot.ax.set_ylabel('Bits', fontsize=60, labelpad=40)
-
-            logoplot.style_spines(visible=False)
-            logoplot.style_spines(spines=['left', 'bottom'], visible=True)
-
-            # save the logoplot as a png, and generate the base64 encoded data
-            logo_png = BytesIO()
-
-            plt.savefig(f"{logoplot_png_stem}.png", format='png')
-
-            logo_png_data = base64.b64encode(logo_png.getbuffer()).decode("ascii")
-
-            with open(f"{logoplot_png_stem}.txt", "w") as logo_png_datafile:
-                logo_png_datafile.write(logo_png_data)
-            
-            # close the plot object, and clear the figure, if we don't do this we'll get a memory leak
-            plt.close()
-            
-            if verbose:
-                print (f"Logoplot for {allele} {length}mer motif created")
-        else:
-            if verbose:
-                print (f"Logoplot for {allele} {length}mer motif already exists")
-
-        j += 1
+        # Iterate through the peptide lengths for this allele, a logoplot is created for each length
+        for length in shards.lengths(allele):
+
+            # create a file stem for each output format of the logoplot
+            output_stems = {plot_format:f"{output_path}/motifs/logoplots/{plot_format}/{allele}_{length}" for plot_format in plot_formats}
+
+            # check if the logoplot already exists and was built from the current data for this allele and length, with the same renderer
+            content_hash = hash_content(shards.content_hash(allele, length).encode('ascii'), renderer.encode('ascii'))
+            logoplot_current = logoplot_manifest.is_current(f"{allele}_{length}", content_hash, plot_output_paths(output_stems))
+
+            # if the force flag is set or the logoplot doesn't exist or is out of date, queue the logoplot to be created
+            if force or not logoplot_current:
+                # the information content matrix was computed by the processing step, so the peptides don't need to be counted again
+                information = shards.shard(allele, length)['information']
+                render_tasks.append((information, shards.amino_acids, output_stems, renderer))
+                rebuilt.append((allele, length, content_hash))
+            else:
+                if verbose:
+                    print (f"Logoplot for {allele} {length}mer motif already exists")
+
+            j += 1
         i += 1
 
+    # render the queued logoplots, spread across a pool of worker processes if more than one job is set
+    render_plots(render_logoplot, render_tasks, workers=jobs, figures_per_worker=config['CONSTANTS']['PLOT_FIGURES_PER_WORKER'])
+
+    for allele, length, content_hash in rebuilt:
+        logoplot_manifest.update(f"{allele}_{length}", content_hash)
+        if verbose:
+            print (f"Logoplot for {allele} {length}mer motif created")
+
+    # remove the logoplots of any allele or length which no longer has a shard, so they are not left behind with out of date data
+    current_keys = {f"{allele}_{length}" for allele in alleles for length in shards.lengths(allele)}
+    removed = logoplot_manifest.remove_stale(current_keys, lambda key: plot_output_paths({plot_format:f"{output_path}/motifs/logoplots/{plot_format}/{key}" for plot_format in plot_formats}))
+    if verbose:
+        for key in removed:
+            print (f"Logoplot for {key} removed")
+
+    logoplot_manifest.save()
+
     # create the action log which will be included in the log file for this run of the pipeline
     action_log = {
         'alleles_processed':i,
-        'motifs_processed':j
+        'motifs_processed':j,
+        'motifs_rebuilt':len(rebuilt),
+        'motifs_removed':len(removed)
     }
     
     return action_log
\ No newline at end of file
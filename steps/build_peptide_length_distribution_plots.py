@@ -1,20 +1,54 @@
-from typing import Dict
+from typing import Dict, List
 
 from pipeline import create_folder
 
 from helpers.files import write_json, read_json
 
-from io import BytesIO
-import base64
+from warehouse import read_table, read_dictionary
+from incremental import AlleleManifest, hash_content
+from plot_rendering import render_plots, figure_template, write_plot_outputs, plot_output_paths
 
 import os
 
-import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 import numpy as np
 
 
 
+def style_lengthplot(fig:Figure, ax:Axes):
+    """
+    This function styles the figure and axes used for every peptide length distribution plot
+
+    Args:
+        fig (Figure): The lengthplot figure
+        ax (Axes): The lengthplot axes
+    """
+    ax.tick_params(axis='both', which='major', labelsize=55)
+
+    ax.set_xlabel('Peptide length', fontsize=70, labelpad=10)
+    ax.set_ylabel('Percentage of peptides', fontsize=70, labelpad=40)
+    ax.spines[['right', 'top']].set_visible(False)
+
+
+def render_lengthplot(labels:List[int], values:List[float], output_stems:Dict[str,str]):
+    """
+    This function renders the peptide length distribution plot for an allele and writes it in each of the output formats
+
+    Args:
+        labels (List[int]): The peptide lengths
+        values (List[float]): The percentage of peptides of each length
+        output_stems (Dict[str,str]): The path of the output files, without the file extension, for each output format
+    """
+    # get the pre-styled lengthplot figure, which is reused for every lengthplot rendered by this process
+    fig, ax = figure_template('lengthplot', style_lengthplot, figsize=(25,20))
+
+    ax.bar(labels, values, color='#0a0039')
+
+    # render the lengthplot once for each format, and write the png, its base64 encoded data and the svg
+    write_plot_outputs(fig, output_stems)
+
+
 def build_peptide_length_distribution_plots(**kwargs) -> Dict[str,str]:
     """
     This function processes the output of the processed class I data downloaded from the MHC Motif Atlas into length distribution plots for each allele
@@ -31,6 +65,7 @@ def build_peptide_length_distribution_plots(**kwargs) -> Dict[str,str]:
         force (bool): Whether to force the step to run ignoring any previous results.
         output_path (str): The path to the output directory.
         console (Console): A Rich console object for printing Rich output.
+        jobs (int): The number of worker processes to render the plots with (defaults to 1, rendering serially).
     """
     config = kwargs['config']
     verbose = kwargs['verbose']
@@ -38,81 +73,75 @@ def build_peptide_length_distribution_plots(**kwargs) -> Dict[str,str]:
     output_path = kwargs['output_path']
     console = kwargs['console']
     function_name = kwargs['function_name']
+    jobs = int(kwargs.get('jobs') or 1)
 
-    # Create the lengthplots folders
-    create_folder(f"{output_path}/motifs/lengthplots/png", verbose)
-    create_folder(f"{output_path}/motifs/lengthplots/svg", verbose)
-
+    # Create the lengthplots folders, one for each output format
+    plot_formats = config['CONSTANTS']['PLOT_FORMATS']
+    for plot_format in plot_formats:
+        create_folder(f"{output_path}/motifs/lengthplots/{plot_format}", verbose)
 
-    # Create the filenames for the input file (the output of the previous step)
-    input_filename = f"{output_path}/motifs/peptide_length_distributions.json"
 
-    # Read the input file
-    peptide_length_distributions = read_json(input_filename)
+    # Create the folder for the input table (the output of the previous step)
+    warehouse_folder = f"{output_path}/motifs"
 
-    i = 0
-    for allele in peptide_length_distributions:
-
-        # create a file stem for the png of the lengthplot
-        # TODO check if we're using the text representation of the png
-        lengthplot_png_stem = f"{output_path}/motifs/lengthplots/png/{allele}"
-
-        # set a boolean for whether the plot already exists or not
-        lengthplot_exists = False
-
-        # check if the logoplot already exists
-        if os.path.exists(f"{lengthplot_png_stem}.png") and os.path.exists(f"{lengthplot_png_stem}.txt"):
-            lengthplot_exists = True
-
-        # if the force flag is set or the logoplot doesn't exist, create the logoplot
-        if force or not lengthplot_exists:
-
-
-            motif_lengths = peptide_length_distributions[allele]
-
-            reworked_motif_lengths = {int(key):motif_lengths['lengths'][key] for key in motif_lengths['lengths']}
+    # Read the columns of the input table needed for the plots
+    peptide_length_distributions = read_table(warehouse_folder, 'peptide_length_distributions', ['allele_id', 'peptide_length', 'percentage'])
+    allele_labels = read_dictionary(warehouse_folder, 'peptide_length_distributions', 'allele_id')
 
-            labels = sorted(reworked_motif_lengths.keys())
-            values = [reworked_motif_lengths[label]['percentage'] for label in labels]
+    # Load the record of the data each lengthplot was built from, so only the lengthplots whose data has changed are rebuilt
+    lengthplot_manifest = AlleleManifest(f"{output_path}/motifs/lengthplots/manifest.json")
 
-            # initialise a set of variables for the logoplot, the png, and the png data
-            fig = None
-            png = None
-            png_data = None
+    # Create lists for the lengthplots to render, and for the alleles and content hashes they are rendered from
+    render_tasks = []
+    rebuilt = []
 
-            fig = Figure()
-            fig.set_figwidth(25)
-            fig.set_figheight(20)
-            ax = fig.subplots()
-            ax.bar(labels, values, color='#0a0039')
-            ax.tick_params(axis='both', which='major', labelsize=55)
-
-            ax.set_xlabel('Peptide length', fontsize=70, labelpad=10)
-            ax.set_ylabel('Percentage of peptides', fontsize=70, labelpad=40)
-            ax.spines[['right', 'top']].set_visible(False)
-
-            lengthplot_png_stem = f"{output_path}/motifs/lengthplots/png/{allele}"
+    i = 0
+    for allele_id, allele in enumerate(allele_labels):
 
-            png = BytesIO()
+        # create a file stem for each output format of the lengthplot
+        output_stems = {plot_format:f"{output_path}/motifs/lengthplots/{plot_format}/{allele}" for plot_format in plot_formats}
 
-            fig.savefig(png, format="png")
-            fig.savefig(f"{lengthplot_png_stem}.png", format="png")
+        # select the lengths for this allele, in order of length
+        selected = peptide_length_distributions['allele_id'] == allele_id
+        order = np.argsort(peptide_length_distributions['peptide_length'][selected])
+        lengths = peptide_length_distributions['peptide_length'][selected][order]
+        percentages = peptide_length_distributions['percentage'][selected][order]
 
-            png_data = base64.b64encode(png.getbuffer()).decode("ascii")
+        # check if the lengthplot already exists and was built from the current data for this allele
+        content_hash = hash_content(lengths.tobytes(), percentages.tobytes())
+        lengthplot_current = lengthplot_manifest.is_current(allele, content_hash, plot_output_paths(output_stems))
 
-            with open(f"{lengthplot_png_stem}.txt", 'w') as f:
-                f.write(png_data)
-            if verbose:
-                print (f"Length distribution plot for {allele} created")
+        # if the force flag is set or the lengthplot doesn't exist or is out of date, queue the lengthplot to be created
+        if force or not lengthplot_current:
+            render_tasks.append((lengths.tolist(), percentages.tolist(), output_stems))
+            rebuilt.append((allele, content_hash))
         else:
             if verbose:
                 print (f"Length distribution plot for {allele} already exists")
 
         i += 1
 
+    # render the queued lengthplots, spread across a pool of worker processes if more than one job is set
+    render_plots(render_lengthplot, render_tasks, workers=jobs, figures_per_worker=config['CONSTANTS']['PLOT_FIGURES_PER_WORKER'])
+
+    for allele, content_hash in rebuilt:
+        lengthplot_manifest.update(allele, content_hash)
+        if verbose:
+            print (f"Length distribution plot for {allele} created")
+
+    # remove the lengthplots of any allele which is no longer in the table, so they are not left behind with out of date data
+    removed = lengthplot_manifest.remove_stale(set(allele_labels), lambda allele: plot_output_paths({plot_format:f"{output_path}/motifs/lengthplots/{plot_format}/{allele}" for plot_format in plot_formats}))
+    if verbose:
+        for allele in removed:
+            print (f"Length distribution plot for {allele} removed")
+
+    lengthplot_manifest.save()
+
     # create the action log which will be included in the log file for this run of the pipeline
     action_log = {
         'alleles_processed':i,
+        'alleles_rebuilt':len(rebuilt),
+        'alleles_removed':len(removed)
     }
     
     return action_log
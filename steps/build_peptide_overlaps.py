@@ -0,0 +1,86 @@
+from typing import Dict
+
+from warehouse import read_sparse_matrix, read_table, read_table_metadata, write_table
+from peptide_overlaps import allele_locus, shared_peptide_counts, allele_overlaps, peptide_promiscuity
+from packed_peptides import unpack_peptides
+
+import time
+
+import numpy as np
+
+
+def build_peptide_overlaps(**kwargs) -> Dict[str,str]:
+    """
+    This function finds the peptides shared between every pair of alleles, and ranks the peptides by the number of alleles which present them
+
+    Both are computed from the allele by peptide incidence matrix written by the processing step. The shared peptide count and Jaccard similarity
+    of each pair of alleles which share a peptide are written to the allele_overlaps table, and the number of alleles and loci presenting each
+    peptide to the peptide_promiscuity table, in the columnar warehouse.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        Dict[str,str]: A dictionary containing the action log for this step.
+
+    Keyword Args:
+        config (dict): The configuration dictionary.
+        verbose (bool): Whether to print verbose output.
+        force (bool): Whether to force the step to run ignoring any previous results.
+        output_path (str): The path to the output directory.
+        console (Console): A Rich console object for printing Rich output.
+    """
+    config = kwargs['config']
+    verbose = kwargs['verbose']
+    force = kwargs['force']
+    output_path = kwargs['output_path']
+    console = kwargs['console']
+    function_name = kwargs['function_name']
+
+    warehouse_folder = f"{output_path}/motifs"
+    incidence = read_sparse_matrix(warehouse_folder, 'allele_peptide_incidence')
+    incidence_metadata = read_table_metadata(warehouse_folder, 'allele_peptide_incidence')
+    allele_labels = incidence_metadata['dictionaries']['allele_id']
+
+    start_time = time.perf_counter()
+    shared = shared_peptide_counts(incidence)
+    overlaps = allele_overlaps(shared)
+    promiscuity = peptide_promiscuity(incidence, [allele_locus(allele_slug) for allele_slug in allele_labels])
+    seconds = round(time.perf_counter() - start_time, 3)
+
+    # the tables record the incidence matrix they were built from, so the table step can tell if they are out of date
+    sources = {'allele_peptide_incidence':incidence_metadata['content_hash']}
+    write_table(warehouse_folder, 'allele_overlaps', overlaps, {'allele_id':allele_labels, 'other_allele_id':allele_labels}, verbose, sources)
+    write_table(warehouse_folder, 'peptide_promiscuity', promiscuity, None, verbose, sources)
+
+    # the most promiscuous peptides are unpacked for the action log
+    top_peptide_ids = np.argsort(promiscuity['promiscuity_rank'])[:10]
+    top_peptides = unpack_peptides(read_table(warehouse_folder, 'peptides')['peptide'][top_peptide_ids]).tolist()
+    most_promiscuous = {peptide:int(promiscuity['allele_count'][peptide_id]) for peptide, peptide_id in zip(top_peptides, top_peptide_ids)}
+
+    most_similar = None
+    if len(overlaps['jaccard']):
+        i = int(np.argmax(overlaps['jaccard']))
+        most_similar = {
+            'alleles':[allele_labels[overlaps['allele_id'][i]], allele_labels[overlaps['other_allele_id'][i]]],
+            'shared_peptides':int(overlaps['shared_peptides'][i]),
+            'jaccard':round(float(overlaps['jaccard'][i]), 4)
+        }
+
+    if verbose:
+        print (f"{len(overlaps['jaccard'])} pairs of alleles share at least one peptide")
+        print (f"{int(np.count_nonzero(promiscuity['allele_count'] > 1))} of {incidence.shape[1]} peptides are presented by more than one allele")
+        print (f"Most promiscuous peptides: {most_promiscuous}")
+
+    # create the action log which will be included in the log file for this run of the pipeline
+    action_log = {
+        'alleles':incidence.shape[0],
+        'peptides':incidence.shape[1],
+        'allele_pairs_sharing_peptides':len(overlaps['jaccard']),
+        'shared_peptides':int(np.count_nonzero(promiscuity['allele_count'] > 1)),
+        'most_similar_alleles':most_similar,
+        'most_promiscuous_peptides':most_promiscuous,
+        'seconds':seconds
+    }
+
+    return action_log
@@ -0,0 +1,99 @@
+from typing import Dict
+
+from warehouse import ShardedWarehouse, write_table
+
+import numpy as np
+
+
+def log_odds_matrices(counts:np.ndarray, pseudocount:float=1.0) -> np.ndarray:
+    """
+    This function builds log-odds position specific scoring matrices from the amino acid counts of a set of motifs of the same length
+
+    The probability of each amino acid at each position has a pseudocount added, as for the logoplots, and is compared with the background
+    frequency of the amino acid in the peptides of all the motifs, so a score of 0 means a peptide is no more likely for the allele than for
+    the panel as a whole
+
+    Args:
+        counts (np.ndarray): The amino acid counts with the shape (alleles, length, amino acids)
+        pseudocount (float): The pseudocount added to the count of each amino acid at each position
+
+    Returns:
+        np.ndarray: The scoring matrices in bits with the shape (alleles, length, amino acids)
+    """
+    probabilities = (counts + pseudocount) / (counts + pseudocount).sum(axis=2, keepdims=True)
+    background_counts = counts.sum(axis=(0, 1)) + pseudocount
+    background = background_counts / background_counts.sum()
+    return np.log2(probabilities / background).astype(np.float32)
+
+
+def build_scoring_matrices(**kwargs) -> Dict[str,str]:
+    """
+    This function builds the log-odds scoring matrices used to score peptides against every allele, for each peptide length
+
+    The matrices are written to the scoring_matrices table in the columnar warehouse, with a row for each allele and peptide length.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        Dict[str,str]: A dictionary containing the action log for this step.
+
+    Keyword Args:
+        config (dict): The configuration dictionary.
+        verbose (bool): Whether to print verbose output.
+        force (bool): Whether to force the step to run ignoring any previous results.
+        output_path (str): The path to the output directory.
+        console (Console): A Rich console object for printing Rich output.
+    """
+    config = kwargs['config']
+    verbose = kwargs['verbose']
+    force = kwargs['force']
+    output_path = kwargs['output_path']
+    console = kwargs['console']
+    function_name = kwargs['function_name']
+
+    warehouse_folder = f"{output_path}/motifs"
+    shards = ShardedWarehouse(warehouse_folder)
+    allele_ids = {allele_slug:allele_id for allele_id, allele_slug in enumerate(shards.alleles)}
+
+    # the peptide lengths with a motif for at least one allele, in length order
+    peptide_lengths = sorted({peptide_length for allele_slug in shards.alleles for peptide_length in shards.lengths(allele_slug)}, key=int)
+
+    # the matrices for every allele and peptide length are held in one table, padded with zeros to the longest peptide length
+    max_length = int(peptide_lengths[-1]) if peptide_lengths else 0
+    columns = {'allele_id':[], 'peptide_length':[], 'peptide_count':[], 'matrix':[]}
+    matrices_built = {}
+    for peptide_length in peptide_lengths:
+        allele_labels = [allele_slug for allele_slug in shards.alleles if shards.has_shard(allele_slug, peptide_length)]
+        counts = np.stack([shards.shard(allele_slug, peptide_length)['counts'] for allele_slug in allele_labels]).astype(np.float64)
+        matrices = log_odds_matrices(counts, config['CONSTANTS']['SCORING_PSEUDOCOUNT'])
+
+        columns['allele_id'].extend(allele_ids[allele_slug] for allele_slug in allele_labels)
+        columns['peptide_length'].extend([int(peptide_length)] * len(allele_labels))
+        columns['peptide_count'].extend(shards.peptide_count(allele_slug, peptide_length) for allele_slug in allele_labels)
+        columns['matrix'].append(np.pad(matrices, ((0, 0), (0, max_length - int(peptide_length)), (0, 0))))
+        matrices_built[peptide_length] = len(allele_labels)
+
+        if verbose:
+            print (f"Built scoring matrices for {len(allele_labels)} alleles with {peptide_length}mer motifs")
+
+    columns = {
+        'allele_id':np.array(columns['allele_id'], dtype=np.int32),
+        'peptide_length':np.array(columns['peptide_length'], dtype=np.int16),
+        'peptide_count':np.array(columns['peptide_count'], dtype=np.int64),
+        'matrix':np.concatenate(columns['matrix']) if columns['matrix'] else np.zeros((0, 0, len(shards.amino_acids)), dtype=np.float32)
+    }
+    # the amino acids label the last axis of the matrices
+    dictionaries = {
+        'allele_id':shards.alleles,
+        'matrix':shards.amino_acids
+    }
+    write_table(warehouse_folder, 'scoring_matrices', columns, dictionaries, verbose)
+
+    # create the action log which will be included in the log file for this run of the pipeline
+    action_log = {
+        'peptide_lengths':peptide_lengths,
+        'matrices_built':matrices_built
+    }
+
+    return action_log
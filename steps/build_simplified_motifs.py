@@ -4,6 +4,10 @@ from pipeline import create_folder
 
 from helpers.files import write_json, read_json
 
+from warehouse import ShardedWarehouse
+
+from build_sorted_amino_acid_distributions import sort_motif
+
 
 def build_simplified_motifs(**kwargs) -> Dict[str,str]:
     """
@@ -30,13 +34,14 @@ def build_simplified_motifs(**kwargs) -> Dict[str,str]:
     function_name = kwargs['function_name']
 
 
-    # Create the filenames for the input file (the output of the previous step) and the output file (the input for the next step)
-    input_filename = f"{output_path}/motifs/sorted_amino_acid_distributions.json"
+    # Create the folder for the input shards (the output of the processing step) and the filename for the output file (the input for the next step)
+    warehouse_folder = f"{output_path}/motifs"
     output_filename = f"{output_path}/motifs/simplified_motifs.json"
 
 
-    # Read the input file
-    sorted_amino_acid_distributions = read_json(input_filename)
+    # Open the sharded warehouse, only the nonamer shards are loaded
+    shards = ShardedWarehouse(warehouse_folder)
+    amino_acid_labels = shards.amino_acids
 
     # Create a new dictionary to store the simplified motifs
     simplified_motifs = {}
@@ -52,32 +57,34 @@ def build_simplified_motifs(**kwargs) -> Dict[str,str]:
 
     """
 
-    # Initialise counters for numbers of alleles and motifs processed
-    i = 0
+    # Loop through the alleles which have a nonamer motif
+    for allele in shards.alleles:
+        if not shards.has_shard(allele, '9'):
+            continue
 
-    # Loop through the alleles
-    for allele in sorted_amino_acid_distributions:
+        # Select the nonamer motif, sorted by position and then by descending percentage
+        motif = shards.shard(allele, '9')
+        sorted_motif = sort_motif(motif['counts'], motif['percentages'])
 
-        # Select the nonamer motif
-        motif = sorted_amino_acid_distributions[allele]['9']
+        # Create a new dictionary to store the simplified motif, with an entry for each position
+        simplified_motif = {str(position):[] for position in range(1, len(motif['counts']) + 1)}
 
-        # Create a new dictionary to store the simplified motif
-        simplified_motif = {}
+        # Loop through the amino acids at each position
+        for position, amino_acid_id, grade in zip(sorted_motif['position'].tolist(), sorted_motif['amino_acid_id'].tolist(), sorted_motif['grade'].tolist()):
+            # If the amino acid is dominant or high, add it to the simplified motif
+            if grade in ['dominant', 'high']:
+                simplified_motif[str(position)].append({'amino_acid':amino_acid_labels[amino_acid_id], 'grade':grade}) 
 
-        # Loop through the positions in the motif
-        for position in motif:
-            simplified_motif[position] = []
-            # Loop through the amino acids at each position
-            for amino_acid in motif[position]:
-                # If the amino acid is dominant or high, add it to the simplified motif
-                if amino_acid['grade'] in ['dominant', 'high']:
-                    simplified_motif[position].append({'amino_acid':amino_acid['amino_acid'], 'grade':amino_acid['grade']}) 
-        # If the verbosity is true, print the allele and the simplified motif
-        if verbose:
-            print (f"{allele} processed: {simplified_motif}")
         # Add the simplified motif to the dictionary of simplified motifs
         simplified_motifs[allele] = simplified_motif
-        i += 1
+
+    # If the verbosity is true, print the allele and the simplified motif
+    if verbose:
+        for allele, simplified_motif in simplified_motifs.items():
+            print (f"{allele} processed: {simplified_motif}")
+
+    # Count the number of alleles processed
+    i = len(simplified_motifs)
 
     # Output the simplified motifs to a JSON file
     write_json(output_filename, simplified_motifs, pretty=True)
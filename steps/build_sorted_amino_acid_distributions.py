@@ -4,18 +4,9 @@ from pipeline import create_folder
 
 from helpers.files import write_json, read_json
 
+from warehouse import read_table, read_dictionary, write_table
 
-def get_percentage(amino_acid: Dict[str, str]) -> int:
-    """
-    This function returns the percentage of an amino acid in a motif or zero if the percentage key does not exist
-
-    Args:
-        amino_acid (Dict[str, str]): The amino acid to get the percentage of
-
-    Returns:
-        int: The percentage of the amino acid in the motif or zero if the percentage key does not exist
-    """
-    return amino_acid.get('percentage', 0)
+import numpy as np
 
 
 def assign_grade(percentage: float) -> str:
@@ -40,36 +31,71 @@ def assign_grade(percentage: float) -> str:
         return "very-low"
 
 
-def manipulate_data(motif_data: Dict[str, Dict[str, Dict[str, str]]]) -> Dict[str, Dict[str, Dict[str, str]]]:
+def assign_grades(percentages: np.ndarray) -> np.ndarray:
     """
-    This function processes the output of the processed class I data downloaded from the MHC Motif Atlas
+    This function assigns grades to an array of amino acid percentages, using the same thresholds as assign_grade
+
+    Args:
+        percentages (np.ndarray): The percentages of the amino acids in the motifs
+
+    Returns:
+        np.ndarray: The grade of each amino acid in the motifs
+    """
+    conditions = [percentages > 60, percentages > 30, percentages > 20, percentages > 10]
+    return np.select(conditions, ['dominant', 'high', 'medium', 'low'], default='very-low')
+
+
+def sort_amino_acid_distributions(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    This function sorts the rows of the amino acid distributions table by percentage within each motif position
 
-    It sorts the amino acids by percentage and assigns a grade to each amino acid based on the percentage and creates a rounded down percentage value for display
+    It assigns a grade to each amino acid based on the percentage and creates a rounded percentage value for display
 
     Args:
-        motif_data (Dict[str, Dict[str, Dict[str, str]]]): The motif data to process
+        columns (Dict[str, np.ndarray]): The columns of the amino acid distributions table, with the rows for each motif position together
 
     Returns:
-        Dict[str, Dict[str, Dict[str, str]]]: The processed motif data
+        Dict[str, np.ndarray]: The sorted columns, with the grade and rounded_percentage columns added
     """
-    for position, sub_dict in motif_data.items():
+    # number the motif positions, a new one starts whenever the allele, length or position changes from the previous row
+    changes = np.zeros(len(columns['position']), dtype=bool)
+    for column_name in ['allele_id', 'peptide_length', 'position']:
+        changes[1:] |= columns[column_name][1:] != columns[column_name][:-1]
+    motif_positions = np.cumsum(changes)
 
-        # Ensure the percentage key exists and set to zero if not
-        for amino_acid, amino_acid_data in sub_dict.items():
-            amino_acid_data.setdefault('percentage', 0)
+    # order the rows by descending percentage within each motif position, the sort is stable so ties keep their existing order
+    order = np.lexsort((-columns['percentage'], motif_positions))
+    sorted_columns = {column_name:column[order] for column_name, column in columns.items()}
 
-        
-        # Set the 'grade' field based on the 'percentage' field
-        for amino_acid, amino_acid_data in sub_dict.items():
-            amino_acid_data['grade'] = assign_grade(amino_acid_data['percentage'])
-            amino_acid_data['rounded_percentage'] = round(amino_acid_data['percentage'], 1)
-            amino_acid_data['amino_acid'] = amino_acid
-        
-        # Order the sub-dictionary by the percentage value
-        sorted_sub_dict = sorted(sub_dict.items(), key=lambda item: get_percentage(item[1]), reverse=True)
-        motif_data[position] = [value for key, value in sorted_sub_dict]
+    sorted_columns['grade'] = assign_grades(sorted_columns['percentage'])
+    sorted_columns['rounded_percentage'] = np.array([round(percentage, 1) for percentage in sorted_columns['percentage'].tolist()], dtype=np.float64)
+    return sorted_columns
 
-    return motif_data
+
+def sort_motif(counts: np.ndarray, percentages: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    This function sorts the amino acids at each position of a single motif by percentage, in the same order as sort_amino_acid_distributions
+
+    Args:
+        counts (np.ndarray): The amino acid counts for the motif with the shape (length, amino acids)
+        percentages (np.ndarray): The amino acid percentages for the motif with the shape (length, amino acids)
+
+    Returns:
+        Dict[str, np.ndarray]: The position, amino_acid_id, percentage and grade of the amino acids seen at each position, sorted by position and
+        then by descending percentage
+    """
+    # order the amino acids by descending percentage at each position, the sort is stable so ties stay in amino acid order
+    amino_acid_ids = np.argsort(-percentages, axis=1, kind='stable')
+    positions = np.broadcast_to(np.arange(1, len(counts) + 1)[:, None], amino_acid_ids.shape)
+    # only the amino acids which are seen at a position are included
+    seen = np.take_along_axis(counts, amino_acid_ids, axis=1) > 0
+    sorted_percentages = np.take_along_axis(percentages, amino_acid_ids, axis=1)[seen]
+    return {
+        'position':positions[seen],
+        'amino_acid_id':amino_acid_ids[seen],
+        'percentage':sorted_percentages,
+        'grade':assign_grades(sorted_percentages)
+    }
 
 
 def build_sorted_amino_acid_distributions(**kwargs) -> Dict[str,str]:
@@ -96,41 +122,52 @@ def build_sorted_amino_acid_distributions(**kwargs) -> Dict[str,str]:
     console = kwargs['console']
     function_name = kwargs['function_name']
 
-    # Create the filenames for the input file (the output of the previous step) and the output file (the input for the next step)
-    input_filename = f"{output_path}/motifs/amino_acid_distributions.json"
+    # Create the folder for the input table (the output of the previous step) and the filename for the output file (the input for the next step)
+    warehouse_folder = f"{output_path}/motifs"
     output_filename = f"{output_path}/motifs/sorted_amino_acid_distributions.json"
 
-    # Read the input file
-    raw_amino_acid_distributions = read_json(input_filename)
+    # Read the input table and the labels for the alleles and amino acids
+    columns = read_table(warehouse_folder, 'amino_acid_distributions')
+    allele_labels = read_dictionary(warehouse_folder, 'amino_acid_distributions', 'allele_id')
+    amino_acid_labels = read_dictionary(warehouse_folder, 'amino_acid_distributions', 'amino_acid_id')
+
+    # Sort, grade and round the amino acid distributions for every motif in one pass and write them as a table for the later steps
+    sorted_columns = sort_amino_acid_distributions(columns)
+    write_table(warehouse_folder, 'sorted_amino_acid_distributions', sorted_columns, {'allele_id':allele_labels.tolist(), 'amino_acid_id':amino_acid_labels.tolist()}, verbose)
 
-    # Create a new dictionary to store the sorted amino acid distributions
+    # Create a new dictionary to store the sorted amino acid distributions, this is exported as JSON
     sorted_amino_acid_distributions = {}
 
     # Initialise counters for numbers of alleles and motifs processed
     i = 0
     j = 0
 
-    # Process the raw amino acid distributions
-    for allele in raw_amino_acid_distributions:
-
-        # Create a new sub-dictionary for the allele
-        sorted_amino_acid_distributions[allele] = {}
-        
-        # Increment the allele counter
-        i += 1
-
-        # Process the raw amino acid distributions for each length
-        for length in raw_amino_acid_distributions[allele]:
-
-            # Create a new sub-dictionary for the length and add the sorted, graded and rounded amino acid distribution
-            sorted_amino_acid_distributions[allele][length] = manipulate_data(raw_amino_acid_distributions[allele][length])
-            
+    rows = zip(*[sorted_columns[column_name].tolist() for column_name in ['allele_id', 'peptide_length', 'position', 'amino_acid_id', 'count', 'percentage', 'grade', 'rounded_percentage']])
+    for allele_id, length, position, amino_acid_id, count, percentage, grade, rounded_percentage in rows:
+        allele = allele_labels[allele_id]
+        length = str(length)
+
+        # Create a new sub-dictionary for the allele, and for the length
+        if allele not in sorted_amino_acid_distributions:
+            sorted_amino_acid_distributions[allele] = {}
+            # Increment the allele counter
+            i += 1
+        if length not in sorted_amino_acid_distributions[allele]:
+            sorted_amino_acid_distributions[allele][length] = {}
             # Increment the motif counter
             j += 1
-
             if verbose:
                 print (f"Sorted, graded and rounded amino acid distribution for {allele} and length {length}")
 
+        # Add the sorted, graded and rounded amino acid to the list for this position
+        sorted_amino_acid_distributions[allele][length].setdefault(str(position), []).append({
+            'count':count,
+            'percentage':percentage,
+            'grade':grade,
+            'rounded_percentage':rounded_percentage,
+            'amino_acid':amino_acid_labels[amino_acid_id]
+        })
+
     # Output the sorted amino acid distributions to a JSON file
     write_json(output_filename, sorted_amino_acid_distributions)
 
@@ -1,11 +1,295 @@
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from helpers.files import write_json, read_json
+
+from warehouse import ShardedWarehouse, columnar_folder, read_table, read_table_metadata, read_dictionary
+from sqlite_loader import build_database, time_queries
+
+from build_sorted_amino_acid_distributions import sort_motif
+from packed_peptides import unpack_peptides
+from peptide_overlaps import allele_locus
+
 import csv
 import os
+import sqlite3
+
+import numpy as np
+
+
+## table format ##
+
+# The database is normalised into a table of alleles, the sorted amino acid distribution at each motif position, the peptides and the link
+# between peptides and alleles. The motifs view joins the alleles and motif positions back into the original flat table format:
+
+# allele_slug   position    amino_acid  grade       percentage  peptide_length
+# hla_a_01_01   3           D           very-high   67.933      9
+
+ALLELES_SCHEMA = [
+    ('allele_id', 'INTEGER PRIMARY KEY'),
+    ('allele_slug', 'TEXT NOT NULL UNIQUE'),
+    ('locus', 'TEXT NOT NULL'),
+    ('peptide_count', 'INTEGER NOT NULL')
+]
+
+MOTIF_POSITIONS_SCHEMA = [
+    ('allele_id', 'INTEGER NOT NULL REFERENCES alleles(allele_id)'),
+    ('peptide_length', 'INTEGER NOT NULL'),
+    ('position', 'INTEGER NOT NULL'),
+    ('amino_acid', 'TEXT NOT NULL'),
+    ('grade', 'TEXT NOT NULL'),
+    ('percentage', 'REAL NOT NULL'),
+    ('count', 'INTEGER NOT NULL')
+]
+
+ALLELE_LENGTHS_SCHEMA = [
+    ('allele_id', 'INTEGER NOT NULL REFERENCES alleles(allele_id)'),
+    ('peptide_length', 'INTEGER NOT NULL'),
+    ('peptide_count', 'INTEGER NOT NULL'),
+    ('percentage', 'REAL NOT NULL'),
+    ('consensus', 'TEXT NOT NULL')
+]
+
+PEPTIDES_SCHEMA = [
+    ('peptide_id', 'INTEGER PRIMARY KEY'),
+    ('sequence', 'TEXT NOT NULL UNIQUE'),
+    ('length', 'INTEGER NOT NULL')
+]
+
+ALLELE_PEPTIDES_SCHEMA = [
+    ('allele_id', 'INTEGER NOT NULL REFERENCES alleles(allele_id)'),
+    ('peptide_id', 'INTEGER NOT NULL REFERENCES peptides(peptide_id)')
+]
+
+# The peptides shared between alleles, and the promiscuity of each peptide, are loaded when the overlap analysis step has been run. Each pair of
+# alleles is held once in the allele overlaps table, the allele similarities view lists each pair both ways round.
+ALLELE_OVERLAPS_SCHEMA = [
+    ('allele_id', 'INTEGER NOT NULL REFERENCES alleles(allele_id)'),
+    ('other_allele_id', 'INTEGER NOT NULL REFERENCES alleles(allele_id)'),
+    ('shared_peptides', 'INTEGER NOT NULL'),
+    ('jaccard', 'REAL NOT NULL')
+]
+
+PEPTIDE_PROMISCUITY_SCHEMA = [
+    ('peptide_id', 'INTEGER PRIMARY KEY REFERENCES peptides(peptide_id)'),
+    ('allele_count', 'INTEGER NOT NULL'),
+    ('locus_count', 'INTEGER NOT NULL'),
+    ('promiscuity_rank', 'INTEGER NOT NULL')
+]
+
+# The column labels of the flat motifs table, used for the motifs view and the CSV
+MOTIFS_LABELS = ['allele_slug', 'position', 'amino_acid', 'grade', 'percentage', 'peptide_length']
+
+# The indexes are created once the rows are loaded. The motif lookup index covers the columns used to search for alleles with a given amino
+# acid at a given position, so those queries are answered from the index alone.
+INDEX_STATEMENTS = [
+    'CREATE INDEX motif_positions_lookup ON motif_positions (peptide_length, position, amino_acid, percentage, allele_id)',
+    'CREATE INDEX motif_positions_allele ON motif_positions (allele_id, peptide_length, position)',
+    'CREATE UNIQUE INDEX allele_lengths_allele ON allele_lengths (allele_id, peptide_length)',
+    'CREATE UNIQUE INDEX allele_peptides_allele ON allele_peptides (allele_id, peptide_id)',
+    'CREATE INDEX allele_peptides_peptide ON allele_peptides (peptide_id, allele_id)'
+]
+
+VIEW_STATEMENTS = [
+    '''CREATE VIEW motifs AS
+    SELECT alleles.allele_slug, motif_positions.position, motif_positions.amino_acid, motif_positions.grade, motif_positions.percentage,
+        motif_positions.peptide_length
+    FROM motif_positions JOIN alleles ON alleles.allele_id = motif_positions.allele_id''',
+    '''CREATE VIEW allele_summary AS
+    SELECT alleles.allele_slug, alleles.locus, alleles.peptide_count, allele_lengths.peptide_count AS nonamer_count,
+        allele_lengths.percentage AS nonamer_percentage, allele_lengths.consensus AS nonamer_consensus
+    FROM alleles LEFT JOIN allele_lengths ON allele_lengths.allele_id = alleles.allele_id AND allele_lengths.peptide_length = 9''',
+    '''CREATE VIEW peptide_alleles AS
+    SELECT peptides.sequence, peptides.length, alleles.allele_slug
+    FROM allele_peptides
+        JOIN peptides ON peptides.peptide_id = allele_peptides.peptide_id
+        JOIN alleles ON alleles.allele_id = allele_peptides.allele_id'''
+]
+
+OVERLAP_INDEX_STATEMENTS = [
+    'CREATE UNIQUE INDEX allele_overlaps_allele ON allele_overlaps (allele_id, other_allele_id)',
+    'CREATE INDEX allele_overlaps_other ON allele_overlaps (other_allele_id, allele_id)',
+    'CREATE INDEX peptide_promiscuity_rank ON peptide_promiscuity (promiscuity_rank)'
+]
+
+OVERLAP_VIEW_STATEMENTS = [
+    '''CREATE VIEW allele_similarities AS
+    SELECT alleles.allele_slug, other_alleles.allele_slug AS other_allele_slug, pairs.shared_peptides, pairs.jaccard
+    FROM (
+        SELECT allele_id, other_allele_id, shared_peptides, jaccard FROM allele_overlaps
+        UNION ALL
+        SELECT other_allele_id, allele_id, shared_peptides, jaccard FROM allele_overlaps
+    ) AS pairs
+        JOIN alleles ON alleles.allele_id = pairs.allele_id
+        JOIN alleles AS other_alleles ON other_alleles.allele_id = pairs.other_allele_id''',
+    '''CREATE VIEW promiscuous_peptides AS
+    SELECT peptides.sequence, peptides.length, peptide_promiscuity.allele_count, peptide_promiscuity.locus_count,
+        peptide_promiscuity.promiscuity_rank
+    FROM peptide_promiscuity JOIN peptides ON peptides.peptide_id = peptide_promiscuity.peptide_id'''
+]
+
+# Typical datasette lookups, timed after each build so the action log shows the query latencies
+BENCHMARK_QUERIES = {
+    'alleles_with_residue_at_position':'''SELECT alleles.allele_slug, motif_positions.percentage FROM motif_positions JOIN alleles ON alleles.allele_id = motif_positions.allele_id
+        WHERE motif_positions.peptide_length = 9 AND motif_positions.position = 2 AND motif_positions.amino_acid = 'L' AND motif_positions.percentage > 60''',
+    'motif_for_allele':"SELECT * FROM motifs WHERE allele_slug = 'hla_a_02_01' AND peptide_length = 9",
+    'alleles_for_peptide':"SELECT allele_slug FROM peptide_alleles WHERE sequence = (SELECT sequence FROM peptides WHERE peptide_id = 1)",
+    'peptides_containing':"SELECT peptides.sequence FROM peptides_fts JOIN peptides ON peptides.peptide_id = peptides_fts.rowid WHERE peptides_fts MATCH 'LLL' LIMIT 100",
+    'allele_summary':"SELECT * FROM allele_summary"
+}
+
+OVERLAP_BENCHMARK_QUERIES = {
+    'alleles_similar_to_allele':"SELECT * FROM allele_similarities WHERE allele_slug = 'hla_a_02_01' ORDER BY jaccard DESC LIMIT 10",
+    'most_promiscuous_peptides':"SELECT * FROM promiscuous_peptides ORDER BY promiscuity_rank LIMIT 100"
+}
+
+
+def fts_statements() -> List[str]:
+    """
+    This function returns the statements to build the full text index on the peptide sequences
+
+    The trigram tokenizer (SQLite 3.34 and later) lets any three or more residues be searched for anywhere in a sequence, older versions of SQLite
+    index each sequence as a single token, which can be searched for by prefix
+
+    Returns:
+        List[str]: The statements to create and fill the full text index
+    """
+    if sqlite3.sqlite_version_info >= (3, 34, 0):
+        tokenizer = "tokenize='trigram'"
+    else:
+        tokenizer = "prefix='2 3 4'"
+    return [
+        f"CREATE VIRTUAL TABLE peptides_fts USING fts5(sequence, content='peptides', content_rowid='peptide_id', {tokenizer})",
+        "INSERT INTO peptides_fts (peptides_fts) VALUES ('rebuild')"
+    ]
+
+
+def overlaps_are_current(warehouse_folder:str, peptide_count:int) -> bool:
+    """
+    This function checks that the allele overlaps and peptide promiscuity tables exist and were built from the current incidence matrix
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        peptide_count (int): The number of peptides in the current peptides table
+
+    Returns:
+        bool: Whether the overlap tables can be loaded
+    """
+    folder = columnar_folder(warehouse_folder)
+    if not all(os.path.exists(f"{folder}/{name}.json") for name in ['allele_peptide_incidence', 'allele_overlaps', 'peptide_promiscuity']):
+        return False
+    incidence_hash = read_table_metadata(warehouse_folder, 'allele_peptide_incidence').get('content_hash')
+    if incidence_hash is None:
+        return False
+    for table_name in ['allele_overlaps', 'peptide_promiscuity']:
+        if read_table_metadata(warehouse_folder, table_name).get('sources', {}).get('allele_peptide_incidence') != incidence_hash:
+            return False
+    # the promiscuity table has a row for every peptide
+    return read_table_metadata(warehouse_folder, 'peptide_promiscuity')['rows'] == peptide_count
+
+
+def motif_position_rows(shards:ShardedWarehouse, allele_ids:Dict[str, int]) -> Iterator[Tuple]:
+    """
+    This function returns a row of the motif positions table for each amino acid seen at each position of each allele and peptide length
+
+    Args:
+        shards (ShardedWarehouse): The sharded warehouse
+        allele_ids (Dict[str, int]): The id for each allele slug
+
+    Yields:
+        Tuple: The allele id, peptide length, position, amino acid, grade, percentage and count
+    """
+    amino_acid_labels = shards.amino_acids
+    for allele_slug in shards.alleles:
+        for peptide_length in shards.lengths(allele_slug):
+            motif = shards.shard(allele_slug, peptide_length)
+            sorted_motif = sort_motif(motif['counts'], motif['percentages'])
+            counts = motif['counts'][sorted_motif['position'] - 1, sorted_motif['amino_acid_id']]
+            rows = zip(*[sorted_motif[column_name].tolist() for column_name in ['position', 'amino_acid_id', 'grade', 'percentage']], counts.tolist())
+            for position, amino_acid_id, grade, percentage, count in rows:
+                yield (allele_ids[allele_slug], int(peptide_length), position, amino_acid_labels[amino_acid_id], grade, percentage, count)
+
+
+def consensus_sequence(percentages:np.ndarray, amino_acids:List[str], threshold:float=30) -> str:
+    """
+    This function returns the consensus of a motif, the most common amino acid at each position where it is at least highly preferred
+
+    Args:
+        percentages (np.ndarray): The amino acid percentages for the motif with the shape (length, amino acids)
+        amino_acids (List[str]): The amino acids, in the order of the columns of the percentages
+        threshold (float): The percentage above which an amino acid is shown, the same as the threshold for the 'high' grade
+
+    Returns:
+        str: The consensus, with x at positions with no preferred amino acid, e.g. xLxxxxxxV
+    """
+    top_amino_acids = np.argmax(percentages, axis=1)
+    top_percentages = np.take_along_axis(percentages, top_amino_acids[:, None], axis=1)[:, 0]
+    return ''.join(amino_acids[i] if percentage > threshold else 'x' for i, percentage in zip(top_amino_acids, top_percentages))
+
+
+def allele_length_rows(shards:ShardedWarehouse, allele_ids:Dict[str, int], warehouse_folder:str) -> Iterator[Tuple]:
+    """
+    This function returns a row of the allele lengths summary table for each allele and peptide length
+
+    Args:
+        shards (ShardedWarehouse): The sharded warehouse
+        allele_ids (Dict[str, int]): The id for each allele slug
+        warehouse_folder (str): The path to the warehouse folder
+
+    Yields:
+        Tuple: The allele id, peptide length, peptide count, percentage of the allele's peptides and consensus
+    """
+    peptide_length_distributions = read_table(warehouse_folder, 'peptide_length_distributions', ['allele_id', 'peptide_length', 'count', 'percentage'])
+    distribution_alleles = read_dictionary(warehouse_folder, 'peptide_length_distributions', 'allele_id')
+    rows = zip(*[peptide_length_distributions[column_name].tolist() for column_name in ['allele_id', 'peptide_length', 'count', 'percentage']])
+    for allele_id, peptide_length, count, percentage in rows:
+        allele_slug = distribution_alleles[allele_id]
+        consensus = consensus_sequence(shards.shard(allele_slug, str(peptide_length))['percentages'], shards.amino_acids)
+        yield (allele_ids[allele_slug], peptide_length, count, percentage, consensus)
+
+
+def write_motifs_csv(csv_filename:str, allele_slugs:List[str], rows:Iterator[Tuple]) -> Iterator[Tuple]:
+    """
+    This function writes the motif position rows to a CSV file in the flat motifs table format as they are passed on, so the same stream of
+    rows can be loaded into the database
+
+    Args:
+        csv_filename (str): The path to the CSV file
+        allele_slugs (List[str]): The allele slug for each allele id
+        rows (Iterator[Tuple]): The motif position rows
+
+    Yields:
+        Tuple: Each row, once it has been written
+    """
+    with open(csv_filename, 'w', newline='\n') as f:
+        writer = csv.writer(f)
+        writer.writerow(MOTIFS_LABELS)
+        for row in rows:
+            allele_id, peptide_length, position, amino_acid, grade, percentage, count = row
+            writer.writerow([allele_slugs[allele_id], position, amino_acid, grade, percentage, peptide_length])
+            yield row
 
 
 def build_table_representation(**kwargs) -> Dict[str,str]:
+    """
+    This function builds the motifs database for use in datasette, for every allele and peptide length
+
+    The rows are streamed from the warehouse straight into a SQLite database with a normalised schema, indexes for the common lookups, a full text
+    index on the peptide sequences and summary views. The peptides shared between alleles are included once the overlap analysis step has been
+    run. The flat motifs table can also be written as a CSV file at the same time.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        Dict[str,str]: A dictionary containing the action log for this step.
+
+    Keyword Args:
+        config (dict): The configuration dictionary.
+        verbose (bool): Whether to print verbose output.
+        force (bool): Whether to force the step to run ignoring any previous results.
+        output_path (str): The path to the output directory.
+        console (Console): A Rich console object for printing Rich output.
+    """
     config = kwargs['config']
     verbose = kwargs['verbose']
     force = kwargs['force']
@@ -13,43 +297,79 @@ def build_table_representation(**kwargs) -> Dict[str,str]:
     console = kwargs['console']
     function_name = kwargs['function_name']
 
-    input_filename = f"{output_path}/motifs/sorted_amino_acid_distributions.json"
+    warehouse_folder = f"{output_path}/motifs"
     csv_output_filename = f"{output_path}/motifs/motifs.csv"
+    db_output_filename = f"{output_path}/motifs/motifs.db"
 
-    sorted_amino_acid_distributions = read_json(input_filename)
-
-    ## table format ##
-
-    # allele_slug   position    amino_acid  grade       percentage  peptide_length
-    # hla_a_01_01   3           D           very-high   67.933      9
-
-    peptide_length = 9
-
-    table = []
+    shards = ShardedWarehouse(warehouse_folder)
+    allele_slugs = shards.alleles
+    allele_ids = {allele_slug:allele_id for allele_id, allele_slug in enumerate(allele_slugs)}
 
-    labels = ['allele_slug', 'position', 'amino_acid', 'grade', 'percentage', 'peptide_length']
+    # the peptides and the link between peptides and alleles are read from the columnar warehouse
+    # the peptides are stored packed, and are unpacked here as the database holds the sequences
+    peptides = unpack_peptides(read_table(warehouse_folder, 'peptides')['peptide'])
+    allele_peptides = read_table(warehouse_folder, 'allele_peptides', ['allele_id', 'peptide_id'])
+    peptide_alleles = read_dictionary(warehouse_folder, 'allele_peptides', 'allele_id')
+    # map the allele ids of the columnar warehouse to the allele ids in the database
+    database_allele_ids = np.array([allele_ids[allele_slug] for allele_slug in peptide_alleles], dtype=np.int64)
 
-    table.append(labels)
+    allele_rows = (
+        (allele_id, allele_slug, allele_locus(allele_slug).upper(), sum(shards.peptide_count(allele_slug, peptide_length) for peptide_length in shards.lengths(allele_slug)))
+        for allele_id, allele_slug in enumerate(allele_slugs)
+    )
+    peptide_rows = zip(range(len(peptides)), peptides.tolist(), np.char.str_len(peptides).tolist())
+    allele_peptide_rows = zip(database_allele_ids[allele_peptides['allele_id']].tolist(), allele_peptides['peptide_id'].tolist())
 
-    for allele_slug in sorted_amino_acid_distributions:
-        for position in sorted_amino_acid_distributions[allele_slug][str(peptide_length)]:
-            for motif_amino_acid in sorted_amino_acid_distributions[allele_slug]['9'][position]:
-                row = [allele_slug, position, motif_amino_acid['amino_acid'], motif_amino_acid['grade'], motif_amino_acid['percentage'], peptide_length]
-                table.append(row)
+    # the allele overlaps and peptide promiscuity are only loaded if the overlap analysis step has written them from the current incidence
+    # matrix, tables left over from an earlier version of the peptides would refer to alleles and peptide ids which have since changed
+    has_overlaps = overlaps_are_current(warehouse_folder, len(peptides))
+    if os.path.exists(f"{columnar_folder(warehouse_folder)}/allele_overlaps.npz") and not has_overlaps:
+        console.print ('[yellow]The allele overlaps were built from an earlier version of the peptides, they are left out of the database until the overlap analysis step is run again[/yellow]')
+    if has_overlaps:
+        allele_overlaps = read_table(warehouse_folder, 'allele_overlaps')
+        overlap_allele_ids = np.array([allele_ids[allele_slug] for allele_slug in read_dictionary(warehouse_folder, 'allele_overlaps', 'allele_id')], dtype=np.int64)
+        allele_overlap_rows = zip(overlap_allele_ids[allele_overlaps['allele_id']].tolist(), overlap_allele_ids[allele_overlaps['other_allele_id']].tolist(), 
+                                  allele_overlaps['shared_peptides'].tolist(), allele_overlaps['jaccard'].tolist())
+        peptide_promiscuity = read_table(warehouse_folder, 'peptide_promiscuity')
+        peptide_promiscuity_rows = zip(*[peptide_promiscuity[column_name].tolist() for column_name, column_type in PEPTIDE_PROMISCUITY_SCHEMA])
 
-    print (labels)
-    print (len(table))
+    motif_rows = motif_position_rows(shards, allele_ids)
+    # the CSV is an optional side output, written from the same stream of rows as the database
+    if config['CONSTANTS']['WRITE_MOTIFS_CSV']:
+        motif_rows = write_motifs_csv(csv_output_filename, allele_slugs, motif_rows)
 
-    with open(csv_output_filename, 'w', newline='\n') as f:
-        writer = csv.writer(f)
-        writer.writerows(table)
+    tables = [
+        ('alleles', ALLELES_SCHEMA, allele_rows),
+        ('motif_positions', MOTIF_POSITIONS_SCHEMA, motif_rows),
+        ('allele_lengths', ALLELE_LENGTHS_SCHEMA, allele_length_rows(shards, allele_ids, warehouse_folder)),
+        ('peptides', PEPTIDES_SCHEMA, peptide_rows),
+        ('allele_peptides', ALLELE_PEPTIDES_SCHEMA, allele_peptide_rows)
+    ]
+    statements = INDEX_STATEMENTS + fts_statements() + VIEW_STATEMENTS
+    benchmark_queries = dict(BENCHMARK_QUERIES)
+    if has_overlaps:
+        tables.append(('allele_overlaps', ALLELE_OVERLAPS_SCHEMA, allele_overlap_rows))
+        tables.append(('peptide_promiscuity', PEPTIDE_PROMISCUITY_SCHEMA, peptide_promiscuity_rows))
+        statements += OVERLAP_INDEX_STATEMENTS + OVERLAP_VIEW_STATEMENTS
+        benchmark_queries.update(OVERLAP_BENCHMARK_QUERIES)
+    row_counts = build_database(db_output_filename, tables, statements)
 
-    db_output_filename = f"{output_path}/motifs/motifs.db"
+    # time the typical lookups against the finished database
+    benchmarks = time_queries(db_output_filename, benchmark_queries)
 
-    if os.path.exists(db_output_filename):
-        os.remove(db_output_filename)
+    if verbose:
+        for table_name, row_count in row_counts.items():
+            print (f"{row_count} rows loaded into the {table_name} table")
+        for query_name, benchmark in benchmarks.items():
+            print (f"{query_name}: {benchmark['median_ms']}ms, {benchmark['rows']} rows")
 
-    csvs_to_sqllite_command = f"csvs-to-sqlite {csv_output_filename} {db_output_filename}"
+    # create the action log which will be included in the log file for this run of the pipeline
+    action_log = {
+        'alleles_processed':len(allele_slugs),
+        'rows_loaded':row_counts,
+        'csv_written':config['CONSTANTS']['WRITE_MOTIFS_CSV'],
+        'overlaps_loaded':has_overlaps,
+        'query_benchmarks':{query_name:benchmark['median_ms'] for query_name, benchmark in benchmarks.items()}
+    }
 
-    print (csvs_to_sqllite_command)
-    os.system(csvs_to_sqllite_command)
\ No newline at end of file
+    return action_log
@@ -0,0 +1,185 @@
+from typing import Dict, List, Optional, Tuple
+
+from motif_distances import MOTIF_EMBEDDINGS
+
+import pickle
+
+import hdbscan
+import numpy as np
+
+
+class MotifClusterModel():
+    """
+    This class holds the fitted clustering of the motifs of one peptide length, and the cluster assigned to each allele
+
+    The clustering is fitted on all the motifs, and new or changed motifs are then placed into the fitted clusters without refitting. The model is
+    refitted when the motifs have drifted too far from the ones it was fitted on. Cluster labels are carried over from the previous fit where the
+    clusters overlap, so an allele keeps its label across small updates.
+
+    Attributes:
+        metric (str): The name of the motif distance
+        peptide_length (str): The peptide length
+        min_cluster_size (int): The minimum cluster size passed to HDBSCAN
+        clusterer (hdbscan.HDBSCAN): The fitted clusterer
+        label_map (Dict[int, int]): The stable cluster label for each label of the fitted clusterer
+        assignments (Dict[str, Tuple[int, float, float]]): The cluster, membership strength and outlier score of each allele
+        content_hashes (Dict[str, str]): The content hash of the motif each allele was assigned from
+        fitted_count (int): The number of motifs the clusterer was fitted on
+        changes_since_fit (int): The number of motifs added, changed or removed since the clusterer was fitted
+    """
+
+    def __init__(self, metric:str, peptide_length:str, min_cluster_size:int):
+        self.metric = metric
+        self.peptide_length = peptide_length
+        self.min_cluster_size = min_cluster_size
+        self.clusterer = None
+        self.label_map = {}
+        self.assignments = {}
+        self.content_hashes = {}
+        self.fitted_count = 0
+        self.changes_since_fit = 0
+
+
+    @property
+    def can_place(self) -> bool:
+        """
+        Whether new motifs can be placed into the fitted clusters, which needs a clusterer fitted on embedded motifs
+        """
+        return self.clusterer is not None and self.metric in MOTIF_EMBEDDINGS
+
+
+    def drift(self, changes:int) -> float:
+        """
+        This function returns how far the motifs will have drifted from the ones the clusterer was fitted on once some more changes are applied
+
+        Args:
+            changes (int): The number of motifs about to be added, changed or removed
+
+        Returns:
+            float: The motifs added, changed or removed since the fit as a fraction of the motifs the clusterer was fitted on
+        """
+        return (self.changes_since_fit + changes) / max(self.fitted_count, 1)
+
+
+    def fit(self, allele_labels:List[str], content_hashes:List[str], features:np.ndarray, distances:Optional[np.ndarray]=None):
+        """
+        This function fits the clusterer on all the motifs, keeping the labels of the previous clusters which overlap the new ones
+
+        Args:
+            allele_labels (List[str]): The alleles of the motifs
+            content_hashes (List[str]): The content hash of each motif
+            features (np.ndarray): The amino acid frequencies of the motifs with the shape (motifs, length, amino acids)
+            distances (Optional[np.ndarray]): The precomputed distances between the motifs, needed for distances with no embedding
+        """
+        if self.metric in MOTIF_EMBEDDINGS:
+            # prediction data is kept so new motifs can be placed without refitting
+            self.clusterer = hdbscan.HDBSCAN(min_cluster_size=self.min_cluster_size, metric='euclidean', prediction_data=True)
+            cluster_labels = self.clusterer.fit_predict(MOTIF_EMBEDDINGS[self.metric](features))
+        else:
+            # the distances are written as float64, so the memory mapped matrix is passed to HDBSCAN without being copied
+            self.clusterer = hdbscan.HDBSCAN(min_cluster_size=self.min_cluster_size, metric='precomputed')
+            cluster_labels = self.clusterer.fit_predict(distances)
+
+        self.label_map = stable_label_map(cluster_labels, allele_labels, self.assignments)
+        self.assignments = {}
+        self.content_hashes = {}
+        rows = zip(allele_labels, content_hashes, cluster_labels.tolist(), self.clusterer.probabilities_.tolist(), self.clusterer.outlier_scores_.tolist())
+        for allele_slug, content_hash, cluster_label, probability, outlier_score in rows:
+            self.assignments[allele_slug] = (self.label_map.get(cluster_label, -1), probability, outlier_score)
+            self.content_hashes[allele_slug] = content_hash
+        self.fitted_count = len(allele_labels)
+        self.changes_since_fit = 0
+
+
+    def place(self, allele_labels:List[str], content_hashes:List[str], features:np.ndarray):
+        """
+        This function places new or changed motifs into the fitted clusters, without refitting the clusterer
+
+        Args:
+            allele_labels (List[str]): The alleles of the motifs
+            content_hashes (List[str]): The content hash of each motif
+            features (np.ndarray): The amino acid frequencies of the motifs with the shape (motifs, length, amino acids)
+        """
+        embedded = MOTIF_EMBEDDINGS[self.metric](features)
+        cluster_labels, strengths = hdbscan.approximate_predict(self.clusterer, embedded)
+        outlier_scores = hdbscan.approximate_predict_scores(self.clusterer, embedded)
+        rows = zip(allele_labels, content_hashes, cluster_labels.tolist(), strengths.tolist(), outlier_scores.tolist())
+        for allele_slug, content_hash, cluster_label, strength, outlier_score in rows:
+            self.assignments[allele_slug] = (self.label_map.get(cluster_label, -1), strength, outlier_score)
+            self.content_hashes[allele_slug] = content_hash
+        self.changes_since_fit += len(allele_labels)
+
+
+    def remove(self, allele_labels:List[str]):
+        """
+        This function removes the assignments of alleles which no longer have a motif of this length
+
+        Args:
+            allele_labels (List[str]): The alleles to remove
+        """
+        for allele_slug in allele_labels:
+            self.assignments.pop(allele_slug, None)
+            self.content_hashes.pop(allele_slug, None)
+        self.changes_since_fit += len(allele_labels)
+
+
+    def save(self, filepath:str):
+        """
+        This function saves the model, so that a later run of the clustering step can place new motifs into the fitted clusters
+
+        Args:
+            filepath (str): The path to the model file
+        """
+        with open(filepath, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def stable_label_map(cluster_labels:np.ndarray, allele_labels:List[str], previous_assignments:Dict[str, Tuple[int, float, float]]) -> Dict[int, int]:
+    """
+    This function maps the labels of a new clustering onto the labels of the previous one, so clusters keep their labels across refits
+
+    The pairs of new and previous clusters which share the most alleles are matched first, and each previous label is used at most once. New
+    clusters which do not overlap a previous cluster are given labels after the highest previous label.
+
+    Args:
+        cluster_labels (np.ndarray): The labels of the new clustering, -1 for outliers
+        allele_labels (List[str]): The allele of each motif
+        previous_assignments (Dict[str, Tuple[int, float, float]]): The cluster, membership strength and outlier score of each allele before
+
+    Returns:
+        Dict[int, int]: The stable label for each label of the new clustering, outliers are left out
+    """
+    overlaps = {}
+    for allele_slug, cluster_label in zip(allele_labels, cluster_labels.tolist()):
+        previous_label = previous_assignments.get(allele_slug, (-1,))[0]
+        if cluster_label != -1 and previous_label != -1:
+            overlaps[(cluster_label, previous_label)] = overlaps.get((cluster_label, previous_label), 0) + 1
+
+    label_map = {}
+    used_labels = set()
+    # the largest overlaps are matched first, ties are broken by label so the mapping does not depend on dictionary order
+    for (cluster_label, previous_label), overlap in sorted(overlaps.items(), key=lambda item: (-item[1], item[0])):
+        if cluster_label not in label_map and previous_label not in used_labels:
+            label_map[cluster_label] = previous_label
+            used_labels.add(previous_label)
+
+    next_label = max([assignment[0] for assignment in previous_assignments.values()] + [-1]) + 1
+    for cluster_label in sorted(set(cluster_labels.tolist()) - {-1}):
+        if cluster_label not in label_map:
+            label_map[cluster_label] = next_label
+            next_label += 1
+    return label_map
+
+
+def load_cluster_model(filepath:str) -> MotifClusterModel:
+    """
+    This function loads a cluster model saved by a previous run of the clustering step
+
+    Args:
+        filepath (str): The path to the model file
+
+    Returns:
+        MotifClusterModel: The cluster model
+    """
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
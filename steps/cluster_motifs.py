@@ -1,10 +1,40 @@
 from typing import Dict, List
 
+from pipeline import create_folder
+
 from helpers.files import write_json, read_json
 
-import hdbscan
+from warehouse import ShardedWarehouse, write_table
+from motif_distances import MOTIF_EMBEDDINGS, motif_features, cached_distance_matrix
+from cluster_model import MotifClusterModel, load_cluster_model
+
+import os
+
+import numpy as np
 
 def cluster_motifs(**kwargs) -> Dict[str,str]:
+    """
+    This function clusters similar motifs for each peptide length in CLUSTER_PEPTIDE_LENGTHS
+
+    The fitted clustering for each peptide length is saved in the warehouse. On later runs only the motifs which are new or have changed are 
+    placed into the fitted clusters with their membership strengths, and the clustering is only refitted when forced or when the changes since
+    the last fit pass CLUSTER_REFIT_DRIFT. Distances with no euclidean embedding (e.g. jensen_shannon) are clustered on a cached pairwise 
+    distance matrix and are refitted every time the motifs change. The cluster of each motif is written to the motif_clusters table in the
+    columnar warehouse. A peptide length with too few motifs to cluster is skipped, and any model saved for it before is removed.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        Dict[str,str]: A dictionary containing the action log for this step.
+
+    Keyword Args:
+        config (dict): The configuration dictionary.
+        verbose (bool): Whether to print verbose output.
+        force (bool): Whether to force the step to run ignoring any previous results.
+        output_path (str): The path to the output directory.
+        console (Console): A Rich console object for printing Rich output.
+    """
     config = kwargs['config']
     verbose = kwargs['verbose']
     force = kwargs['force']
@@ -12,85 +42,105 @@ def cluster_motifs(**kwargs) -> Dict[str,str]:
     console = kwargs['console']
     function_name = kwargs['function_name']
 
-    # we take the sorted amino acid distributions as input
-    input_filename = f"{output_path}/motifs/sorted_amino_acid_distributions.json"
-
-    sorted_amino_acid_distributions = read_json(input_filename)
-    
-    # load the list of amino acids from the constants
-    amino_acid_list = config['CONSTANTS']['AMINO_ACIDS']
-
-    # initialise the position_amino_acid_labels list
-    position_amino_acid_labels = []
-
-    # and populate it with the composite labels for the position and amino acid
-    for position in range(1,10):
-        for amino_acid in amino_acid_list:
-            position_amino_acid_labels.append(f"{position}_{amino_acid}")
-    
-    # initialise the allele_labels list
-    allele_labels = []
-
-    # initialise the flattened_motifs list
-    flattened_motifs = []
-
-    # loop through the alleles
-    for allele_slug in sorted_amino_acid_distributions:
-        # add the allele to the allele_labels list
-        allele_labels.append(allele_slug)
-        # initialise the flattened_motif list for this allele
-        flattened_motif = []
-
-        # loop through the positions in the nonamer motif
-        for position in sorted_amino_acid_distributions[allele_slug]['9']:
-            # initialise the position_amino_acids dictionary, we set the percentage for each amino acid to 0 as a default
-            position_amino_acids = {amino_acid:0 for amino_acid in amino_acid_list}
-            # loop through the amino acids at this position and add the percentages to the position_amino_acids dictionary
-            for motif_amino_acid in sorted_amino_acid_distributions[allele_slug]['9'][position]:
-                position_amino_acids[motif_amino_acid['amino_acid']] = motif_amino_acid['percentage'] 
-            # add the amino acid percentages to the flattened motif
-            for position_amino_acid in position_amino_acids:
-                flattened_motif.append(position_amino_acids[position_amino_acid])
-        # add the flattened motif to the flattened_motifs list
-        flattened_motifs.append(flattened_motif)
-
-
-    # cluster the motifs using HDBSCAN
-    # we set the minimum cluster size to 2 as we want the maximum number of precise clusters
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=2)
-
-    # generate the cluster labels for the motifs
-    cluster_labels = clusterer.fit_predict(flattened_motifs)
-
-    # create a dictionary to store the clusters
-    clusters = {}
-
-    # loop through the alleles and add them to the appropriate cluster
-    for i in range(len(allele_labels)):
-        # if the cluster label is -1 then the motif is an outlier
-        if cluster_labels[i] == -1:
-            cluster_label = 'outliers'
+    constants = config['CONSTANTS']
+    metric = constants['CLUSTER_DISTANCE_METRIC']
+    min_cluster_size = constants['CLUSTER_MIN_CLUSTER_SIZE']
+    refit_drift = constants['CLUSTER_REFIT_DRIFT']
+
+    # the motifs are read from the warehouse shards, only the shards which are new or changed since the last run are loaded
+    warehouse_folder = f"{output_path}/motifs"
+    models_folder = f"{warehouse_folder}/clusters"
+    create_folder(models_folder, verbose)
+    shards = ShardedWarehouse(warehouse_folder)
+    allele_ids = {allele_slug:allele_id for allele_id, allele_slug in enumerate(shards.alleles)}
+
+    # the columns of the motif_clusters table, a cluster of -1 means the motif is an outlier
+    cluster_columns = {'allele_id':[], 'peptide_length':[], 'cluster':[], 'probability':[], 'outlier_score':[]}
+    cluster_modes = {}
+    motifs_updated = 0
+    clusters_found = 0
+    outlier_count = 0
+
+    for peptide_length in [str(peptide_length) for peptide_length in constants['CLUSTER_PEPTIDE_LENGTHS']]:
+        model_filepath = f"{models_folder}/model_{peptide_length}.pkl"
+        model = load_cluster_model(model_filepath) if os.path.exists(model_filepath) else None
+        # a model fitted with a different distance or minimum cluster size is refitted, but its assignments are kept to carry the labels over
+        if model is None or model.metric != metric or model.min_cluster_size != min_cluster_size:
+            previous_assignments = model.assignments if model else {}
+            model = MotifClusterModel(metric, peptide_length, min_cluster_size)
+            model.assignments = previous_assignments
+
+        # the content hashes of the motifs are read from the warehouse manifest, so finding the changed motifs does not load any shards
+        content_hashes = {allele_slug:shards.content_hash(allele_slug, peptide_length) for allele_slug in shards.alleles if shards.has_shard(allele_slug, peptide_length)}
+        changed_alleles = [allele_slug for allele_slug, content_hash in content_hashes.items() if model.content_hashes.get(allele_slug) != content_hash]
+        removed_alleles = [allele_slug for allele_slug in model.content_hashes if allele_slug not in content_hashes]
+
+        changes = len(changed_alleles) + len(removed_alleles)
+        # HDBSCAN needs at least as many motifs as the minimum cluster size. With too few motifs the length is not clustered, the saved model is
+        # removed so it is not updated from on the next run and the length has no rows in the motif_clusters table
+        if len(content_hashes) < max(min_cluster_size, 2):
+            if os.path.exists(model_filepath):
+                os.remove(model_filepath)
+            cluster_modes[peptide_length] = 'skipped'
+            continue
+        if not force and model.clusterer is not None and changes == 0:
+            cluster_modes[peptide_length] = 'unchanged'
+        elif force or not model.can_place or model.drift(changes) > refit_drift:
+            # the features are the frequency of each amino acid at each position of the motif
+            allele_labels, features = motif_features(shards, peptide_length)
+            distances = None
+            if metric not in MOTIF_EMBEDDINGS:
+                distances = cached_distance_matrix(warehouse_folder, metric, peptide_length, allele_labels, features, verbose)[0]
+            model.fit(allele_labels, [content_hashes[allele_slug] for allele_slug in allele_labels], features, distances)
+            cluster_modes[peptide_length] = 'refit'
+            motifs_updated += len(allele_labels)
         else:
-            cluster_label = f"cluster_{cluster_labels[i] + 1}"
-        # if the cluster label is not already in the clusters dictionary then add it
-        if cluster_label not in clusters:
-            clusters[cluster_label] = []
-        # add the allele to the appropriate cluster
-        clusters[cluster_label].append(allele_labels[i])
-    
-    # generate an ordered list of the clusters
-    ordered_clusters = sorted(clusters.keys())
-    # iterate through the ordered clusters and print the alleles in each cluster
-    for cluster in ordered_clusters:
-        print (f"Cluster {cluster}: {clusters[cluster]}")   
-
+            # new and changed motifs are placed into the fitted clusters, so the cost depends on the number of changes not the number of alleles
+            model.remove(removed_alleles)
+            if changed_alleles:
+                allele_labels, features = motif_features(shards, peptide_length, changed_alleles)
+                model.place(allele_labels, [content_hashes[allele_slug] for allele_slug in allele_labels], features)
+            cluster_modes[peptide_length] = 'placed'
+            motifs_updated += changes
+        model.save(model_filepath)
+
+        # the assignments are written in warehouse order
+        assignments = [(allele_slug, model.assignments[allele_slug]) for allele_slug in content_hashes]
+        for allele_slug, (cluster_label, probability, outlier_score) in assignments:
+            cluster_columns['allele_id'].append(allele_ids[allele_slug])
+            cluster_columns['peptide_length'].append(int(peptide_length))
+            cluster_columns['cluster'].append(cluster_label)
+            cluster_columns['probability'].append(probability)
+            cluster_columns['outlier_score'].append(outlier_score)
+
+        cluster_labels = np.array([assignment[0] for allele_slug, assignment in assignments], dtype=np.int32)
+        clusters_found += len(set(cluster_labels.tolist()) - {-1})
+        outlier_count += int(np.sum(cluster_labels == -1))
+
+        if verbose:
+            # print the alleles in each cluster, with the outliers last
+            for cluster_label in sorted(set(cluster_labels.tolist()), key=lambda cluster_label: (cluster_label == -1, cluster_label)):
+                cluster_name = 'outliers' if cluster_label == -1 else f"cluster_{cluster_label + 1}"
+                print (f"{peptide_length}mer {cluster_name}: {[assignments[i][0] for i in np.flatnonzero(cluster_labels == cluster_label)]}")
+
+    columns = {
+        'allele_id':np.array(cluster_columns['allele_id'], dtype=np.int32),
+        'peptide_length':np.array(cluster_columns['peptide_length'], dtype=np.int16),
+        'cluster':np.array(cluster_columns['cluster'], dtype=np.int32),
+        'probability':np.array(cluster_columns['probability'], dtype=np.float64),
+        'outlier_score':np.array(cluster_columns['outlier_score'], dtype=np.float64)
+    }
+    write_table(warehouse_folder, 'motif_clusters', columns, {'allele_id':shards.alleles}, verbose)
 
     # create the action log which will be included in the log file for this run of the pipeline
     action_log = {
-        'alleles_processed':len(flattened_motifs),
-        'motifs_processed':len(flattened_motifs),
-        'clusters_found':len(ordered_clusters) - 1,
-        'outlier_count':len(clusters['outliers'])
+        'alleles_processed':len(set(columns['allele_id'].tolist())),
+        'motifs_processed':len(columns['cluster']),
+        'motifs_updated':motifs_updated,
+        'distance_metric':metric,
+        'cluster_modes':cluster_modes,
+        'clusters_found':clusters_found,
+        'outlier_count':outlier_count
     }
-    
-    return action_log
\ No newline at end of file
+
+    return action_log
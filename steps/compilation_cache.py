@@ -0,0 +1,185 @@
+from typing import Dict, Optional, Set
+
+import json
+import os
+
+import numpy as np
+
+from helpers.files import write_json, read_json
+
+from motif_accumulator import MotifAccumulator
+from packed_peptides import pack_peptide
+
+
+# The data compilations are JSON files with an entry for each allele, or for each peptide, which would otherwise be built and encoded again in
+# full whenever a single peptide changes. The JSON text of each allele's entry, and of each block of entries of peptides.json, is kept between
+# runs of the processing step, so a run which changes a few alleles only encodes their entries and the blocks of peptides they touch again, and
+# the rest of each file is joined together from the saved text. The files are the same as if they had been encoded in full.
+
+# the version of the format the cache is saved in, a cache saved in any other format is not loaded and every entry is encoded again
+CACHE_VERSION = 1
+
+# the number of peptides.json entries in each block, peptides.json is in insertion order so new peptides only touch the last block
+PEPTIDE_BLOCK_SIZE = 4096
+
+
+def encode_entries(entries:Dict) -> str:
+    """
+    This function encodes the entries of a dictionary as JSON text, without the surrounding braces
+
+    Args:
+        entries (Dict): The entries
+
+    Returns:
+        str: The JSON text of the entries, separated as json.dumps separates them
+    """
+    return json.dumps(entries)[1:-1]
+
+
+class CompilationCache():
+    """
+    This class holds the JSON text of the entries of the data compilations, so only the changed entries are encoded again by the processing step
+
+    Attributes:
+        source (Optional[str]): The content hash of the atlas file the cached text was built from
+        allele_entries (Dict[str, Dict[str, str]]): The JSON text of each allele's entry, keyed by compilation name and then allele number, in
+            the order they are written
+        peptide_blocks (List[Tuple[Tuple[int, int, int], str]]): The first and last packed peptide and number of peptides of each block of
+            peptides.json, with the JSON text of its entries
+    """
+
+    def __init__(self):
+        self.source = None
+        self.allele_entries = {}
+        self.peptide_blocks = []
+
+
+    def update(self, accumulator:MotifAccumulator, changed_alleles:Optional[Set[str]]=None, changed_peptides:Optional[Set[str]]=None) -> Dict[str, int]:
+        """
+        This function encodes the entries of the alleles and blocks of peptides which have changed, and drops those which are gone
+
+        Args:
+            accumulator (MotifAccumulator): The accumulator the compilations are built from
+            changed_alleles (Optional[Set[str]]): The alleles which had a peptide added or removed, or None to encode every entry
+            changed_peptides (Optional[Set[str]]): The peptides which had an allele added or removed, or None to encode every entry
+
+        Returns:
+            Dict[str, int]: The number of allele entries and peptide blocks which were encoded
+        """
+        if changed_alleles is None or changed_peptides is None:
+            changed_alleles = changed_peptides = None
+            self.allele_entries = {}
+            self.peptide_blocks = []
+
+        # the entries of alleles which have changed, or are missing from the cache, are built for just those alleles
+        allele_keys = accumulator.allele_compilation_keys()
+        stale_alleles = None
+        if changed_alleles is not None:
+            stale_alleles = set(changed_alleles)
+            for compilation, allele_numbers in allele_keys.items():
+                cached = self.allele_entries.get(compilation, {})
+                stale_alleles.update(allele_number for allele_number in allele_numbers if allele_number not in cached)
+        compilations = accumulator.allele_compilations(stale_alleles)
+        for compilation, allele_numbers in allele_keys.items():
+            cached = self.allele_entries.get(compilation, {})
+            entries = compilations[compilation]
+            self.allele_entries[compilation] = {
+                allele_number:encode_entries({allele_number:entries[allele_number]}) if allele_number in entries else cached[allele_number] for allele_number in allele_numbers
+            }
+
+        # a cached block is kept if it still starts and ends with the same peptides and none of its peptides have changed. A removed peptide
+        # moves every later peptide back, so the blocks after it no longer line up and are encoded again
+        peptide_store = accumulator.peptide_store
+        changed_codes = None if changed_peptides is None else {pack_peptide(peptide) for peptide in changed_peptides}
+        peptides = list(peptide_store.peptides)
+        peptide_blocks = []
+        blocks_encoded = 0
+        for block_number, start in enumerate(range(0, len(peptides), PEPTIDE_BLOCK_SIZE)):
+            block = peptides[start:start + PEPTIDE_BLOCK_SIZE]
+            bounds = (block[0], block[-1], len(block))
+            cached = self.peptide_blocks[block_number] if changed_codes is not None and block_number < len(self.peptide_blocks) else None
+            if cached is not None and cached[0] == bounds and changed_codes.isdisjoint(block):
+                peptide_blocks.append(cached)
+            else:
+                peptide_blocks.append((bounds, encode_entries(peptide_store.peptides_to_dict(block))))
+                blocks_encoded += 1
+        self.peptide_blocks = peptide_blocks
+
+        return {
+            'allele_entries_encoded':len(compilations['alleles']),
+            'peptide_blocks_encoded':blocks_encoded
+        }
+
+
+    def write(self, filepath:str, compilation:str):
+        """
+        This function writes a data compilation from the cached JSON text of its entries
+
+        Args:
+            filepath (str): The path to the JSON file
+            compilation (str): The name of the compilation
+        """
+        fragments = [text for bounds, text in self.peptide_blocks] if compilation == 'peptides' else self.allele_entries[compilation].values()
+        with open(filepath, 'w') as f:
+            f.write('{')
+            for i, fragment in enumerate(fragments):
+                if i:
+                    f.write(', ')
+                f.write(fragment)
+            f.write('}')
+
+
+    def save(self, filepath:str, source:str):
+        """
+        This function saves the cached JSON text, for the next run of the processing step
+
+        The text of the entries is saved as a single array of UTF-8 bytes, with the offset of each entry, in an uncompressed .npz file. A .json
+        sidecar holds the version of the format, the source, the allele numbers of the entries and the bounds of the blocks of peptides
+
+        Args:
+            filepath (str): The path to the cache files, without an extension
+            source (str): The content hash of the atlas file the compilations were built from
+        """
+        self.source = source
+        fragments = [text for entries in self.allele_entries.values() for text in entries.values()] + [text for bounds, text in self.peptide_blocks]
+        encoded = [fragment.encode('utf-8') for fragment in fragments]
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))])
+        np.savez(f"{filepath}.npz", text=np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets=offsets)
+        metadata = {
+            'version':CACHE_VERSION,
+            'source':source,
+            'allele_entries':{compilation:list(entries) for compilation, entries in self.allele_entries.items()},
+            'peptide_blocks':[list(bounds) for bounds, text in self.peptide_blocks]
+        }
+        write_json(f"{filepath}.json", metadata, pretty=True)
+
+
+def load_compilation_cache(filepath:str, source:Optional[str]) -> CompilationCache:
+    """
+    This function loads the cached JSON text saved by a previous run of the processing step
+
+    Args:
+        filepath (str): The path to the cache files, without an extension
+        source (Optional[str]): The content hash of the atlas file the saved state was built from
+
+    Returns:
+        CompilationCache: The saved cache if it was saved in the current format from the same atlas file as the saved state, otherwise an 
+        empty cache
+    """
+    cache = CompilationCache()
+    if source is None or not (os.path.exists(f"{filepath}.npz") and os.path.exists(f"{filepath}.json")):
+        return cache
+    metadata = read_json(f"{filepath}.json")
+    if metadata.get('version') != CACHE_VERSION or metadata['source'] != source:
+        return cache
+
+    with np.load(f"{filepath}.npz", allow_pickle=False) as arrays:
+        text = arrays['text'].tobytes()
+        offsets = arrays['offsets'].tolist()
+    # the entries are in the order they were saved in, the allele entries of each compilation and then the blocks of peptides
+    fragments = iter([text[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])])
+    for compilation, allele_numbers in metadata['allele_entries'].items():
+        cache.allele_entries[compilation] = {allele_number:next(fragments) for allele_number in allele_numbers}
+    cache.peptide_blocks = [(tuple(bounds), next(fragments)) for bounds in metadata['peptide_blocks']]
+    cache.source = source
+    return cache
@@ -0,0 +1,295 @@
+from typing import Dict, List, Optional, Tuple
+
+from helpers.files import write_json, read_json
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Downloads are cached next to the file they write. A sidecar file holds the ETag and Last-Modified headers of the cached copy, so the next
+# download can ask the server for the file only if it has changed. The body is streamed to a .part file, which is renamed over the cached copy
+# once it is complete, so an interrupted download never leaves a truncated file in place and can be resumed with a Range request.
+
+
+def metadata_path(filepath:str) -> str:
+    """
+    This function returns the path of the sidecar file holding the HTTP metadata for a downloaded file
+
+    Args:
+        filepath (str): The path to the downloaded file
+
+    Returns:
+        str: The path to the sidecar file
+    """
+    return f"{filepath}.http.json"
+
+
+def partial_path(filepath:str) -> str:
+    """
+    This function returns the path of the partial file a download is streamed to before it is complete
+
+    Args:
+        filepath (str): The path to the downloaded file
+
+    Returns:
+        str: The path to the partial file
+    """
+    return f"{filepath}.part"
+
+
+def read_metadata(filepath:str) -> Optional[Dict]:
+    """
+    This function reads the HTTP metadata recorded for a downloaded or partially downloaded file
+
+    Args:
+        filepath (str): The path to the file
+
+    Returns:
+        Optional[Dict]: The url, ETag and Last-Modified of the file, or None if there is no metadata or no file
+    """
+    if os.path.exists(filepath) and os.path.exists(metadata_path(filepath)):
+        return read_json(metadata_path(filepath))
+    return None
+
+
+def discard_partial(filepath:str) -> None:
+    """
+    This function removes the partial file of a download and its sidecar file, so the next download starts from the beginning
+
+    Args:
+        filepath (str): The path to the downloaded file
+    """
+    for path in [partial_path(filepath), metadata_path(partial_path(filepath))]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def complete_download(filepath:str) -> None:
+    """
+    This function moves a complete partial file and its sidecar file over the cached copy
+
+    Args:
+        filepath (str): The path to the downloaded file
+    """
+    part_filepath = partial_path(filepath)
+    os.replace(part_filepath, filepath)
+    os.replace(metadata_path(part_filepath), metadata_path(filepath))
+
+
+def content_range_length(content_range:Optional[str]) -> Optional[int]:
+    """
+    This function returns the full length of a file from the Content-Range header of a response, e.g. 1234 for "bytes */1234"
+
+    Args:
+        content_range (Optional[str]): The Content-Range header
+
+    Returns:
+        Optional[int]: The length of the file, or None if the header is missing or the length is not known
+    """
+    length = (content_range or '').rpartition('/')[2].strip()
+    return int(length) if length.isdigit() else None
+
+
+def response_metadata(url:str, response:requests.Response) -> Dict:
+    """
+    This function returns the metadata to record for a response, which is used to validate the cached copy on the next download
+
+    Args:
+        url (str): The url of the file
+        response (requests.Response): The response
+
+    Returns:
+        Dict: The url, ETag and Last-Modified of the response
+    """
+    return {
+        'url':url,
+        'etag':response.headers.get('ETag'),
+        'last_modified':response.headers.get('Last-Modified')
+    }
+
+
+def download_file(url:str, filepath:str, session:Optional[requests.Session]=None, force:bool=False, chunk_size:int=64 * 1024, timeout:float=60) -> Dict:
+    """
+    This function downloads a file if it has changed since the cached copy was downloaded, streaming it to disk and resuming a partial download
+
+    Args:
+        url (str): The url of the file
+        filepath (str): The path to write the file to
+        session (Optional[requests.Session]): The session to make the request with, so connections can be reused across downloads
+        force (bool): Whether to download the file even if the cached copy is current
+        chunk_size (int): The number of bytes to write to disk at a time
+        timeout (float): The number of seconds to wait for the server to connect or send data
+
+    Returns:
+        Dict: The status code, whether the cached copy was used, the bytes transferred, the throughput and the length and path of the file
+    """
+    session = session or requests.Session()
+    part_filepath = partial_path(filepath)
+
+    headers = {}
+    # ask for the file only if it has changed since the cached copy was downloaded
+    cached = read_metadata(filepath)
+    if cached and cached['url'] == url and not force:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    # resume a partial download of the same version of the file, the If-Range header makes the server send the whole file if it has changed.
+    # Range offsets refer to the bytes as sent, so resumed transfers are requested without compression. A sidecar file left without its
+    # partial file can not be resumed, so it is removed
+    partial = read_metadata(part_filepath)
+    if partial is None:
+        discard_partial(filepath)
+    resume_from = 0
+    if partial and os.path.exists(part_filepath) and partial['url'] == url and (partial['etag'] or partial['last_modified']):
+        resume_from = os.path.getsize(part_filepath)
+    if resume_from:
+        headers['Range'] = f"bytes={resume_from}-"
+        headers['If-Range'] = partial['etag'] or partial['last_modified']
+        headers['Accept-Encoding'] = 'identity'
+
+    download_log = {
+        'url':url,
+        'http_status_code':None,
+        'cache_hit':False,
+        'resumed_from':0,
+        'bytes_transferred':0,
+        'seconds':0.0,
+        'throughput_mb_per_second':None,
+        'file_length':os.path.getsize(filepath) if os.path.exists(filepath) else None,
+        'file_path':filepath,
+        'error':None
+    }
+
+    start_time = time.perf_counter()
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        download_log['http_status_code'] = r.status_code
+
+        if r.status_code == 304:
+            download_log['cache_hit'] = True
+            download_log['seconds'] = round(time.perf_counter() - start_time, 3)
+            return download_log
+        if r.status_code >= 500:
+            download_log['error'] = 'server_error'
+            return download_log
+        if r.status_code == 416 and resume_from:
+            # the range starts at the end of the file, which happens when the partial file was complete but was not renamed into place. If the
+            # partial file is as long as the file it is finished now, otherwise it is no use and the whole file is fetched again
+            if content_range_length(r.headers.get('Content-Range')) == resume_from:
+                complete_download(filepath)
+                download_log['resumed_from'] = resume_from
+                download_log['seconds'] = round(time.perf_counter() - start_time, 3)
+                download_log['file_length'] = os.path.getsize(filepath)
+                return download_log
+            discard_partial(filepath)
+            r.close()
+            return download_file(url, filepath, session=session, force=force, chunk_size=chunk_size, timeout=timeout)
+        if r.status_code not in [200, 206]:
+            download_log['error'] = 'file_not_found'
+            return download_log
+
+        # a 206 continues the partial file, a 200 is the whole file so the partial file and its sidecar are started again
+        if r.status_code == 206:
+            download_log['resumed_from'] = resume_from
+        else:
+            discard_partial(filepath)
+        mode = 'ab' if r.status_code == 206 else 'wb'
+
+        try:
+            with open(part_filepath, mode) as f:
+                # iter_content decompresses gzip or deflate encoded responses as they are streamed
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+        finally:
+            # the raw response counts the bytes received over the wire, before decompression
+            download_log['bytes_transferred'] = r.raw.tell()
+            # the sidecar is only written once the body received so far is in the partial file, so an interrupted download can be resumed but
+            # a sidecar never describes bytes which are not there
+            write_json(metadata_path(part_filepath), response_metadata(url, r), pretty=True)
+
+    # the download is complete, so the partial file replaces the cached copy in one step
+    complete_download(filepath)
+
+    seconds = time.perf_counter() - start_time
+    download_log['seconds'] = round(seconds, 3)
+    download_log['throughput_mb_per_second'] = round(download_log['bytes_transferred'] / seconds / 1024 / 1024, 3) if seconds > 0 else None
+    download_log['file_length'] = os.path.getsize(filepath)
+    return download_log
+
+
+def pooled_session(max_connections:int) -> requests.Session:
+    """
+    This function returns a session which keeps open connections to each host for reuse, sized for the number of concurrent downloads
+
+    Args:
+        max_connections (int): The number of connections to keep open to each host
+
+    Returns:
+        requests.Session: The session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_with_retries(url:str, filepath:str, session:requests.Session, force:bool=False, retries:int=3, backoff:float=1.0, timeout:float=60) -> Dict:
+    """
+    This function downloads a file, retrying with an exponential backoff if the connection fails or the server returns an error
+
+    A retry after an interrupted transfer resumes from the partial file, so only the missing bytes are fetched again
+
+    Args:
+        url (str): The url of the file
+        filepath (str): The path to write the file to
+        session (requests.Session): The session to make the requests with
+        force (bool): Whether to download the file even if the cached copy is current
+        retries (int): The number of times to retry a failed download
+        backoff (float): The number of seconds to wait before the first retry, doubled for each retry after that
+        timeout (float): The number of seconds to wait for the server to connect or send data
+
+    Returns:
+        Dict: The download log of the last attempt, with the number of attempts and the total time taken
+    """
+    start_time = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            download_log = download_file(url, filepath, session=session, force=force, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            download_log = {'url':url, 'file_path':filepath, 'error':'download_interrupted', 'exception':str(e)}
+        # only connection failures and server errors are worth retrying, a missing file will still be missing
+        if download_log['error'] not in ['download_interrupted', 'server_error']:
+            break
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    download_log['attempts'] = attempt + 1
+    download_log['total_seconds'] = round(time.perf_counter() - start_time, 3)
+    return download_log
+
+
+def download_files(downloads:List[Tuple[str, str, str]], force:bool=False, max_workers:int=4, retries:int=3, backoff:float=1.0, timeout:float=60) -> Dict[str, Dict]:
+    """
+    This function downloads a set of files at the same time, over a shared pool of connections
+
+    Args:
+        downloads (List[Tuple[str, str, str]]): The name, url and file path of each download
+        force (bool): Whether to download the files even if the cached copies are current
+        max_workers (int): The maximum number of files to download at the same time
+        retries (int): The number of times to retry each failed download
+        backoff (float): The number of seconds to wait before the first retry of a download, doubled for each retry after that
+        timeout (float): The number of seconds to wait for a server to connect or send data
+
+    Returns:
+        Dict[str, Dict]: The download log for each file, keyed by name
+    """
+    max_workers = max(1, min(max_workers, len(downloads)))
+    with pooled_session(max_workers) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {name:executor.submit(download_with_retries, url, filepath, session, force, retries, backoff, timeout) for name, url, filepath in downloads}
+            return {name:future.result() for name, future in futures.items()}
@@ -0,0 +1,136 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+
+# Peptides of every length are projected onto a common binding core of 9 positions, so the motif of an allele can be built from all its
+# peptides rather than just the nonamers. The anchor residues at the N-terminal end (P1 to P3, including the P2 anchor) and the C-terminal end
+# (the last two residues, including the PΩ anchor) always keep their place in the core. A longer peptide bulges out of the groove in the
+# middle, so a contiguous stretch of residues between the anchors is left out of the core. A shorter peptide leaves a gap in the middle of the
+# core instead. Each place the bulge or gap could be is a frame, and each peptide is placed in the frame which scores best against the
+# nonamer motif of its allele.
+
+# the number of positions in the core
+CORE_LENGTH = 9
+
+
+def core_frames(peptide_length:int, core_length:int=CORE_LENGTH, n_terminal:int=3, c_terminal:int=2) -> np.ndarray:
+    """
+    This function returns every way of placing a peptide of a given length onto the core
+
+    Args:
+        peptide_length (int): The peptide length
+        core_length (int): The number of positions in the core
+        n_terminal (int): The number of residues at the N-terminal end which always keep their place
+        c_terminal (int): The number of residues at the C-terminal end which always keep their place
+
+    Returns:
+        np.ndarray: The position in the peptide of the residue at each core position for each frame, with the shape (frames, core length), -1 for
+        a gap. Peptides too short to keep both ends have no frames.
+    """
+    frames = []
+    if peptide_length >= core_length:
+        # the residues left out of the core start after the N-terminal residues, and end before the C-terminal residues
+        bulge = peptide_length - core_length
+        for start in range(n_terminal, core_length - c_terminal + 1 if bulge else n_terminal + 1):
+            frames.append(list(range(start)) + list(range(start + bulge, peptide_length)))
+    else:
+        gap = core_length - peptide_length
+        for start in range(n_terminal, peptide_length - c_terminal + 1):
+            frames.append(list(range(start)) + [-1] * gap + list(range(start, peptide_length)))
+    return np.array(frames, dtype=np.int64).reshape(len(frames), core_length)
+
+
+def indel_positions(frames:np.ndarray) -> np.ndarray:
+    """
+    This function returns where the core and the peptide part ways in each frame
+
+    Args:
+        frames (np.ndarray): The frames from core_frames with the shape (frames, core length)
+
+    Returns:
+        np.ndarray: The first core position with a gap for a shorter peptide, or the first peptide position left out of the core for a longer
+        peptide, numbered from 1, or 0 where the peptide fills the core as it is
+    """
+    mismatched = frames != np.arange(frames.shape[1])
+    return np.where(mismatched.any(axis=1), mismatched.argmax(axis=1) + 1, 0)
+
+
+def project_to_core(encoded:np.ndarray, frames:np.ndarray, scoring_matrix:np.ndarray, batch_size:int=65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function places each of a set of encoded peptides of the same length in its best scoring frame on the core
+
+    Every frame of every peptide in a batch is scored at once by gathering the residues of each frame and looking up their scores, gaps and
+    residues which are not amino acids score 0. Where frames score the same, the first is used.
+
+    Args:
+        encoded (np.ndarray): The amino acid ids of the peptides with the shape (peptides, length), -1 for characters which are not amino acids
+        frames (np.ndarray): The frames from core_frames with the shape (frames, core length)
+        scoring_matrix (np.ndarray): The log-odds scoring matrix of the core with the shape (core length, amino acids)
+        batch_size (int): The number of peptides scored at once, which bounds the memory used
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The amino acid id at each core position with the shape (peptides, core length), -1 for gaps and residues
+        which are not amino acids, and the frame used for each peptide
+    """
+    core_length = frames.shape[1]
+    positions = np.arange(core_length)
+    core = np.empty((len(encoded), core_length), dtype=np.int64)
+    chosen = np.empty(len(encoded), dtype=np.int64)
+    for start in range(0, len(encoded), batch_size):
+        batch = encoded[start:start + batch_size].astype(np.int64)
+        # the residues of every frame, with the shape (peptides, frames, core length)
+        gathered = np.where(frames >= 0, batch[:, np.maximum(frames, 0)], -1)
+        scores = np.where(gathered >= 0, scoring_matrix[positions, gathered], 0).sum(axis=2)
+        best = np.argmax(scores, axis=1)
+        core[start:start + len(batch)] = gathered[np.arange(len(batch)), best]
+        chosen[start:start + len(batch)] = best
+    return core, chosen
+
+
+def core_counts(core:np.ndarray, amino_acid_count:int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function counts the amino acids at each position of a set of projected peptides
+
+    Args:
+        core (np.ndarray): The amino acid id at each core position with the shape (peptides, core length), -1 for gaps
+        amino_acid_count (int): The number of amino acids
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The count of each amino acid at each position with the shape (core length, amino acids), and the number of
+        gaps at each position
+    """
+    core_length = core.shape[1]
+    filled = core >= 0
+    # each residue is counted in one bincount, by its position and amino acid
+    flat = (np.arange(core_length) * amino_acid_count + core)[filled]
+    counts = np.bincount(flat, minlength=core_length * amino_acid_count).reshape(core_length, amino_acid_count)
+    return counts.astype(np.int64), (~filled).sum(axis=0).astype(np.int64)
+
+
+def core_matrices(counts:np.ndarray, pseudocount:float=1.0) -> Dict[str, np.ndarray]:
+    """
+    This function turns the core counts into the percentages, probabilities and information content used for the motifs of each peptide length
+
+    The transformations are the same as those of the amino acid counts of each peptide length, the percentages are of the peptides with a
+    residue at the position, so gaps are left out
+
+    Args:
+        counts (np.ndarray): The core counts with the shape (alleles, core length, amino acids)
+        pseudocount (float): The pseudocount added to the count of each amino acid at each position for the probabilities
+
+    Returns:
+        Dict[str, np.ndarray]: The percentages, probabilities and information matrices, each the same shape as the counts
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentages = counts / counts.sum(axis=2, keepdims=True) * 100
+    probabilities = (counts + pseudocount) / (counts + pseudocount).sum(axis=2, keepdims=True)
+    # the smallest positive float is added before taking logs, as logomaker does, so a zero probability does not give an error
+    small = np.finfo(float).tiny
+    background = 1 / counts.shape[2]
+    relative_entropy = (probabilities * (np.log2(probabilities + small) - np.log2(background + small))).sum(axis=2, keepdims=True)
+    return {
+        'percentages':percentages,
+        'probabilities':probabilities,
+        'information':probabilities * relative_entropy
+    }
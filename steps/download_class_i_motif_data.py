@@ -1,11 +1,16 @@
 from typing import Dict
-import requests
 
-from helpers.files import write_file
+from conditional_download import download_files
+
+import time
 
 def download_class_i_motif_data(**kwargs) -> Dict[str,str]:
     """
-    This function downloads the class I motif data from the MHC Motif Atlas
+    This function downloads the class I motif data from the MHC Motif Atlas, and any other data sources listed in DOWNLOAD_SOURCES
+
+    Each source in DOWNLOAD_SOURCES is the name of the constant holding its url, and its filename is held in the constant of the same name with
+    _FILENAME added. The sources are downloaded at the same time over a shared pool of connections. Each file is only downloaded if it has 
+    changed since the local copy was downloaded, and an interrupted download is resumed.
 
     Args:
         **kwargs: Arbitrary keyword arguments.
@@ -27,24 +32,35 @@ def download_class_i_motif_data(**kwargs) -> Dict[str,str]:
     console = kwargs['console']
     function_name = kwargs['function_name']
 
-    url = config['CONSTANTS']['MHC_MOTIF_ATLAS_CLASS_I']
-
-    filename = config['CONSTANTS']['MHC_MOTIF_ATLAS_CLASS_I_FILENAME']
-    
-    action_log = {}
-
-    r = requests.get(url)
-    action_log['http_status_code'] = r.status_code
-    if r.status_code == 200:
-        text = r.text
-        filepath = f"{config['PATHS']['TMP_PATH']}/{filename}"
-        write_file(filepath, text)
-        action_log['file_length'] = len(text)
-        action_log['file_path'] = filepath
-        action_log['error'] = None
-    else:
-        action_log['error'] = 'file_not_found'
-        if verbose:
-            print (f"Error with {r.status_code} when downloading {url}")
-        text = None
-    return action_log
\ No newline at end of file
+    constants = config['CONSTANTS']
+
+    downloads = []
+    for source in constants['DOWNLOAD_SOURCES']:
+        url = constants[source]
+        filepath = f"{config['PATHS']['TMP_PATH']}/{constants[f'{source}_FILENAME']}"
+        downloads.append((source, url, filepath))
+
+    start_time = time.perf_counter()
+    source_logs = download_files(
+        downloads, 
+        force=force, 
+        max_workers=constants['DOWNLOAD_MAX_CONCURRENCY'], 
+        retries=constants['DOWNLOAD_RETRIES'], 
+        backoff=constants['DOWNLOAD_BACKOFF_SECONDS'], 
+        timeout=constants['DOWNLOAD_TIMEOUT_SECONDS']
+    )
+
+    if verbose:
+        for source, source_log in source_logs.items():
+            if source_log['error']:
+                print (f"Error {source_log['error']} when downloading {source_log['url']}")
+            elif source_log['cache_hit']:
+                print (f"{source_log['url']} is unchanged since it was last downloaded")
+
+    action_log = {
+        'sources':source_logs,
+        'seconds':round(time.perf_counter() - start_time, 3),
+        'bytes_transferred':sum(source_log.get('bytes_transferred', 0) for source_log in source_logs.values()),
+        'errors':[source for source, source_log in source_logs.items() if source_log['error']]
+    }
+    return action_log
@@ -0,0 +1,271 @@
+from typing import Callable, Dict, List, Optional, Set
+
+from pipeline import create_folder
+
+from helpers.files import write_json, read_json
+
+import functools
+import hashlib
+import os
+import zipfile
+
+
+def hash_artifact(path:str) -> Optional[str]:
+    """
+    This function returns a content hash for a file, or for a folder and everything in it
+
+    Args:
+        path (str): The path to the file or folder
+
+    Returns:
+        Optional[str]: The SHA-256 hex digest of the content, or None if the path does not exist
+    """
+    if os.path.isdir(path):
+        # a folder is hashed from the relative path and content hash of every file in it, in a fixed order
+        digest = hashlib.sha256()
+        for folder, subfolders, filenames in os.walk(path):
+            subfolders.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(folder, filename)
+                digest.update(os.path.relpath(filepath, path).encode('utf-8'))
+                digest.update(hash_artifact(filepath).encode('ascii'))
+        return digest.hexdigest()
+    if os.path.isfile(path) and path.endswith('.npz'):
+        # .npz files are zip archives which record the time they were written, so only the name and content of each array are hashed
+        digest = hashlib.sha256()
+        with zipfile.ZipFile(path) as archive:
+            for member in sorted(archive.namelist()):
+                digest.update(member.encode('utf-8'))
+                digest.update(hashlib.sha256(archive.read(member)).digest())
+        return digest.hexdigest()
+    if os.path.isfile(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return None
+
+
+def file_fingerprints(paths:List[str]) -> Dict[str, List[int]]:
+    """
+    This function returns the size and modification time of every file at or inside a set of paths, a cheap way to tell that the files have
+    not been changed or rewritten since they were last seen, without reading them
+
+    Args:
+        paths (List[str]): The paths to the files or folders
+
+    Returns:
+        Dict[str, List[int]]: The size in bytes and modification time in nanoseconds of each file, keyed by file path, paths which do not exist
+        are left out
+    """
+    fingerprints = {}
+    for path in paths:
+        filepaths = [path] if os.path.isfile(path) else []
+        for folder, subfolders, filenames in os.walk(path):
+            subfolders.sort()
+            filepaths.extend(os.path.join(folder, filename) for filename in sorted(filenames))
+        for filepath in filepaths:
+            stat = os.stat(filepath)
+            fingerprints[filepath] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def hash_input(path:str) -> Optional[str]:
+    """
+    This function returns a content hash for an input artifact of a step
+
+    A folder with a manifest, e.g. the shards folder, is hashed from the manifest alone, as the manifest holds the content hash of every file in
+    the folder
+
+    Args:
+        path (str): The path to the file or folder
+
+    Returns:
+        Optional[str]: The SHA-256 hex digest of the content, or None if the path does not exist
+    """
+    manifest_filepath = os.path.join(path, 'manifest.json')
+    if os.path.isdir(path) and os.path.isfile(manifest_filepath):
+        return hash_artifact(manifest_filepath)
+    return hash_artifact(path)
+
+
+def hash_content(*parts:bytes) -> str:
+    """
+    This function returns a content hash for some in memory data, e.g. the bytes of the arrays used to build a plot
+
+    Args:
+        *parts (bytes): The data to hash
+
+    Returns:
+        str: The SHA-256 hex digest of the data
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def resolve_artifacts(artifacts:List[str], config:Dict, output_path:str) -> List[str]:
+    """
+    This function fills in the paths of the input or output artifacts declared for a step
+
+    Artifact paths can include {output_path}, {tmp_path} and any of the constants, e.g. {MHC_MOTIF_ATLAS_CLASS_I_FILENAME}
+
+    Args:
+        artifacts (List[str]): The artifact path templates
+        config (Dict): The configuration dictionary
+        output_path (str): The path to the output directory
+
+    Returns:
+        List[str]: The artifact paths
+    """
+    return [artifact.format(output_path=output_path, tmp_path=config['PATHS']['TMP_PATH'], **config['CONSTANTS']) for artifact in artifacts]
+
+
+class AlleleManifest():
+    """
+    This class records a content hash of the input data used to build each per-allele output of a step, so that only the alleles whose data
+    has changed are rebuilt
+
+    Attributes:
+        filepath (str): The path to the manifest file
+        hashes (Dict[str, str]): The content hash for each output key
+    """
+
+    def __init__(self, filepath:str):
+        self.filepath = filepath
+        self.hashes = read_json(filepath) if os.path.exists(filepath) else {}
+
+
+    def is_current(self, key:str, content_hash:str, output_paths:List[str]) -> bool:
+        """
+        This function returns whether an output was built from the same input data and all of its files still exist
+
+        Args:
+            key (str): The output key, e.g. the allele number
+            content_hash (str): The content hash of the input data for this output
+            output_paths (List[str]): The files written for this output
+
+        Returns:
+            bool: Whether the output is up to date
+        """
+        return self.hashes.get(key) == content_hash and all(os.path.exists(output_path) for output_path in output_paths)
+
+
+    def update(self, key:str, content_hash:str):
+        """
+        This function records the content hash of the input data used to build an output
+
+        Args:
+            key (str): The output key, e.g. the allele number
+            content_hash (str): The content hash of the input data for this output
+        """
+        self.hashes[key] = content_hash
+
+
+    def remove_stale(self, current_keys:Set[str], output_paths:Callable[[str], List[str]]) -> List[str]:
+        """
+        This function removes the entries for outputs which are no longer built, e.g. for an allele or length with no peptides left, and deletes
+        their files
+
+        Args:
+            current_keys (Set[str]): The keys of the outputs which are still built
+            output_paths (Callable[[str], List[str]]): The function which returns the files written for the output with a key
+
+        Returns:
+            List[str]: The keys of the outputs which were removed
+        """
+        stale_keys = [key for key in self.hashes if key not in current_keys]
+        for key in stale_keys:
+            for output_path in output_paths(key):
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            del self.hashes[key]
+        return stale_keys
+
+
+    def save(self):
+        """
+        This function writes the manifest file
+        """
+        write_json(self.filepath, self.hashes, pretty=True)
+
+
+def incremental_step(step_number:str, step:Dict) -> Callable:
+    """
+    This function wraps the function for a step so that it only runs when the content of its inputs has changed
+
+    A manifest of the input content hashes is stored for each step, with the size and modification time of the files of its inputs and outputs.
+    The step is skipped when its inputs have the same hashes as the last run and its outputs still have the same size and modification time as
+    that run left them. An input is only read to hash it again if its files have been touched since the last run, and the outputs are only
+    checked if none of the inputs have changed. Steps with no declared inputs always run, as does every step if the force flag is set.
+
+    Args:
+        step_number (str): The number of the step
+        step (Dict): The step definition, including its declared inputs and outputs
+
+    Returns:
+        Callable: The wrapped step function
+    """
+    function = step['function']
+
+    @functools.wraps(function)
+    def run_if_changed(**kwargs) -> Dict:
+        config = kwargs['config']
+        verbose = kwargs['verbose']
+        force = kwargs['force']
+        output_path = kwargs['output_path']
+
+        manifest_folder = f"{output_path}/manifests"
+        manifest_filename = f"{manifest_folder}/step_{step_number}.json"
+        previous_run = read_json(manifest_filename) if os.path.exists(manifest_filename) else {'inputs':{}, 'outputs':{}}
+
+        inputs = resolve_artifacts(step.get('inputs', []), config, output_path)
+        outputs = resolve_artifacts(step.get('outputs', []), config, output_path)
+
+        # an input whose files have the same size and modification time as last time is not read again, the hash from the last run is used
+        previous_input_files = previous_run.get('input_files', {})
+        input_files = {artifact:file_fingerprints([artifact]) for artifact in inputs}
+        input_hashes = {}
+        for artifact in inputs:
+            if artifact in previous_run['inputs'] and previous_input_files.get(artifact) == input_files[artifact]:
+                input_hashes[artifact] = previous_run['inputs'][artifact]
+            else:
+                input_hashes[artifact] = hash_input(artifact)
+        changed_inputs = [artifact for artifact in inputs if previous_run['inputs'].get(artifact) != input_hashes[artifact]]
+
+        # the outputs are only checked if the inputs are unchanged, as the step runs anyway otherwise
+        if inputs and not changed_inputs and not force and previous_run['outputs'] == file_fingerprints(outputs):
+            if verbose:
+                print (f"Step {step_number} skipped, its inputs are unchanged")
+            return {'skipped':True}
+
+        action_log = function(**kwargs) or {}
+
+        # record the hashes of the inputs used, and the size and modification time of the inputs and of the outputs written by this run
+        create_folder(manifest_folder, verbose)
+        write_json(manifest_filename, {
+            'inputs':input_hashes,
+            'input_files':input_files,
+            'outputs':file_fingerprints(outputs)
+        }, pretty=True)
+
+        action_log['skipped'] = False
+        action_log['changed_inputs'] = changed_inputs
+        return action_log
+
+    return run_if_changed
+
+
+def incremental_steps(steps:Dict[str, Dict]) -> Dict[str, Dict]:
+    """
+    This function returns a copy of the steps in which each step only runs when the content of its inputs has changed
+
+    Args:
+        steps (Dict[str, Dict]): The step definitions
+
+    Returns:
+        Dict[str, Dict]: The step definitions with wrapped step functions
+    """
+    return {step_number:{**step, 'function':incremental_step(step_number, step)} for step_number, step in steps.items()}
@@ -0,0 +1,231 @@
+from typing import Dict, List, Tuple
+
+import functools
+import math
+
+from matplotlib.axes import Axes
+from matplotlib.font_manager import FontProperties
+from matplotlib.patches import PathPatch
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath
+from matplotlib.ticker import MaxNLocator
+from matplotlib.transforms import Affine2D
+import numpy as np
+
+
+# The native logo renderer draws logos without building a logomaker Logo for each plot. The glyph shapes, stacking, padding and data limits
+# follow logomaker, and tests/test_logo_rendering.py checks the position and size of every glyph against a logomaker Logo of the same matrix.
+# The axes of the svg (ticks, tick labels and axis labels) are laid out by hand with the constants below to resemble the matplotlib defaults,
+# so they are close to but not identical to a logomaker plot. The outline of each amino acid is computed once per process, and each logo is
+# composed directly as SVG text from the stacked glyph positions. A png is only rasterised if it is one of the requested output formats.
+
+# The glyph font and layout used by logomaker
+GLYPH_FONT = FontProperties(family='sans', weight='bold')
+GLYPH_WIDTH = 0.95
+# logomaker stops narrow characters being stretched wider than this character would be
+WIDEST_GLYPH = 'E'
+
+# The size of the svg in points, and the position of the plot area within it, as fractions of the size, which are the matplotlib defaults
+SVG_WIDTH = 1800
+SVG_HEIGHT = 1440
+PLOT_LEFT = 0.125
+PLOT_RIGHT = 0.9
+PLOT_BOTTOM = 0.11
+PLOT_TOP = 0.88
+
+
+@functools.lru_cache(maxsize=None)
+def glyph_outline(amino_acid:str) -> Tuple[Path, float]:
+    """
+    This function returns the outline of an amino acid glyph, scaled to fill a unit square, computed once per process
+
+    Args:
+        amino_acid (str): The amino acid letter
+
+    Returns:
+        Tuple[Path, float]: The glyph outline, and the fraction of the glyph width it fills, which is less than 1 for narrow letters like I
+    """
+    path = TextPath((0, 0), amino_acid, size=1, prop=GLYPH_FONT)
+    extents = path.get_extents()
+    widest_extents = TextPath((0, 0), WIDEST_GLYPH, size=1, prop=GLYPH_FONT).get_extents()
+    transformation = Affine2D().translate(-extents.xmin, -extents.ymin).scale(1 / extents.width, 1 / extents.height)
+    return transformation.transform_path(path), min(1.0, extents.width / widest_extents.width)
+
+
+@functools.lru_cache(maxsize=None)
+def glyph_svg_path(amino_acid:str) -> str:
+    """
+    This function returns the outline of an amino acid glyph as svg path data, in a unit square with the y axis pointing down
+
+    Args:
+        amino_acid (str): The amino acid letter
+
+    Returns:
+        str: The svg path data
+    """
+    path, width_fraction = glyph_outline(amino_acid)
+    commands = []
+    for vertices, code in path.iter_segments(simplify=False, curves=True):
+        # svg coordinates run down the page, so the glyph is flipped vertically within the unit square
+        points = ' '.join(f"{x:.5f} {1 - y:.5f}" for x, y in vertices.reshape(-1, 2))
+        if code == Path.MOVETO:
+            commands.append(f"M{points}")
+        elif code == Path.LINETO:
+            commands.append(f"L{points}")
+        elif code == Path.CURVE3:
+            commands.append(f"Q{points}")
+        elif code == Path.CURVE4:
+            commands.append(f"C{points}")
+        elif code == Path.CLOSEPOLY:
+            commands.append("Z")
+    return ''.join(commands)
+
+
+def stack_glyphs(information:np.ndarray, amino_acids:List[str], vpad:float=0.1) -> Tuple[List[Tuple[str, float, float, float, float]], float]:
+    """
+    This function stacks the amino acid glyphs at each position of a logo, with the biggest on top, as logomaker does
+
+    Args:
+        information (np.ndarray): The information content in bits of each amino acid at each position
+        amino_acids (List[str]): The amino acids, in the order of the columns of the information matrix
+        vpad (float): The fraction of the height of each glyph left as padding above and below it
+
+    Returns:
+        Tuple[List[Tuple[str, float, float, float, float]], float]: The amino acid, x, y, width and height of each glyph in data coordinates,
+        and the height of the tallest stack
+    """
+    order = np.argsort(information, axis=1)
+    heights = np.take_along_axis(information, order, axis=1)
+    ceilings = np.cumsum(heights, axis=1)
+    floors = ceilings - heights
+
+    glyphs = []
+    for position in range(information.shape[0]):
+        for amino_acid_index, floor, height in zip(order[position], floors[position], heights[position]):
+            # logomaker doesn't draw glyphs with no height
+            if height == 0:
+                continue
+            amino_acid = amino_acids[amino_acid_index]
+            width = GLYPH_WIDTH * glyph_outline(amino_acid)[1]
+            x = position + 1 - width / 2
+            glyphs.append((amino_acid, x, floor + vpad * height / 2, width, height - vpad * height))
+    return glyphs, float(ceilings[:, -1].max()) if len(ceilings) else 0.0
+
+
+def tick_label(tick:float, step:float) -> str:
+    """
+    This function formats a tick label with as many decimal places as the tick spacing needs
+
+    Args:
+        tick (float): The tick value
+        step (float): The spacing between ticks
+
+    Returns:
+        str: The tick label
+    """
+    decimals = max(0, -math.floor(math.log10(step))) if step < 1 else 0
+    # a step like 0.25 needs one more decimal place than its magnitude suggests
+    if round(step, decimals) != step:
+        decimals += 1
+    return f"{tick:.{decimals}f}"
+
+
+def svg_logo(glyphs:List[Tuple[str, float, float, float, float]], length:int, ymax:float, colors:Dict[str, List[float]], xlabel:str='Peptide position',
+             ylabel:str='Bits', tick_fontsize:int=40, label_fontsize:int=60) -> str:
+    """
+    This function composes a logo as svg, from its stacked glyphs
+
+    Each glyph outline is defined once in the svg and placed with a transform for every position it appears at
+
+    Args:
+        glyphs (List[Tuple[str, float, float, float, float]]): The amino acid, x, y, width and height of each glyph, from stack_glyphs
+        length (int): The number of positions in the logo
+        ymax (float): The height of the tallest stack
+        colors (Dict[str, List[float]]): The rgb colour of each amino acid, as fractions
+        xlabel (str): The label for the x axis
+        ylabel (str): The label for the y axis
+        tick_fontsize (int): The font size of the tick labels in points
+        label_fontsize (int): The font size of the axis labels in points
+
+    Returns:
+        str: The svg document
+    """
+    # the data limits are the same as those set by logomaker
+    xmin = 1 - GLYPH_WIDTH / 2
+    xmax = length + GLYPH_WIDTH / 2
+    ymax = ymax if ymax > 0 else 1.0
+
+    left = PLOT_LEFT * SVG_WIDTH
+    right = PLOT_RIGHT * SVG_WIDTH
+    top = (1 - PLOT_TOP) * SVG_HEIGHT
+    bottom = (1 - PLOT_BOTTOM) * SVG_HEIGHT
+    x_scale = (right - left) / (xmax - xmin)
+    y_scale = (bottom - top) / ymax
+
+    def svg_x(x:float) -> float:
+        return left + (x - xmin) * x_scale
+
+    def svg_y(y:float) -> float:
+        return bottom - y * y_scale
+
+    elements = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="{SVG_WIDTH}pt" height="{SVG_HEIGHT}pt" viewBox="0 0 {SVG_WIDTH} {SVG_HEIGHT}">',
+        f'<rect width="{SVG_WIDTH}" height="{SVG_HEIGHT}" fill="#ffffff"/>'
+    ]
+
+    # define the outline of each amino acid used in the logo once
+    elements.append('<defs>')
+    for amino_acid in sorted({glyph[0] for glyph in glyphs}):
+        elements.append(f'<path id="glyph-{amino_acid}" d="{glyph_svg_path(amino_acid)}"/>')
+    elements.append('</defs>')
+
+    # place each glyph, the unit square outline is scaled to the glyph size and moved to its position
+    for amino_acid, x, y, width, height in glyphs:
+        fill = '#' + ''.join(f"{round(channel * 255):02x}" for channel in colors[amino_acid])
+        elements.append(f'<use xlink:href="#glyph-{amino_acid}" fill="{fill}" transform="translate({svg_x(x):.3f} {svg_y(y + height):.3f}) scale({width * x_scale:.4f} {height * y_scale:.4f})"/>')
+
+    # draw the left and bottom spines and the baseline
+    elements.append(f'<path d="M{left:.3f} {top:.3f}V{bottom:.3f}H{right:.3f}" fill="none" stroke="#000000" stroke-width="0.8" stroke-linecap="square"/>')
+
+    # draw the ticks and tick labels, positioned with the same locator matplotlib uses by default
+    tick_length = 3.5
+    tick_pad = 3.5 + tick_length
+    font = 'font-family="DejaVu Sans, Bitstream Vera Sans, Arial, sans-serif" fill="#000000"'
+    x_ticks = [tick for tick in MaxNLocator(nbins=9, steps=[1, 2, 2.5, 5, 10], integer=True).tick_values(xmin, xmax) if xmin <= tick <= xmax]
+    for tick in x_ticks:
+        elements.append(f'<path d="M{svg_x(tick):.3f} {bottom:.3f}v{tick_length}" stroke="#000000" stroke-width="0.8"/>')
+        elements.append(f'<text x="{svg_x(tick):.3f}" y="{bottom + tick_pad:.3f}" font-size="{tick_fontsize}" text-anchor="middle" dominant-baseline="hanging" {font}>{int(tick)}</text>')
+    y_ticks = [tick for tick in MaxNLocator(nbins=9, steps=[1, 2, 2.5, 5, 10]).tick_values(0, ymax) if 0 <= tick <= ymax]
+    y_step = y_ticks[1] - y_ticks[0] if len(y_ticks) > 1 else 1.0
+    for tick in y_ticks:
+        elements.append(f'<path d="M{left:.3f} {svg_y(tick):.3f}h{-tick_length}" stroke="#000000" stroke-width="0.8"/>')
+        elements.append(f'<text x="{left - tick_pad:.3f}" y="{svg_y(tick):.3f}" font-size="{tick_fontsize}" text-anchor="end" dominant-baseline="central" {font}>{tick_label(tick, y_step)}</text>')
+
+    # draw the axis labels, below the x tick labels and to the left of the y tick labels
+    xlabel_y = bottom + tick_pad + tick_fontsize + 10
+    elements.append(f'<text x="{(left + right) / 2:.3f}" y="{xlabel_y:.3f}" font-size="{label_fontsize}" text-anchor="middle" dominant-baseline="hanging" {font}>{xlabel}</text>')
+    ylabel_x = left - tick_pad - tick_fontsize * 0.6 * max(len(tick_label(tick, y_step)) for tick in y_ticks) - 40
+    elements.append(f'<text transform="translate({ylabel_x:.3f} {(top + bottom) / 2:.3f}) rotate(-90)" font-size="{label_fontsize}" text-anchor="middle" {font}>{ylabel}</text>')
+
+    elements.append('</svg>')
+    return '\n'.join(elements) + '\n'
+
+
+def draw_logo(ax:Axes, glyphs:List[Tuple[str, float, float, float, float]], length:int, ymax:float, colors:Dict[str, List[float]]):
+    """
+    This function draws a logo onto a matplotlib axes from its stacked glyphs, so it can be rasterised
+
+    Args:
+        ax (Axes): The axes to draw on
+        glyphs (List[Tuple[str, float, float, float, float]]): The amino acid, x, y, width and height of each glyph, from stack_glyphs
+        length (int): The number of positions in the logo
+        ymax (float): The height of the tallest stack
+        colors (Dict[str, List[float]]): The rgb colour of each amino acid, as fractions
+    """
+    for amino_acid, x, y, width, height in glyphs:
+        path = Affine2D().scale(width, height).translate(x, y).transform_path(glyph_outline(amino_acid)[0])
+        ax.add_patch(PathPatch(path, facecolor=colors[amino_acid], edgecolor='black', linewidth=0.0))
+    # draw the baseline and set the same data limits as logomaker
+    ax.axhline(0, color='black', linewidth=0.5)
+    ax.set_xlim([1 - GLYPH_WIDTH / 2, length + GLYPH_WIDTH / 2])
+    ax.set_ylim([0, ymax if ymax > 0 else 1.0])
@@ -0,0 +1,320 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import os
+
+import numpy as np
+
+from helpers.files import write_json, read_json
+
+from peptide_store import PeptideStore, load_peptide_store
+from packed_peptides import codes_to_array, word_count
+from amino_acid_counts import AminoAcidCounts, load_amino_acid_counts
+
+
+# the version of the format the accumulator is saved in, a state saved in any other format is not loaded and the atlas file is processed again
+STATE_VERSION = 1
+
+
+class MotifAccumulator():
+    """
+    This class accumulates the peptides, amino acid counts and peptide length distributions for a run of the processing step
+
+    Accumulators built from separate parts of the atlas file can be merged, so the file can be processed in shards across several processes
+
+    Attributes:
+        peptide_store (PeptideStore): The peptides for each allele and the alleles for each peptide
+        amino_acid_counts (AminoAcidCounts): The amino acid counts for the peptides bound by each allele
+        lines_processed (int): The number of data lines read from the atlas file
+        invalid_peptides (int): The number of data lines skipped because the peptide is not made only of capital letters, e.g. a lowercase or
+            modified residue, so can not be packed
+    """
+
+    def __init__(self, amino_acids:List[str]):
+        self.peptide_store = PeptideStore()
+        self.amino_acid_counts = AminoAcidCounts(amino_acids)
+        self.lines_processed = 0
+        self.invalid_peptides = 0
+
+
+    def add(self, allele_number:str, peptide:str) -> bool:
+        """
+        This function adds a peptide bound by an allele to the accumulator
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide (str): The peptide sequence
+
+        Returns:
+            bool: Whether the peptide was new for this allele (and is not a duplicate)
+        """
+        # the add function returns true if the peptide was added to the allele (and is not a duplicate)
+        peptide_added = self.peptide_store.add(allele_number, peptide, str(len(peptide)))
+        # if the peptide is unique we can add the amino acids at each position of the peptide to the amino acid counts
+        if peptide_added:
+            self.amino_acid_counts.add(allele_number, peptide)
+        return peptide_added
+
+
+    def remove(self, allele_number:str, peptide:str) -> bool:
+        """
+        This function removes a peptide bound by an allele from the accumulator
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide (str): The peptide sequence
+
+        Returns:
+            bool: Whether the peptide was in the accumulator for this allele
+        """
+        peptide_length = str(len(peptide))
+        peptide_removed = self.peptide_store.remove(allele_number, peptide, peptide_length)
+        if peptide_removed:
+            self.amino_acid_counts.remove(allele_number, peptide)
+            # if that was the last peptide of this length for the allele, the length is no longer included in the amino acid distributions
+            if peptide_length not in self.peptide_store.alleles.get(allele_number, {}):
+                del self.amino_acid_counts.peptide_lengths[allele_number][peptide_length]
+        return peptide_removed
+
+
+    def merge(self, other:'MotifAccumulator'):
+        """
+        This function merges an accumulator built from a later part of the atlas file into this one
+
+        Peptide sets are unioned and counts are added, any peptide already seen for an allele is removed again from the merged counts so the result
+        is the same as processing the file serially
+
+        Args:
+            other (MotifAccumulator): The accumulator to merge into this one
+        """
+        duplicates = self.peptide_store.merge(other.peptide_store)
+        self.amino_acid_counts.merge(other.amino_acid_counts)
+        for allele_number, peptide in duplicates:
+            self.amino_acid_counts.remove(allele_number, peptide)
+        self.lines_processed += other.lines_processed
+        self.invalid_peptides += other.invalid_peptides
+
+
+    def peptide_length_distribution(self, allele_number:str) -> Dict:
+        """
+        This function builds the peptide length distribution for the allele
+
+        Args:
+            allele_number (str): The slugified allele number
+
+        Returns:
+            Dict: The total number of peptides and the count and percentage for each peptide length
+        """
+        # create a dictionary for the peptide length distribution for this allele
+        peptide_length_distribution = {'total':0,'lengths':{}}
+        # iterate through the peptide lengths for this allele and add the count for each to the dictionary
+        for peptide_length in self.peptide_store.alleles[allele_number]:
+            peptide_length_distribution['lengths'][peptide_length] = {
+                'count':self.peptide_store.peptide_count(allele_number, peptide_length),
+                'percentage':None
+            }
+        # set the total number of peptides for this allele in the dictionary
+        allele_peptide_count = sum(this_length['count'] for this_length in peptide_length_distribution['lengths'].values())
+        peptide_length_distribution['total'] = allele_peptide_count
+        # set the percentage of peptides for each length
+        for this_length in peptide_length_distribution['lengths'].values():
+            this_length['percentage'] = this_length['count'] / allele_peptide_count * 100
+        return peptide_length_distribution
+
+
+    def allele_compilations(self, allele_numbers:Optional[Set[str]]=None) -> Dict[str, Dict]:
+        """
+        This function returns the data compilations which are keyed by allele, for some or all of the alleles
+
+        Args:
+            allele_numbers (Optional[Set[str]]): The alleles to include, or None for every allele
+
+        Returns:
+            Dict[str, Dict]: The alleles, amino acid distributions and peptide length distributions, keyed by compilation name
+        """
+        return {
+            'alleles':self.peptide_store.alleles_to_dict(allele_numbers),
+            'amino_acid_distributions':self.amino_acid_counts.to_dict(allele_numbers),
+            'peptide_length_distributions':{allele_number:self.peptide_length_distribution(allele_number) for allele_number in self.peptide_store.alleles if allele_numbers is None or allele_number in allele_numbers}
+        }
+
+
+    def allele_compilation_keys(self) -> Dict[str, List[str]]:
+        """
+        This function returns the alleles in each of the data compilations which are keyed by allele, in the order they are written
+
+        Returns:
+            Dict[str, List[str]]: The slugified allele numbers, keyed by compilation name
+        """
+        return {
+            'alleles':list(self.peptide_store.alleles),
+            'amino_acid_distributions':self.amino_acid_counts.counted_alleles(),
+            'peptide_length_distributions':list(self.peptide_store.alleles)
+        }
+
+
+    def compilations(self) -> Dict[str, Dict]:
+        """
+        This function returns the data compilations written to the warehouse by the processing step
+
+        Returns:
+            Dict[str, Dict]: The alleles, peptides, amino acid distributions and peptide length distributions, keyed by compilation name
+        """
+        return {
+            **self.allele_compilations(),
+            'peptides':self.peptide_store.peptides_to_dict()
+        }
+
+
+    def tables(self) -> Tuple[Dict[str, Dict[str, np.ndarray]], Dict[str, List[str]]]:
+        """
+        This function returns the data compilations as tables for the columnar warehouse
+
+        Returns:
+            Tuple[Dict[str, Dict[str, np.ndarray]], Dict[str, List[str]]]: The columns of each table keyed by table name, and the labels for the 
+            allele_id and amino_acid_id columns
+        """
+        allele_numbers = list(self.peptide_store.alleles)
+        allele_ids = {allele_number:i for i, allele_number in enumerate(allele_numbers)}
+        peptides, allele_peptides = self.peptide_store.to_columns(allele_ids)
+
+        # the peptide length distributions are small, so are built from the lengths of the peptide sets for each allele
+        peptide_length_distributions = {'allele_id':[], 'peptide_length':[], 'count':[], 'percentage':[]}
+        for allele_number in allele_numbers:
+            for peptide_length, this_length in self.peptide_length_distribution(allele_number)['lengths'].items():
+                peptide_length_distributions['allele_id'].append(allele_ids[allele_number])
+                peptide_length_distributions['peptide_length'].append(int(peptide_length))
+                peptide_length_distributions['count'].append(this_length['count'])
+                peptide_length_distributions['percentage'].append(this_length['percentage'])
+
+        tables = {
+            'peptides':peptides,
+            'allele_peptides':allele_peptides,
+            'amino_acid_distributions':self.amino_acid_counts.to_columns(allele_ids),
+            'peptide_length_distributions':{
+                'allele_id':np.array(peptide_length_distributions['allele_id'], dtype=np.int32),
+                'peptide_length':np.array(peptide_length_distributions['peptide_length'], dtype=np.int16),
+                'count':np.array(peptide_length_distributions['count'], dtype=np.int64),
+                'percentage':np.array(peptide_length_distributions['percentage'], dtype=np.float64)
+            }
+        }
+        dictionaries = {
+            'allele_id':allele_numbers,
+            'amino_acid_id':self.amino_acid_counts.amino_acids
+        }
+        return tables, dictionaries
+
+
+    def shards(self, allele_numbers:Optional[Set[str]]=None) -> Iterator[Tuple[str, str, Dict[str, np.ndarray]]]:
+        """
+        This function returns the data for each allele and peptide length, for the sharded warehouse
+
+        Args:
+            allele_numbers (Optional[Set[str]]): The alleles to return the data for, or None for every allele
+
+        Yields:
+            Tuple[str, str, Dict[str, np.ndarray]]: The allele number, peptide length and the packed peptides, counts, percentages, probabilities 
+            and information arrays, the matrices have the shape (length, amino acids)
+        """
+        amino_acid_counts = self.amino_acid_counts
+        # the matrices for every allele and length are computed in one pass over the counts tensor
+        percentages = amino_acid_counts.percentages()
+        probabilities = amino_acid_counts.probabilities()
+        information = amino_acid_counts.information(probabilities)
+        for allele_number, lengths in self.peptide_store.alleles.items():
+            if allele_numbers is not None and allele_number not in allele_numbers:
+                continue
+            i = amino_acid_counts.allele_index[allele_number]
+            for peptide_length, allele_peptides in lengths.items():
+                length = int(peptide_length)
+                yield allele_number, peptide_length, {
+                    'peptides':codes_to_array(allele_peptides, len(allele_peptides), word_count(length)),
+                    'counts':amino_acid_counts.counts[i, length, :length],
+                    'percentages':percentages[i, length, :length],
+                    'probabilities':probabilities[i, length, :length],
+                    'information':information[i, length, :length]
+                }
+
+
+    def save(self, filepath:str, tables:Optional[Dict[str, Dict[str, np.ndarray]]]=None):
+        """
+        This function saves the accumulator, so that a later run of the processing step can apply only the changes to the atlas file
+
+        The arrays are saved as an uncompressed .npz file, alongside a .json sidecar holding the labels, the counters and the version of the
+        format, as the tables of the columnar warehouse are
+
+        Args:
+            filepath (str): The path to the state files, without an extension
+            tables (Optional[Dict[str, Dict[str, np.ndarray]]]): The tables returned by tables(), if they have been built already, so the
+                peptide columns are not built again
+        """
+        allele_numbers = list(self.peptide_store.alleles)
+        count_arrays, count_metadata = self.amino_acid_counts.to_state()
+        # the tables number the alleles in the same order as the state does
+        columns = None if tables is None else (tables['peptides'], tables['allele_peptides'])
+        np.savez(f"{filepath}.npz", **self.peptide_store.to_state({allele_number:i for i, allele_number in enumerate(allele_numbers)}, columns), **count_arrays)
+        metadata = {
+            'version':STATE_VERSION,
+            'allele_numbers':allele_numbers,
+            'amino_acid_counts':count_metadata,
+            'lines_processed':self.lines_processed,
+            'invalid_peptides':self.invalid_peptides
+        }
+        write_json(f"{filepath}.json", metadata, pretty=True)
+
+
+def is_current_state(filepath:str) -> bool:
+    """
+    This function returns whether there is a saved accumulator in the current format
+
+    Args:
+        filepath (str): The path to the state files, without an extension
+
+    Returns:
+        bool: Whether the state files exist and were saved in the current format
+    """
+    if not (os.path.exists(f"{filepath}.npz") and os.path.exists(f"{filepath}.json")):
+        return False
+    return read_json(f"{filepath}.json").get('version') == STATE_VERSION
+
+
+def load_accumulator(filepath:str) -> MotifAccumulator:
+    """
+    This function loads an accumulator saved by a previous run of the processing step
+
+    Args:
+        filepath (str): The path to the state files, without an extension
+
+    Returns:
+        MotifAccumulator: The accumulator
+
+    Raises:
+        ValueError: If the state was saved in a different format
+    """
+    metadata = read_json(f"{filepath}.json")
+    if metadata.get('version') != STATE_VERSION:
+        raise ValueError(f"The state in {filepath} was saved in version {metadata.get('version')} of the format, not version {STATE_VERSION}")
+    with np.load(f"{filepath}.npz", allow_pickle=False) as state:
+        arrays = {array_name:state[array_name] for array_name in state.files}
+    accumulator = MotifAccumulator(metadata['amino_acid_counts']['amino_acids'])
+    accumulator.peptide_store = load_peptide_store(arrays, metadata['allele_numbers'])
+    accumulator.amino_acid_counts = load_amino_acid_counts(arrays, metadata['amino_acid_counts'])
+    accumulator.lines_processed = metadata['lines_processed']
+    accumulator.invalid_peptides = metadata['invalid_peptides']
+    return accumulator
+
+
+def read_state_pairs(filepath:str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    This function reads the allele and peptide pairs of a saved accumulator as arrays, without loading the rest of the state
+
+    Args:
+        filepath (str): The path to the state files, without an extension
+
+    Returns:
+        Tuple[List[str], np.ndarray, np.ndarray]: The allele number for each allele id, and the allele id and packed peptide of each pair in
+        insertion order
+    """
+    with np.load(f"{filepath}.npz", allow_pickle=False) as state:
+        pair_allele_ids = state['pair_allele_id']
+        pair_peptides = state['peptides'][state['pair_peptide_id']]
+    return read_json(f"{filepath}.json")['allele_numbers'], pair_allele_ids, pair_peptides
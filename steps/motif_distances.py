@@ -0,0 +1,229 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pipeline import create_folder
+
+from helpers.files import write_json, read_json
+
+from warehouse import ShardedWarehouse
+from incremental import hash_content
+
+import os
+
+import numpy as np
+
+
+# The pairwise distances between motifs are held as a float64 .npy file in the warehouse, alongside a small .json sidecar recording the content
+# hash of the features and the metric they were computed from. The matrix is memory mapped when it is read, so clustering with different
+# parameters reuses the distances without recomputing them or reading the whole matrix into memory. It is written as float64, the type HDBSCAN
+# works in, so the memory mapped matrix can be handed to it without being converted into a copy in memory.
+
+DISTANCE_DTYPE = np.float64
+
+# the number of motifs compared against all the others at once, which bounds the memory used for the (block, motifs, length, amino acids) arrays
+DISTANCE_BLOCK_SIZE = 64
+
+
+def distances_folder(warehouse_folder:str) -> str:
+    """
+    This function returns the folder for the cached distance matrices within the warehouse folder
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+
+    Returns:
+        str: The path to the distances folder
+    """
+    return f"{warehouse_folder}/distances"
+
+
+def motif_features(shards:ShardedWarehouse, peptide_length:str, allele_labels:Optional[List[str]]=None) -> Tuple[List[str], np.ndarray]:
+    """
+    This function builds the feature array for the motifs of a peptide length from the per position amino acid counts
+
+    Args:
+        shards (ShardedWarehouse): The sharded warehouse
+        peptide_length (str): The peptide length
+        allele_labels (Optional[List[str]]): The alleles to build features for, or None for every allele with a motif of this length
+
+    Returns:
+        Tuple[List[str], np.ndarray]: The alleles with a motif of this length, in warehouse order, and the amino acid frequencies at each position
+        with the shape (alleles, length, amino acids)
+    """
+    if allele_labels is None:
+        allele_labels = [allele_slug for allele_slug in shards.alleles if shards.has_shard(allele_slug, peptide_length)]
+    if not allele_labels:
+        return allele_labels, np.zeros((0, int(peptide_length), len(shards.amino_acids)))
+    counts = np.stack([shards.shard(allele_slug, peptide_length)['counts'] for allele_slug in allele_labels]).astype(np.float64)
+    # every position of a motif has the same total, the number of peptides of that length
+    totals = counts.sum(axis=2, keepdims=True)
+    return allele_labels, np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+
+def percentage_embedding(features:np.ndarray) -> np.ndarray:
+    """
+    This function flattens the motifs into the percentage of each amino acid at each position, the euclidean distance between these is the
+    euclidean motif distance
+
+    Args:
+        features (np.ndarray): The amino acid frequencies of the motifs with the shape (motifs, length, amino acids)
+
+    Returns:
+        np.ndarray: The embedded motifs with the shape (motifs, length * amino acids)
+    """
+    return features.reshape(len(features), -1) * 100
+
+
+def hellinger_embedding(features:np.ndarray) -> np.ndarray:
+    """
+    This function flattens the motifs into the square root of the frequency of each amino acid at each position, scaled so that the euclidean
+    distance between these is the root mean square over the positions of the Hellinger distance, which lies between 0 and 1
+
+    The Hellinger distance is closely related to the Jensen-Shannon distance, but as it is a euclidean distance in this embedding new motifs can
+    be placed into existing clusters without comparing them to every other motif
+
+    Args:
+        features (np.ndarray): The amino acid frequencies of the motifs with the shape (motifs, length, amino acids)
+
+    Returns:
+        np.ndarray: The embedded motifs with the shape (motifs, length * amino acids)
+    """
+    return np.sqrt(features.reshape(len(features), -1) / (2 * features.shape[1]))
+
+
+def euclidean_distances(features:np.ndarray, block:np.ndarray) -> np.ndarray:
+    """
+    This function returns the euclidean distances between motifs, using the percentage of each amino acid at each position as the features
+
+    Args:
+        features (np.ndarray): The amino acid frequencies of all the motifs with the shape (motifs, length, amino acids)
+        block (np.ndarray): The amino acid frequencies of the motifs to compare against all the others
+
+    Returns:
+        np.ndarray: The distances with the shape (block motifs, motifs)
+    """
+    differences = (block[:, None] - features[None]) * 100
+    return np.sqrt(np.square(differences).sum(axis=(2, 3)))
+
+
+def jensen_shannon_distances(features:np.ndarray, block:np.ndarray) -> np.ndarray:
+    """
+    This function returns the Jensen-Shannon distance between motifs, averaged over the positions
+
+    The Jensen-Shannon distance at a position is the square root of the Jensen-Shannon divergence (in bits) between the two amino acid
+    distributions, so it lies between 0 and 1 and is a true metric
+
+    Args:
+        features (np.ndarray): The amino acid frequencies of all the motifs with the shape (motifs, length, amino acids)
+        block (np.ndarray): The amino acid frequencies of the motifs to compare against all the others
+
+    Returns:
+        np.ndarray: The distances with the shape (block motifs, motifs)
+    """
+    p = np.broadcast_to(block[:, None], (len(block),) + features.shape)
+    q = np.broadcast_to(features[None], p.shape)
+    m = (p + q) / 2
+    # amino acids which are not seen contribute nothing to the divergence, 0 * log(0) is taken to be 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p_terms = np.where(p > 0, p * np.log2(p / m), 0)
+        q_terms = np.where(q > 0, q * np.log2(q / m), 0)
+    divergence = (p_terms.sum(axis=3) + q_terms.sum(axis=3)) / 2
+    # rounding can leave a divergence a tiny amount below zero for identical distributions
+    return np.sqrt(np.clip(divergence, 0, 1)).mean(axis=2)
+
+
+def hellinger_distances(features:np.ndarray, block:np.ndarray) -> np.ndarray:
+    """
+    This function returns the root mean square over the positions of the Hellinger distance between motifs
+
+    Args:
+        features (np.ndarray): The amino acid frequencies of all the motifs with the shape (motifs, length, amino acids)
+        block (np.ndarray): The amino acid frequencies of the motifs to compare against all the others
+
+    Returns:
+        np.ndarray: The distances with the shape (block motifs, motifs)
+    """
+    differences = hellinger_embedding(block)[:, None] - hellinger_embedding(features)[None]
+    return np.sqrt(np.square(differences).sum(axis=2))
+
+
+# The motif distances which can be used for clustering, each takes the features of all the motifs and a block of motifs and returns the distances
+# between them. Further distances can be added here and selected with the CLUSTER_DISTANCE_METRIC constant.
+MOTIF_DISTANCES = {
+    'euclidean':euclidean_distances,
+    'hellinger':hellinger_distances,
+    'jensen_shannon':jensen_shannon_distances
+}
+
+# The motif distances which are the euclidean distance between motifs in an embedding. These are clustered on the embedded motifs, which lets
+# new motifs be placed into the fitted clusters, the other distances are clustered on a precomputed distance matrix and are refitted every time.
+MOTIF_EMBEDDINGS = {
+    'euclidean':percentage_embedding,
+    'hellinger':hellinger_embedding
+}
+
+
+def distance_matrix(features:np.ndarray, distance_function:Callable[[np.ndarray, np.ndarray], np.ndarray], filepath:str) -> np.ndarray:
+    """
+    This function computes the pairwise distances between motifs straight into a float64 .npy file, a block of motifs at a time
+
+    Args:
+        features (np.ndarray): The amino acid frequencies of the motifs with the shape (motifs, length, amino acids)
+        distance_function (Callable[[np.ndarray, np.ndarray], np.ndarray]): The motif distance
+        filepath (str): The path to the .npy file
+
+    Returns:
+        np.ndarray: The memory mapped distance matrix
+    """
+    motif_count = len(features)
+    distances = np.lib.format.open_memmap(filepath, mode='w+', dtype=DISTANCE_DTYPE, shape=(motif_count, motif_count))
+    for start in range(0, motif_count, DISTANCE_BLOCK_SIZE):
+        distances[start:start + DISTANCE_BLOCK_SIZE] = distance_function(features, features[start:start + DISTANCE_BLOCK_SIZE])
+    # the distance from a motif to itself is exactly zero, whatever the rounding
+    np.fill_diagonal(distances, 0)
+    distances.flush()
+    del distances
+    return np.load(filepath, mmap_mode='r')
+
+
+def cached_distance_matrix(warehouse_folder:str, metric:str, peptide_length:str, allele_labels:List[str], features:np.ndarray,
+                           verbose:bool=False) -> Tuple[np.ndarray, bool]:
+    """
+    This function returns the pairwise distances between the motifs of a peptide length, only computing them if the motifs or metric have changed
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        metric (str): The name of the motif distance in MOTIF_DISTANCES
+        peptide_length (str): The peptide length
+        allele_labels (List[str]): The alleles of the motifs, in the order of the features
+        features (np.ndarray): The amino acid frequencies of the motifs with the shape (motifs, length, amino acids)
+        verbose (bool): Whether to print verbose output
+
+    Returns:
+        Tuple[np.ndarray, bool]: The memory mapped distance matrix, and whether it was read from the cache
+    """
+    if metric not in MOTIF_DISTANCES:
+        raise ValueError(f"Unknown motif distance '{metric}', expected one of {', '.join(MOTIF_DISTANCES)}")
+
+    folder = distances_folder(warehouse_folder)
+    create_folder(folder, verbose)
+    filepath = f"{folder}/{metric}_{peptide_length}.npy"
+    metadata_filepath = f"{folder}/{metric}_{peptide_length}.json"
+    content_hash = hash_content(metric.encode('utf-8'), '\n'.join(allele_labels).encode('utf-8'), np.ascontiguousarray(features).tobytes())
+
+    if os.path.exists(filepath) and os.path.exists(metadata_filepath):
+        if read_json(metadata_filepath).get('content_hash') == content_hash:
+            distances = np.load(filepath, mmap_mode='r')
+            # a matrix cached as float32 by an earlier version is computed again, rather than being converted on every read
+            if distances.dtype == DISTANCE_DTYPE:
+                return distances, True
+            del distances
+
+    distances = distance_matrix(features, MOTIF_DISTANCES[metric], filepath)
+    metadata = {
+        'metric':metric,
+        'peptide_length':int(peptide_length),
+        'alleles':allele_labels,
+        'content_hash':content_hash
+    }
+    write_json(metadata_filepath, metadata, pretty=True)
+    return distances, False
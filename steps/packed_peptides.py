@@ -0,0 +1,217 @@
+from typing import Iterable, List
+
+import numpy as np
+
+
+# Peptides are packed at 5 bits per residue, 12 residues to a 64 bit word, with the first residue in the highest bits. Each letter A-Z is stored
+# as 1-26 and the end of the peptide is padded with 0, so any sequence of capital letters can be packed and unpacked again. Because padding sorts
+# before every letter, sorting or comparing packed peptides gives the same order as sorting or comparing the sequences. A nonamer takes 8 bytes
+# packed, against around 58 bytes as a Python string or 36 to 60 bytes in a numpy unicode array.
+
+RESIDUE_BITS = 5
+RESIDUES_PER_WORD = 12
+
+# the string the peptides in the ingestion state are packed with, a saved state packed differently can not be used
+PEPTIDE_ENCODING = 'packed_5bit'
+
+
+def is_packable(peptide:str) -> bool:
+    """
+    This function returns whether a peptide can be packed, i.e. it is made only of the capital letters A to Z
+
+    Args:
+        peptide (str): The peptide sequence
+
+    Returns:
+        bool: Whether the peptide can be packed
+    """
+    # any other character would overflow its 5 bits into the neighbouring residue, or make the code negative
+    return peptide.isascii() and peptide.isalpha() and peptide.isupper()
+
+
+def pack_peptide(peptide:str) -> int:
+    """
+    This function packs a single peptide into a Python integer, for use as a compact dictionary key
+
+    The integer holds the same bits as the packed words of the peptide joined together, so peptides of any length can be packed
+
+    Args:
+        peptide (str): The peptide sequence, in capital letters
+
+    Returns:
+        int: The packed peptide
+
+    Raises:
+        ValueError: If the peptide is empty or has any character other than the capital letters A to Z, which have no 5 bit code
+    """
+    if not is_packable(peptide):
+        raise ValueError(f"The peptide {peptide!r} can not be packed, only peptides of the capital letters A to Z can be")
+    code = 0
+    for residue in peptide.encode('ascii'):
+        code = (code << RESIDUE_BITS) | (residue - 64)
+    # the peptide is padded to a whole number of words, so the integer has the same layout as the packed array
+    return code << (-len(peptide) % RESIDUES_PER_WORD) * RESIDUE_BITS
+
+
+def unpack_peptide(code:int) -> str:
+    """
+    This function unpacks a peptide packed by pack_peptide
+
+    Args:
+        code (int): The packed peptide
+
+    Returns:
+        str: The peptide sequence
+    """
+    residues = bytearray()
+    while code:
+        residues.append((code & 31) + 64 if code & 31 else 0)
+        code >>= RESIDUE_BITS
+    return residues[::-1].rstrip(b'\x00').decode('ascii') if residues else ''
+
+
+def word_count(max_length:int) -> int:
+    """
+    This function returns the number of 64 bit words needed to pack peptides up to a length
+
+    Args:
+        max_length (int): The length of the longest peptide
+
+    Returns:
+        int: The number of words, at least 1
+    """
+    return max(-(-max_length // RESIDUES_PER_WORD), 1)
+
+
+def codes_to_array(codes:Iterable[int], count:int, words:int=1) -> np.ndarray:
+    """
+    This function turns peptides packed by pack_peptide into an array of packed peptides
+
+    Args:
+        codes (Iterable[int]): The packed peptides
+        count (int): The number of packed peptides
+        words (int): The number of words for each peptide, which must be enough for the longest peptide
+
+    Returns:
+        np.ndarray: A uint64 array with the shape (peptides, words)
+    """
+    if words == 1:
+        return np.fromiter(codes, dtype=np.uint64, count=count)[:, None]
+    word_bits = RESIDUES_PER_WORD * RESIDUE_BITS
+    # the codes are held in an object array, so the shifts on each Python integer are run by numpy rather than a generator
+    codes = np.fromiter(codes, dtype=object, count=count)
+    own_words = np.ones(count, dtype=np.int64)
+    for word in range(1, words):
+        own_words += (codes >= (1 << (word_bits * word))).astype(bool)
+    # shorter peptides are padded out to the full width, the first residue always sits in the top bits of the first word of a packed peptide
+    codes = codes << ((words - own_words) * word_bits).astype(object)
+    mask = (1 << word_bits) - 1
+    return np.stack([((codes >> (word_bits * (words - 1 - word))) & mask).astype(np.uint64) for word in range(words)], axis=1).reshape(count, words)
+
+
+def pack_sequences(sequences:np.ndarray, words:int=1) -> np.ndarray:
+    """
+    This function packs an array of peptide sequences in one go, giving the same array as codes_to_array gives for the peptides packed one at a time
+
+    Args:
+        sequences (np.ndarray): The peptide sequences as a bytes array, which must all be packable
+        words (int): The number of words for each peptide, which must be enough for the longest peptide
+
+    Returns:
+        np.ndarray: A uint64 array with the shape (peptides, words)
+    """
+    # the sequences are padded with null bytes to the full width, which pack to 0 as the padding does in pack_peptide
+    width = words * RESIDUES_PER_WORD
+    residues = np.frombuffer(np.ascontiguousarray(sequences, dtype=f"S{width}").tobytes(), dtype=np.uint8).reshape(len(sequences), words, RESIDUES_PER_WORD)
+    codes = np.where(residues > 0, residues - 64, 0).astype(np.uint64)
+    shifts = (np.arange(RESIDUES_PER_WORD, 0, -1, dtype=np.uint64) - 1) * RESIDUE_BITS
+    return np.bitwise_or.reduce(codes << shifts, axis=2)
+
+
+def packed_codes(packed:np.ndarray) -> List[int]:
+    """
+    This function turns an array of packed peptides back into the integers pack_peptide gives for each peptide
+
+    Args:
+        packed (np.ndarray): A uint64 array with the shape (peptides, words)
+
+    Returns:
+        List[int]: The packed peptides
+    """
+    codes = packed[:, 0].astype(object)
+    if packed.shape[1] > 1:
+        # pack_peptide only pads a peptide to its own number of words, so the words of a longer peptide are joined up to that number
+        word_bits = RESIDUES_PER_WORD * RESIDUE_BITS
+        own_words = -(-packed_lengths(packed) // RESIDUES_PER_WORD)
+        for word in range(1, packed.shape[1]):
+            longer = own_words > word
+            codes[longer] = (codes[longer] << word_bits) | packed[longer, word].astype(object)
+    return codes.tolist()
+
+
+def unpack_peptides(packed:np.ndarray) -> np.ndarray:
+    """
+    This function unpacks an array of packed peptides back into sequences
+
+    Args:
+        packed (np.ndarray): A uint64 array with the shape (peptides, words)
+
+    Returns:
+        np.ndarray: The peptide sequences as a unicode array
+    """
+    shifts = (np.arange(RESIDUES_PER_WORD, 0, -1, dtype=np.uint64) - 1) * RESIDUE_BITS
+    residues = ((packed[:, :, None] >> shifts) & np.uint64(31)).astype(np.uint8).reshape(len(packed), packed.shape[1] * RESIDUES_PER_WORD)
+    # the letters are restored from their codes, the padding stays as null bytes which are dropped from the end of each fixed width string
+    letters = np.where(residues > 0, residues + 64, 0).astype(np.uint8)
+    return np.ascontiguousarray(letters).view(f"S{letters.shape[1]}").ravel().astype(str)
+
+
+def packed_residues(packed:np.ndarray, peptide_length:int) -> np.ndarray:
+    """
+    This function returns the residues of packed peptides of the same length as their ASCII character codes, without building strings
+
+    Args:
+        packed (np.ndarray): A uint64 array with the shape (peptides, words)
+        peptide_length (int): The length of the peptides
+
+    Returns:
+        np.ndarray: A uint8 array of character codes with the shape (peptides, length)
+    """
+    shifts = (np.arange(RESIDUES_PER_WORD, 0, -1, dtype=np.uint64) - 1) * RESIDUE_BITS
+    residues = ((packed[:, :, None] >> shifts) & np.uint64(31)).astype(np.uint8).reshape(len(packed), packed.shape[1] * RESIDUES_PER_WORD)[:, :peptide_length]
+    return residues + np.uint8(64)
+
+
+def packed_lengths(packed:np.ndarray) -> np.ndarray:
+    """
+    This function returns the length of each packed peptide, without unpacking it
+
+    Args:
+        packed (np.ndarray): A uint64 array with the shape (peptides, words)
+
+    Returns:
+        np.ndarray: The peptide lengths
+    """
+    shifts = (np.arange(RESIDUES_PER_WORD, 0, -1, dtype=np.uint64) - 1) * RESIDUE_BITS
+    return (((packed[:, :, None] >> shifts) & np.uint64(31)) > 0).reshape(len(packed), packed.shape[1] * RESIDUES_PER_WORD).sum(axis=1)
+
+
+# Peptide sequences are also encoded as arrays of amino acid ids, which the peptide index, the peptide scoring and the core motifs share, using
+# this lookup table
+
+def encoding_table(amino_acids:List[str]) -> np.ndarray:
+    """
+    This function returns a lookup table from the byte value of each character to the amino acid id, with -1 for characters which are not
+    amino acids
+
+    Args:
+        amino_acids (List[str]): The amino acids, in id order
+
+    Returns:
+        np.ndarray: An int8 array of 256 amino acid ids
+    """
+    table = np.full(256, -1, dtype=np.int8)
+    for amino_acid_id, amino_acid in enumerate(amino_acids):
+        table[ord(amino_acid)] = amino_acid_id
+        table[ord(amino_acid.lower())] = amino_acid_id
+    return table
@@ -0,0 +1,341 @@
+from typing import Dict, List, Optional, Tuple
+
+from pipeline import create_folder
+
+from helpers.files import write_json, read_json
+
+from packed_peptides import encoding_table, packed_lengths, unpack_peptides
+
+import argparse
+
+import numpy as np
+
+
+# The peptide index lets a peptide be looked up without loading peptides.json. The peptides of each length are held as a sorted array of fixed
+# width byte strings in a .npy file, which is memory mapped and binary searched, so an exact lookup only reads a few pages of the file. The
+# alleles for each peptide are held as one array of allele ids with an offset for each peptide, in the same order as the sorted peptides. Every
+# k-mer of every peptide is listed in an inverted index, which narrows substring searches and near-match searches down to a few candidates.
+
+# the length of the k-mers in the inverted index, with 20 amino acids there are 8000 3-mers
+KMER_LENGTH = 3
+
+
+def peptide_index_folder(warehouse_folder:str) -> str:
+    """
+    This function returns the folder for the peptide index within the warehouse folder
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+
+    Returns:
+        str: The path to the peptide index folder
+    """
+    return f"{warehouse_folder}/peptide_index"
+
+
+def kmer_codes(encoded:np.ndarray, amino_acid_count:int, kmer_length:int=KMER_LENGTH) -> np.ndarray:
+    """
+    This function returns the code of every k-mer of a set of encoded peptides of the same length
+
+    Args:
+        encoded (np.ndarray): The amino acid ids of the peptides with the shape (peptides, length)
+        amino_acid_count (int): The number of amino acids
+        kmer_length (int): The length of the k-mers
+
+    Returns:
+        np.ndarray: The k-mer codes with the shape (peptides, length - kmer_length + 1), -1 for k-mers with characters which are not amino acids
+    """
+    kmer_count = encoded.shape[1] - kmer_length + 1
+    codes = np.zeros((len(encoded), max(kmer_count, 0)), dtype=np.int64)
+    unknown = np.zeros(codes.shape, dtype=bool)
+    for offset in range(kmer_length):
+        window = encoded[:, offset:offset + kmer_count].astype(np.int64)
+        codes = codes * amino_acid_count + window
+        unknown |= window < 0
+    codes[unknown] = -1
+    return codes
+
+
+def build_peptide_index(warehouse_folder:str, peptides:np.ndarray, allele_peptides:Dict[str, np.ndarray], allele_labels:List[str],
+                        amino_acids:List[str], verbose:bool=False) -> int:
+    """
+    This function builds the peptide index from the peptides and allele peptides tables of the columnar warehouse
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        peptides (np.ndarray): The packed peptides, indexed by peptide id
+        allele_peptides (Dict[str, np.ndarray]): The allele_id and peptide_id columns of the allele peptides table
+        allele_labels (List[str]): The allele slug for each allele id
+        amino_acids (List[str]): The amino acids
+        verbose (bool): Whether to print verbose output
+
+    Returns:
+        int: The number of peptides indexed
+    """
+    folder = peptide_index_folder(warehouse_folder)
+    create_folder(folder, verbose)
+
+    # the alleles of each peptide id, as an array of allele ids with an offset for each peptide
+    pair_order = np.argsort(allele_peptides['peptide_id'], kind='stable')
+    peptide_allele_ids = allele_peptides['allele_id'][pair_order]
+    allele_counts = np.bincount(allele_peptides['peptide_id'], minlength=len(peptides))
+    allele_offsets = np.concatenate([[0], np.cumsum(allele_counts)])
+
+    # the peptides are ordered by length and then by sequence, so each length is a contiguous sorted block, packed peptides sort in sequence
+    # order word by word so they are sorted without unpacking them
+    lengths = packed_lengths(peptides)
+    peptide_order = np.lexsort(tuple(peptides[:, word] for word in reversed(range(peptides.shape[1]))) + (lengths,))
+    sorted_lengths = lengths[peptide_order]
+
+    # the allele ids are reordered to follow the sorted peptides
+    sorted_counts = allele_counts[peptide_order]
+    sorted_offsets = np.concatenate([[0], np.cumsum(sorted_counts)])
+    gather = np.repeat(allele_offsets[:-1][peptide_order] - sorted_offsets[:-1], sorted_counts) + np.arange(sorted_offsets[-1])
+    np.save(f"{folder}/allele_offsets.npy", sorted_offsets.astype(np.int64))
+    np.save(f"{folder}/allele_ids.npy", peptide_allele_ids[gather].astype(np.int32))
+
+    table = encoding_table(amino_acids)
+    length_blocks = {}
+    kmer_keys = []
+    for peptide_length in np.unique(sorted_lengths).tolist():
+        start = int(np.searchsorted(sorted_lengths, peptide_length, side='left'))
+        end = int(np.searchsorted(sorted_lengths, peptide_length, side='right'))
+        block = unpack_peptides(peptides[peptide_order[start:end]]).astype(f"S{peptide_length}")
+        np.save(f"{folder}/peptides_{peptide_length}.npy", block)
+        length_blocks[str(peptide_length)] = [start, end - start]
+
+        # every distinct k-mer of each peptide is paired with the position of the peptide in the sorted order
+        codes = kmer_codes(table[block.view(np.uint8).reshape(len(block), peptide_length)], len(amino_acids))
+        positions = np.broadcast_to(np.arange(start, end)[:, None], codes.shape)
+        known = codes >= 0
+        kmer_keys.append(codes[known] * len(peptides) + positions[known])
+
+    # the inverted index lists the peptides containing each k-mer, in sorted peptide order
+    kmer_keys = np.unique(np.concatenate(kmer_keys)) if kmer_keys else np.zeros(0, dtype=np.int64)
+    kmer_count = len(amino_acids) ** KMER_LENGTH
+    kmer_offsets = np.concatenate([[0], np.cumsum(np.bincount(kmer_keys // max(len(peptides), 1), minlength=kmer_count))])
+    np.save(f"{folder}/kmer_offsets.npy", kmer_offsets.astype(np.int64))
+    np.save(f"{folder}/kmer_postings.npy", (kmer_keys % max(len(peptides), 1)).astype(np.int32))
+
+    metadata = {
+        'peptide_count':len(peptides),
+        'lengths':length_blocks,
+        'alleles':list(allele_labels),
+        'amino_acids':list(amino_acids),
+        'kmer_length':KMER_LENGTH
+    }
+    write_json(f"{folder}/index.json", metadata, pretty=True)
+    return len(peptides)
+
+
+class PeptideIndex():
+    """
+    This class looks up peptides in the peptide index, reading only the parts of the index files each lookup needs
+
+    Attributes:
+        folder (str): The path to the peptide index folder
+        metadata (Dict): The peptide count, the position of each length in the sorted order, the alleles, the amino acids and the k-mer length
+        table (np.ndarray): The lookup table from characters to amino acid ids
+        arrays (Dict[str, np.ndarray]): The memory mapped index arrays which have been used
+    """
+
+    def __init__(self, warehouse_folder:str):
+        self.folder = peptide_index_folder(warehouse_folder)
+        self.metadata = read_json(f"{self.folder}/index.json")
+        self.table = encoding_table(self.metadata['amino_acids'])
+        self.arrays = {}
+
+
+    def array(self, array_name:str) -> np.ndarray:
+        """
+        This function returns one of the index arrays, memory mapping it the first time it is used
+
+        Args:
+            array_name (str): The name of the .npy file without the extension
+
+        Returns:
+            np.ndarray: The memory mapped array
+        """
+        if array_name not in self.arrays:
+            self.arrays[array_name] = np.load(f"{self.folder}/{array_name}.npy", mmap_mode='r')
+        return self.arrays[array_name]
+
+
+    def block(self, peptide_length:int) -> Tuple[int, np.ndarray]:
+        """
+        This function returns the sorted peptides of a length, and the position of the first of them in the sorted order of all the peptides
+
+        Args:
+            peptide_length (int): The peptide length
+
+        Returns:
+            Tuple[int, np.ndarray]: The position of the block, and the memory mapped peptides, empty if there are no peptides of that length
+        """
+        if str(peptide_length) not in self.metadata['lengths']:
+            return 0, np.zeros(0, dtype=f"S{max(peptide_length, 1)}")
+        return self.metadata['lengths'][str(peptide_length)][0], self.array(f"peptides_{peptide_length}")
+
+
+    def alleles(self, position:int) -> List[str]:
+        """
+        This function returns the alleles which present a peptide
+
+        Args:
+            position (int): The position of the peptide in the sorted order
+
+        Returns:
+            List[str]: The allele slugs
+        """
+        allele_offsets = self.array('allele_offsets')
+        allele_ids = self.array('allele_ids')[allele_offsets[position]:allele_offsets[position + 1]]
+        return [self.metadata['alleles'][allele_id] for allele_id in allele_ids.tolist()]
+
+
+    def exact(self, peptide:str) -> Optional[List[str]]:
+        """
+        This function returns the alleles which present a peptide
+
+        Args:
+            peptide (str): The peptide sequence
+
+        Returns:
+            Optional[List[str]]: The allele slugs, or None if the peptide is not in the index
+        """
+        peptide = peptide.upper()
+        start, block = self.block(len(peptide))
+        key = peptide.encode('ascii', 'replace')
+        i = int(np.searchsorted(block, key))
+        if i < len(block) and block[i] == key:
+            return self.alleles(start + i)
+        return None
+
+
+    def candidates(self, kmers:List[str]) -> np.ndarray:
+        """
+        This function returns the positions of the peptides which contain all of a set of k-mers
+
+        Args:
+            kmers (List[str]): The k-mers
+
+        Returns:
+            np.ndarray: The positions of the peptides in the sorted order
+        """
+        kmer_offsets = self.array('kmer_offsets')
+        kmer_postings = self.array('kmer_postings')
+        encoded = self.table[np.frombuffer(''.join(kmers).encode('ascii', 'replace'), dtype=np.uint8)].reshape(len(kmers), -1)
+        codes = kmer_codes(encoded, len(self.metadata['amino_acids']))[:, 0]
+        if (codes < 0).any():
+            return np.zeros(0, dtype=np.int32)
+        # the posting lists are intersected from the shortest up, so the candidates shrink as fast as possible
+        postings = sorted((kmer_postings[kmer_offsets[code]:kmer_offsets[code + 1]] for code in set(codes.tolist())), key=len)
+        positions = np.asarray(postings[0])
+        for posting in postings[1:]:
+            positions = np.intersect1d(positions, posting, assume_unique=True)
+        return positions
+
+
+    def sequences(self, positions:np.ndarray) -> List[str]:
+        """
+        This function returns the sequences of peptides from their positions in the sorted order
+
+        Args:
+            positions (np.ndarray): The positions of the peptides
+
+        Returns:
+            List[str]: The peptide sequences
+        """
+        sequences = []
+        for peptide_length, (start, count) in self.metadata['lengths'].items():
+            in_block = positions[(positions >= start) & (positions < start + count)]
+            if len(in_block):
+                sequences.extend(self.array(f"peptides_{peptide_length}")[in_block - start].astype(str).tolist())
+        return sequences
+
+
+    def substring(self, query:str, limit:Optional[int]=None) -> Dict[str, List[str]]:
+        """
+        This function returns the peptides which contain a sequence, for example a binding core, and the alleles which present them
+
+        Args:
+            query (str): The sequence to search for, at least as long as the k-mers of the index
+            limit (Optional[int]): The largest number of peptides to return
+
+        Returns:
+            Dict[str, List[str]]: The alleles for each peptide which contains the sequence, in length and then sequence order
+        """
+        query = query.upper()
+        kmer_length = self.metadata['kmer_length']
+        if len(query) < kmer_length:
+            raise ValueError(f"Substring searches need at least {kmer_length} amino acids, '{query}' is too short")
+        positions = np.sort(self.candidates([query[i:i + kmer_length] for i in range(len(query) - kmer_length + 1)]))
+        matches = {}
+        # the k-mers can be in a different order in a candidate, so each candidate is checked for the whole sequence
+        for position, sequence in zip(positions.tolist(), self.sequences(positions)):
+            if query in sequence:
+                matches[sequence] = self.alleles(position)
+                if limit and len(matches) >= limit:
+                    break
+        return matches
+
+
+    def neighbours(self, peptide:str, max_distance:int=1) -> List[Tuple[str, int, List[str]]]:
+        """
+        This function returns the peptides of the same length which differ from a peptide at no more than max_distance positions
+
+        If a peptide differs at no more than d positions, at least one of d + 1 segments of the query must match it exactly. When every segment
+        is at least as long as the k-mers, the peptides holding the first k-mer of a segment are the only candidates, otherwise every peptide of
+        that length is compared.
+
+        Args:
+            peptide (str): The peptide sequence
+            max_distance (int): The largest number of positions at which a neighbour can differ
+
+        Returns:
+            List[Tuple[str, int, List[str]]]: Each neighbour, the number of positions at which it differs and its alleles, closest first
+        """
+        peptide = peptide.upper()
+        peptide_length = len(peptide)
+        start, block = self.block(peptide_length)
+        if not len(block):
+            return []
+        kmer_length = self.metadata['kmer_length']
+        segment_length = peptide_length // (max_distance + 1)
+
+        if segment_length >= kmer_length:
+            segment_starts = [i * segment_length for i in range(max_distance + 1)]
+            positions = np.unique(np.concatenate([self.candidates([peptide[i:i + kmer_length]]) for i in segment_starts]))
+            positions = positions[(positions >= start) & (positions < start + len(block))] - start
+        else:
+            positions = np.arange(len(block))
+
+        query = np.frombuffer(peptide.encode('ascii', 'replace'), dtype=np.uint8)
+        rows = np.asarray(block[positions]).view(np.uint8).reshape(len(positions), peptide_length)
+        distances = (rows != query).sum(axis=1)
+        close = np.flatnonzero(distances <= max_distance)
+        close = close[np.lexsort((positions[close], distances[close]))]
+        return [(block[positions[i]].decode('ascii'), int(distances[i]), self.alleles(start + int(positions[i]))) for i in close.tolist()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Looks up the alleles which present a peptide, or peptides which contain it or are close to it.')
+    parser.add_argument('peptides', nargs='+', help='the peptides to look up')
+    parser.add_argument('-w', '--warehouse', default='output/motifs', help='the motifs folder of the pipeline output (output/motifs is the default)')
+    parser.add_argument('-s', '--substring', action='store_true', help='find the peptides which contain each peptide, e.g. a binding core')
+    parser.add_argument('-d', '--distance', type=int, default=0, help='also find peptides which differ at up to this many positions (0 is the default)')
+    parser.add_argument('-l', '--limit', type=int, default=50, help='the largest number of substring matches to list (50 is the default)')
+    args = parser.parse_args()
+
+    index = PeptideIndex(args.warehouse)
+    for peptide in args.peptides:
+        if args.substring:
+            for sequence, alleles in index.substring(peptide, args.limit).items():
+                print (f"{peptide}\t{sequence}\t{','.join(alleles)}")
+        elif args.distance:
+            for sequence, distance, alleles in index.neighbours(peptide, args.distance):
+                print (f"{peptide}\t{sequence}\t{distance}\t{','.join(alleles)}")
+        else:
+            alleles = index.exact(peptide)
+            print (f"{peptide}\t{','.join(alleles) if alleles is not None else 'not found'}")
+
+if __name__ == '__main__':
+    main()
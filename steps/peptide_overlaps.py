@@ -0,0 +1,113 @@
+from typing import Dict, List
+
+import numpy as np
+import scipy.sparse
+
+
+# The peptides shared between alleles are found from the allele by peptide incidence matrix, which has a 1 where an allele presents a peptide.
+# Multiplying the matrix by its transpose gives the number of peptides every pair of alleles share in one sparse product, and summing its columns
+# gives the number of alleles presenting each peptide, so there are no loops over pairs of alleles or over peptides.
+
+
+def allele_locus(allele_slug:str) -> str:
+    """
+    This function returns the locus of an allele from its slug
+
+    Args:
+        allele_slug (str): The slugified allele number, e.g. hla_a_02_01
+
+    Returns:
+        str: The locus in lower case, the second part of the slug, e.g. a for hla_a_02_01
+    """
+    return allele_slug.split('_')[1]
+
+
+def incidence_matrix(allele_peptides:Dict[str, np.ndarray], allele_count:int, peptide_count:int) -> scipy.sparse.csr_matrix:
+    """
+    This function builds the allele by peptide incidence matrix from the allele peptides table of the columnar warehouse
+
+    Args:
+        allele_peptides (Dict[str, np.ndarray]): The allele_id and peptide_id columns of the allele peptides table
+        allele_count (int): The number of alleles, which is the number of rows
+        peptide_count (int): The number of peptides, which is the number of columns
+
+    Returns:
+        scipy.sparse.csr_matrix: A uint8 matrix with the shape (alleles, peptides), 1 where the allele presents the peptide
+    """
+    data = np.ones(len(allele_peptides['allele_id']), dtype=np.uint8)
+    incidence = scipy.sparse.csr_matrix((data, (allele_peptides['allele_id'], allele_peptides['peptide_id'])), shape=(allele_count, peptide_count))
+    # a pair listed more than once would be summed into a count (which could also wrap around in uint8), so every entry is set back to 1
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    return incidence
+
+
+def shared_peptide_counts(incidence:scipy.sparse.csr_matrix) -> scipy.sparse.csr_matrix:
+    """
+    This function returns the number of peptides shared by every pair of alleles
+
+    Args:
+        incidence (scipy.sparse.csr_matrix): The allele by peptide incidence matrix
+
+    Returns:
+        scipy.sparse.csr_matrix: An int64 matrix with the shape (alleles, alleles), the diagonal holds the number of peptides of each allele
+    """
+    # the counts are summed as int64, as the uint8 incidence values would overflow
+    incidence = incidence.astype(np.int64)
+    return (incidence @ incidence.T).tocsr()
+
+
+def allele_overlaps(shared:scipy.sparse.csr_matrix) -> Dict[str, np.ndarray]:
+    """
+    This function returns the shared peptide count and Jaccard similarity of every pair of alleles which share at least one peptide
+
+    Each pair is listed once, with the lower allele id first
+
+    Args:
+        shared (scipy.sparse.csr_matrix): The shared peptide counts from shared_peptide_counts
+
+    Returns:
+        Dict[str, np.ndarray]: The allele_id, other_allele_id, shared_peptides and jaccard columns, ordered by allele_id and then other_allele_id
+    """
+    pairs = scipy.sparse.triu(shared, k=1).tocoo()
+    order = np.lexsort((pairs.col, pairs.row))
+    allele_ids, other_allele_ids, shared_peptides = pairs.row[order], pairs.col[order], pairs.data[order]
+    # the Jaccard similarity is the shared peptides over the peptides of either allele, which is both counts less the shared peptides
+    peptide_counts = shared.diagonal()
+    union = peptide_counts[allele_ids] + peptide_counts[other_allele_ids] - shared_peptides
+    return {
+        'allele_id':allele_ids.astype(np.int32),
+        'other_allele_id':other_allele_ids.astype(np.int32),
+        'shared_peptides':shared_peptides.astype(np.int64),
+        'jaccard':(shared_peptides / union).astype(np.float64)
+    }
+
+
+def peptide_promiscuity(incidence:scipy.sparse.csr_matrix, allele_loci:List[str]) -> Dict[str, np.ndarray]:
+    """
+    This function returns the number of alleles and loci presenting each peptide, and ranks the peptides by them
+
+    Args:
+        incidence (scipy.sparse.csr_matrix): The allele by peptide incidence matrix
+        allele_loci (List[str]): The locus of each allele, e.g. A, B or C
+
+    Returns:
+        Dict[str, np.ndarray]: The peptide_id, allele_count, locus_count and promiscuity_rank columns, ordered by peptide id. The most promiscuous
+        peptide has rank 1, peptides presented by the same number of alleles are ranked by the number of loci and then by peptide id
+    """
+    allele_counts = np.asarray(incidence.sum(axis=0, dtype=np.int64)).ravel()
+    # a locus by allele indicator matrix turns the allele rows into locus rows, so the loci of each peptide are counted in one more product
+    loci, locus_ids = np.unique(np.array(allele_loci, dtype=str), return_inverse=True)
+    locus_indicator = scipy.sparse.csr_matrix((np.ones(len(locus_ids), dtype=np.int64), (locus_ids, np.arange(len(locus_ids)))), shape=(len(loci), incidence.shape[0]))
+    locus_counts = np.asarray(((locus_indicator @ incidence.astype(np.int64)) > 0).sum(axis=0)).ravel()
+
+    peptide_ids = np.arange(incidence.shape[1])
+    order = np.lexsort((peptide_ids, -locus_counts, -allele_counts))
+    ranks = np.empty(len(order), dtype=np.int32)
+    ranks[order] = np.arange(1, len(order) + 1)
+    return {
+        'peptide_id':peptide_ids.astype(np.int32),
+        'allele_count':allele_counts.astype(np.int32),
+        'locus_count':locus_counts.astype(np.int32),
+        'promiscuity_rank':ranks
+    }
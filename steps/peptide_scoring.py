@@ -0,0 +1,227 @@
+from typing import Dict, Iterator, List, TextIO, Tuple
+
+from warehouse import read_table, read_dictionary
+from packed_peptides import encoding_table
+
+import argparse
+import time
+
+import numpy as np
+
+
+# Peptides are scored against the log-odds matrices built by build_scoring_matrices. Each peptide is encoded as an array of amino acid ids, and
+# a batch of peptides of the same length is scored against every allele at once by looking up the scores of the amino acid at each position
+# and adding them up, so the work is a handful of vectorised gathers per position rather than a loop over peptides and alleles.
+
+
+class ScoringMatrices():
+    """
+    This class holds the log-odds scoring matrices for every allele and peptide length
+
+    Attributes:
+        amino_acids (List[str]): The amino acids which label the last axis of the matrices
+        peptide_lengths (np.ndarray): The peptide length of each matrix
+        allele_ids (np.ndarray): The allele id of each matrix
+        allele_labels (np.ndarray): The allele slug for each allele id
+        matrices (np.ndarray): The scoring matrices, padded with zeros to the longest peptide length
+        loaded (Dict[int, Tuple[np.ndarray, np.ndarray]]): The alleles and rearranged matrices for each peptide length which has been used
+    """
+
+    def __init__(self, warehouse_folder:str):
+        table = read_table(warehouse_folder, 'scoring_matrices', ['allele_id', 'peptide_length', 'matrix'])
+        self.amino_acids = read_dictionary(warehouse_folder, 'scoring_matrices', 'matrix').tolist()
+        self.peptide_lengths = table['peptide_length']
+        self.allele_ids = table['allele_id']
+        self.allele_labels = read_dictionary(warehouse_folder, 'scoring_matrices', 'allele_id')
+        self.matrices = table['matrix']
+        self.loaded = {}
+
+
+    def for_length(self, peptide_length:int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        This function returns the alleles and scoring matrices for a peptide length
+
+        Args:
+            peptide_length (int): The peptide length
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The allele labels, and the scoring matrices rearranged to the shape (length, amino acids, alleles) so that
+            looking up an amino acid at a position gives a contiguous row of scores for every allele
+        """
+        if peptide_length not in self.loaded:
+            rows = np.flatnonzero(self.peptide_lengths == peptide_length)
+            matrices = self.matrices[rows, :peptide_length]
+            self.loaded[peptide_length] = (self.allele_labels[self.allele_ids[rows]], np.ascontiguousarray(matrices.transpose(1, 2, 0)))
+        return self.loaded[peptide_length]
+
+
+def encode_peptides(peptides:List[str], table:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function encodes peptides of the same length into an array of amino acid ids
+
+    Args:
+        peptides (List[str]): The peptide sequences, all the same length
+        table (np.ndarray): The lookup table from encoding_table
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The amino acid ids with the shape (peptides, length), and whether each peptide is made only of known amino
+        acids
+    """
+    peptide_length = len(peptides[0])
+    encoded = table[np.frombuffer(''.join(peptides).encode('ascii', 'replace'), dtype=np.uint8)].reshape(len(peptides), peptide_length)
+    return encoded, (encoded >= 0).all(axis=1)
+
+
+def score_encoded(encoded:np.ndarray, matrices:np.ndarray) -> np.ndarray:
+    """
+    This function scores a batch of encoded peptides against every allele
+
+    Args:
+        encoded (np.ndarray): The amino acid ids of the peptides with the shape (peptides, length)
+        matrices (np.ndarray): The scoring matrices with the shape (length, amino acids, alleles)
+
+    Returns:
+        np.ndarray: The score in bits of each peptide for each allele, with the shape (peptides, alleles)
+    """
+    # the scores are built up one position at a time, so the largest array held is (peptides, alleles)
+    scores = matrices[0][encoded[:, 0]]
+    for position in range(1, encoded.shape[1]):
+        scores += matrices[position][encoded[:, position]]
+    return scores
+
+
+def top_alleles(scores:np.ndarray, top:int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function returns the highest scoring alleles for each peptide, in descending order of score
+
+    Args:
+        scores (np.ndarray): The scores with the shape (peptides, alleles)
+        top (int): The number of alleles to return for each peptide
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The allele indexes and scores with the shape (peptides, top)
+    """
+    top = min(top, scores.shape[1])
+    # the top alleles are partitioned out before sorting, so only top scores are sorted for each peptide
+    indexes = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+    top_scores = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(indexes, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def read_peptide_batches(f:TextIO, batch_size:int=100000) -> Iterator[List[str]]:
+    """
+    This function reads peptides from a file a batch at a time, so files of any size can be scored in a fixed amount of memory. The batches hold
+    roughly batch_size peptides.
+
+    The file has one peptide per line, or the peptide as the first tab or comma separated column. Blank lines and lines starting with # are
+    skipped.
+
+    Args:
+        f (TextIO): The open peptide file
+        batch_size (int): The rough number of peptides in each batch
+
+    Yields:
+        List[str]: The peptides in each batch, in file order
+    """
+    while True:
+        # the lines are read a block at a time, which is much faster than reading them one by one, a line holding a nonamer is 10 characters
+        lines = f.readlines(batch_size * 10)
+        if not lines:
+            break
+        batch = [line.split('\t', 1)[0].split(',', 1)[0].strip().upper() for line in lines]
+        batch = [peptide for peptide in batch if peptide and not peptide.startswith('#')]
+        if batch:
+            yield batch
+
+
+def score_peptides(scoring_matrices:ScoringMatrices, peptides:List[str], top:int=3) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function scores a batch of peptides against every allele with a motif of the same length
+
+    Peptides are grouped by length and each group is scored at once. Peptides of a length with no scoring matrices, or with characters which are
+    not amino acids, have no alleles.
+
+    Args:
+        scoring_matrices (ScoringMatrices): The scoring matrices
+        peptides (List[str]): The peptide sequences
+        top (int): The number of alleles to return for each peptide
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The highest scoring alleles for each peptide in descending order of score, with the shape (peptides, top),
+        and their scores, which are empty strings and NaN for peptides with fewer alleles
+    """
+    table = encoding_table(scoring_matrices.amino_acids)
+    alleles = np.full((len(peptides), top), '', dtype=scoring_matrices.allele_labels.dtype)
+    scores = np.full((len(peptides), top), np.nan, dtype=np.float32)
+    lengths = np.fromiter(map(len, peptides), dtype=np.int64, count=len(peptides))
+    for peptide_length in np.unique(lengths).tolist():
+        allele_labels, matrices = scoring_matrices.for_length(peptide_length)
+        if not len(allele_labels):
+            continue
+        indexes = np.flatnonzero(lengths == peptide_length)
+        encoded, valid = encode_peptides([peptides[i] for i in indexes], table)
+        indexes, encoded = indexes[valid], encoded[valid]
+        if not len(indexes):
+            continue
+        allele_indexes, allele_scores = top_alleles(score_encoded(encoded, matrices), top)
+        alleles[indexes, :allele_indexes.shape[1]] = allele_labels[allele_indexes]
+        scores[indexes, :allele_scores.shape[1]] = allele_scores
+    return alleles, scores
+
+
+def score_peptide_file(warehouse_folder:str, input_filepath:str, output_filepath:str, top:int=3, batch_size:int=100000) -> Dict:
+    """
+    This function scores every peptide in a file against every allele, and writes the highest scoring alleles for each peptide to a tab separated
+    file with a row for each peptide, in input order
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        input_filepath (str): The path to the peptide file
+        output_filepath (str): The path to the output file
+        top (int): The number of alleles to return for each peptide
+        batch_size (int): The number of peptides scored at once
+
+    Returns:
+        Dict: The number of peptides read and scored, and the time taken
+    """
+    scoring_matrices = ScoringMatrices(warehouse_folder)
+    peptides_read = 0
+    peptides_scored = 0
+    start_time = time.perf_counter()
+    with open(input_filepath, 'r') as input_file, open(output_filepath, 'w') as output_file:
+        header = ['peptide'] + [f"{label}_{rank}" for rank in range(1, top + 1) for label in ['allele_slug', 'score']]
+        output_file.write('\t'.join(header) + '\n')
+        for batch in read_peptide_batches(input_file, batch_size):
+            alleles, scores = score_peptides(scoring_matrices, batch, top)
+            # the rows are built a column at a time, the scores of missing alleles are left empty
+            columns = [batch]
+            for rank in range(alleles.shape[1]):
+                columns.append(alleles[:, rank].tolist())
+                columns.append(['' if score != score else f"{score:.3f}" for score in scores[:, rank].tolist()])
+            output_file.write('\n'.join(map('\t'.join, zip(*columns))) + '\n')
+            peptides_read += len(batch)
+            peptides_scored += int(np.count_nonzero(alleles[:, 0]))
+    seconds = time.perf_counter() - start_time
+    return {
+        'peptides_read':peptides_read,
+        'peptides_scored':peptides_scored,
+        'seconds':round(seconds, 3),
+        'peptides_per_second':round(peptides_read / seconds) if seconds else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scores peptides against the motif of every allele, and lists the highest scoring alleles for each peptide.')
+    parser.add_argument('input', help='a file with one peptide per line')
+    parser.add_argument('output', help='the tab separated file to write the scores to')
+    parser.add_argument('-w', '--warehouse', default='output/motifs', help='the motifs folder of the pipeline output (output/motifs is the default)')
+    parser.add_argument('-t', '--top', type=int, default=3, help='the number of alleles to list for each peptide (3 is the default)')
+    parser.add_argument('-b', '--batch-size', type=int, default=100000, help='the number of peptides to score at once (100000 is the default)')
+    args = parser.parse_args()
+
+    summary = score_peptide_file(args.warehouse, args.input, args.output, args.top, args.batch_size)
+    print (f"Scored {summary['peptides_scored']} of {summary['peptides_read']} peptides in {summary['seconds']}s")
+
+if __name__ == '__main__':
+    main()
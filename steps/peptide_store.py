@@ -0,0 +1,284 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import sys
+
+from packed_peptides import pack_peptide, unpack_peptide, codes_to_array, word_count, unpack_peptides, packed_codes
+
+import numpy as np
+
+
+class PeptideStore():
+    """
+    This class holds the peptides bound by each allele and the alleles which bind each peptide
+
+    The peptides for each allele are held in dictionaries used as ordered sets (the values are always None), so membership checks are constant 
+    time and insertion order is preserved for output. The peptides are packed into integers by pack_peptide, which take around half the memory
+    of the sequence strings, and are only turned back into sequences for output. Most peptides are bound by one or two alleles, so the alleles
+    for each peptide are held as a tuple of interned allele numbers rather than a dictionary, which is around a quarter of the size.
+
+    Attributes:
+        alleles (Dict[str, Dict[str, Dict[int, None]]]): The packed peptides for each allele, keyed by allele number and then peptide length
+        peptides (Dict[int, Tuple[str, ...]]): The alleles for each peptide in the order they were added, keyed by packed peptide
+    """
+
+    def __init__(self):
+        self.alleles = {}
+        self.peptides = {}
+
+
+    def add(self, allele_number:str, peptide:str, peptide_length:str) -> bool:
+        """
+        This function adds the peptide to the allele and the allele to the peptide
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide (str): The peptide sequence
+            peptide_length (str): The peptide length
+
+        Returns:
+            bool: Whether the peptide was new for this allele (and is not a duplicate)
+        """
+        peptide = pack_peptide(peptide)
+        # the allele number is interned, so every peptide bound by the allele shares one copy of it
+        allele_number = sys.intern(allele_number)
+
+        # if the allele number or peptide length are not already in the dictionary, add them
+        allele_peptides = self.alleles.setdefault(allele_number, {}).setdefault(peptide_length, {})
+        # add the peptide to the set of peptides for this allele and peptide length
+        if peptide in allele_peptides:
+            return False
+        allele_peptides[peptide] = None
+
+        # add the allele number to the alleles for this peptide
+        self.peptides[peptide] = self.peptides.get(peptide, ()) + (allele_number,)
+        return True
+
+
+    def remove(self, allele_number:str, peptide:str, peptide_length:str) -> bool:
+        """
+        This function removes the peptide from the allele and the allele from the peptide
+
+        Any allele, peptide length or peptide which is left with nothing in it is removed too, so the store is the same as if the peptide had
+        never been added
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide (str): The peptide sequence
+            peptide_length (str): The peptide length
+
+        Returns:
+            bool: Whether the peptide was in the store for this allele
+        """
+        peptide = pack_peptide(peptide)
+        allele_peptides = self.alleles.get(allele_number, {}).get(peptide_length, {})
+        if peptide not in allele_peptides:
+            return False
+        del allele_peptides[peptide]
+        if not allele_peptides:
+            del self.alleles[allele_number][peptide_length]
+        if not self.alleles[allele_number]:
+            del self.alleles[allele_number]
+
+        peptide_alleles = tuple(peptide_allele for peptide_allele in self.peptides[peptide] if peptide_allele != allele_number)
+        if peptide_alleles:
+            self.peptides[peptide] = peptide_alleles
+        else:
+            del self.peptides[peptide]
+        return True
+
+
+    def merge(self, other:'PeptideStore') -> List[Tuple[str,str]]:
+        """
+        This function merges the peptides and alleles from another store into this one
+
+        The other store is assumed to hold data which came after the data in this store, so the insertion order of the merged store is the same as if 
+        all the data had been added to a single store
+
+        Args:
+            other (PeptideStore): The store to merge into this one
+
+        Returns:
+            List[Tuple[str,str]]: The allele number and peptide pairs from the other store which were already in this store
+        """
+        duplicates = []
+        for allele_number, lengths in other.alleles.items():
+            this_allele = self.alleles.setdefault(allele_number, {})
+            for peptide_length, allele_peptides in lengths.items():
+                this_length = this_allele.setdefault(peptide_length, {})
+                for peptide in allele_peptides:
+                    if peptide in this_length:
+                        duplicates.append((allele_number, unpack_peptide(peptide)))
+                    else:
+                        this_length[peptide] = None
+        for peptide, peptide_alleles in other.peptides.items():
+            this_alleles = self.peptides.get(peptide, ())
+            self.peptides[peptide] = this_alleles + tuple(allele_number for allele_number in peptide_alleles if allele_number not in this_alleles)
+        return duplicates
+
+
+    def peptide_count(self, allele_number:str, peptide_length:str) -> int:
+        """
+        This function returns the number of unique peptides of a given length for an allele
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide_length (str): The peptide length
+
+        Returns:
+            int: The number of unique peptides
+        """
+        return len(self.alleles[allele_number][peptide_length])
+
+
+    def packed_peptides(self, peptides:Optional[List[int]]=None) -> np.ndarray:
+        """
+        This function returns the peptides in the store as an array of packed peptides, in insertion order
+
+        Args:
+            peptides (Optional[List[int]]): The packed peptides to return, or None for every peptide in the store
+
+        Returns:
+            np.ndarray: A uint64 array with the shape (peptides, words), wide enough for the longest peptide
+        """
+        peptides = self.peptides if peptides is None else peptides
+        max_length = max((int(peptide_length) for lengths in self.alleles.values() for peptide_length in lengths), default=0)
+        return codes_to_array(peptides, len(peptides), word_count(max_length))
+
+
+    def sequences(self, peptides:Optional[List[int]]=None) -> Dict[int, str]:
+        """
+        This function returns the sequence of each packed peptide, unpacking them all at once for output
+
+        Args:
+            peptides (Optional[List[int]]): The packed peptides to unpack, or None for every peptide in the store
+
+        Returns:
+            Dict[int, str]: The peptide sequence for each packed peptide
+        """
+        peptides = list(self.peptides) if peptides is None else peptides
+        if not peptides:
+            return {}
+        return dict(zip(peptides, unpack_peptides(self.packed_peptides(peptides)).tolist()))
+
+
+    def alleles_to_dict(self, allele_numbers:Optional[Set[str]]=None) -> Dict[str, Dict[str, List[str]]]:
+        """
+        This function returns the peptides for each allele in the shape used for alleles.json
+
+        Args:
+            allele_numbers (Optional[Set[str]]): The alleles to include, or None for every allele
+
+        Returns:
+            Dict[str, Dict[str, List[str]]]: The list of peptides for each allele and peptide length
+        """
+        alleles = {allele_number:lengths for allele_number, lengths in self.alleles.items() if allele_numbers is None or allele_number in allele_numbers}
+        # only the peptides of the alleles being returned are unpacked
+        sequences = self.sequences(None if allele_numbers is None else [peptide for lengths in alleles.values() for allele_peptides in lengths.values() for peptide in allele_peptides])
+        return {allele_number:{peptide_length:list(map(sequences.__getitem__, allele_peptides)) for peptide_length, allele_peptides in lengths.items()} for allele_number, lengths in alleles.items()}
+
+
+    def peptides_to_dict(self, peptides:Optional[List[int]]=None) -> Dict[str, List[str]]:
+        """
+        This function returns the alleles for each peptide in the shape used for peptides.json
+
+        Args:
+            peptides (Optional[List[int]]): The packed peptides to include, or None for every peptide in the store
+
+        Returns:
+            Dict[str, List[str]]: The list of alleles for each peptide
+        """
+        peptides = list(self.peptides) if peptides is None else peptides
+        sequences = self.sequences(peptides)
+        return {sequences[peptide]:list(self.peptides[peptide]) for peptide in peptides}
+
+
+    def to_columns(self, allele_ids:Dict[str, int]) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """
+        This function returns the peptides and the peptides for each allele as columns for the columnar warehouse
+
+        Args:
+            allele_ids (Dict[str, int]): The id for each allele number
+
+        Returns:
+            Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]: The columns of the peptides table, with the peptides packed, and of the allele 
+            peptides table
+        """
+        peptide_ids = {peptide:i for i, peptide in enumerate(self.peptides)}
+        allele_id_column = []
+        peptide_length_column = []
+        peptide_id_column = []
+        for allele_number, lengths in self.alleles.items():
+            for peptide_length, allele_peptides in lengths.items():
+                allele_id_column.extend([allele_ids[allele_number]] * len(allele_peptides))
+                peptide_length_column.extend([int(peptide_length)] * len(allele_peptides))
+                peptide_id_column.extend(map(peptide_ids.__getitem__, allele_peptides))
+        peptide_columns = {
+            'peptide':self.packed_peptides()
+        }
+        allele_peptide_columns = {
+            'allele_id':np.array(allele_id_column, dtype=np.int32),
+            'peptide_length':np.array(peptide_length_column, dtype=np.int16),
+            'peptide_id':np.array(peptide_id_column, dtype=np.int32)
+        }
+        return peptide_columns, allele_peptide_columns
+
+
+    def to_state(self, allele_ids:Dict[str, int], columns:Optional[Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]]=None) -> Dict[str, np.ndarray]:
+        """
+        This function returns the arrays the store is saved as between runs of the processing step
+
+        Args:
+            allele_ids (Dict[str, int]): The id for each allele number
+            columns (Optional[Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]]): The columns returned by to_columns for the same allele ids,
+                if they have been built already
+
+        Returns:
+            Dict[str, np.ndarray]: The packed peptides, the allele_id, peptide_length and peptide_id columns of every allele and peptide pair in
+            insertion order, and the allele ids of each peptide in the order they were added, held as one array with the offset of each peptide
+        """
+        peptide_columns, allele_peptide_columns = self.to_columns(allele_ids) if columns is None else columns
+        allele_counts = np.fromiter(map(len, self.peptides.values()), dtype=np.int64, count=len(self.peptides))
+        return {
+            'peptides':peptide_columns['peptide'],
+            **{f"pair_{column_name}":column for column_name, column in allele_peptide_columns.items()},
+            'peptide_allele_offsets':np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(allele_counts)]),
+            'peptide_allele_ids':np.array([allele_ids[allele_number] for peptide_alleles in self.peptides.values() for allele_number in peptide_alleles], dtype=np.int32)
+        }
+
+
+def load_peptide_store(state:Dict[str, np.ndarray], allele_numbers:List[str]) -> PeptideStore:
+    """
+    This function rebuilds a store from the arrays returned by to_state
+
+    Args:
+        state (Dict[str, np.ndarray]): The arrays the store was saved as
+        allele_numbers (List[str]): The allele number for each allele id
+
+    Returns:
+        PeptideStore: The store, with the same insertion order as the store which was saved
+    """
+    peptide_store = PeptideStore()
+    allele_numbers = [sys.intern(allele_number) for allele_number in allele_numbers]
+    codes = np.array(packed_codes(state['peptides']), dtype=object)
+
+    # the pairs are in runs of the same allele and peptide length, in the order they were added
+    pair_allele_ids = state['pair_allele_id']
+    pair_peptide_lengths = state['pair_peptide_length']
+    pair_peptide_ids = state['pair_peptide_id']
+    run_starts = np.flatnonzero((np.diff(pair_allele_ids, prepend=-1) != 0) | (np.diff(pair_peptide_lengths, prepend=-1) != 0))
+    run_bounds = np.append(run_starts, len(pair_peptide_ids)).tolist()
+    for start, end in zip(run_bounds[:-1], run_bounds[1:]):
+        allele_peptides = peptide_store.alleles.setdefault(allele_numbers[pair_allele_ids[start]], {})
+        allele_peptides[str(pair_peptide_lengths[start])] = dict.fromkeys(codes[pair_peptide_ids[start:end]].tolist())
+
+    # the tuples of alleles are built together for all the peptides with the same number of alleles, by zipping the first, second and later
+    # alleles of those peptides, as most peptides are bound by only one or two alleles
+    offsets = state['peptide_allele_offsets']
+    peptide_alleles = np.array(allele_numbers, dtype=object)[state['peptide_allele_ids']]
+    allele_counts = np.diff(offsets)
+    allele_tuples = np.empty(len(allele_counts), dtype=object)
+    for allele_count in np.unique(allele_counts).tolist():
+        rows = np.flatnonzero(allele_counts == allele_count)
+        allele_tuples[rows] = np.fromiter(zip(*(peptide_alleles[offsets[rows] + i].tolist() for i in range(allele_count))), dtype=object, count=len(rows))
+    peptide_store.peptides = dict(zip(codes.tolist(), allele_tuples.tolist()))
+    return peptide_store
@@ -0,0 +1,116 @@
+from typing import Any, Callable, Dict, List, Tuple
+
+from io import BytesIO
+import base64
+import multiprocessing
+
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
+
+
+# The pre-styled figure for each kind of plot, created once in each process and reused for every allele
+figure_templates = {}
+
+
+def use_headless_backend():
+    """
+    This function switches matplotlib to the non-interactive Agg backend, it is run when each rendering worker process starts
+    """
+    plt.switch_backend('Agg')
+
+
+def figure_template(template_name:str, style_function:Callable[[Figure, Axes], None], figsize:Tuple[float, float]) -> Tuple[Figure, Axes]:
+    """
+    This function returns the pre-styled figure and axes for a kind of plot, with anything plotted on it previously removed
+
+    The figure, its fonts, labels, tick styles and spines are set up the first time a template is used in a process, after that only the data 
+    is replaced for each plot.
+
+    Args:
+        template_name (str): The name of the template, e.g. 'logoplot'
+        style_function (Callable[[Figure, Axes], None]): The function which styles the figure and axes when the template is first created
+        figsize (Tuple[float, float]): The size of the figure in inches
+
+    Returns:
+        Tuple[Figure, Axes]: The figure and axes to plot on
+    """
+    if template_name not in figure_templates:
+        fig = Figure(figsize=figsize)
+        ax = fig.subplots()
+        style_function(fig, ax)
+        figure_templates[template_name] = (fig, ax)
+    fig, ax = figure_templates[template_name]
+
+    # remove the data plotted for the previous allele, and reset the data limits so the axes are scaled to the next plot only
+    for artist in list(ax.patches) + list(ax.lines) + list(ax.collections):
+        artist.remove()
+    ax.containers.clear()
+    ax.relim()
+    return fig, ax
+
+
+def write_plot_outputs(fig:Figure, output_stems:Dict[str, str]):
+    """
+    This function renders a figure once for each output format, and writes the files for each format from that render
+
+    The png is rendered into memory, and both the png file and its base64 encoded text file are written from that one buffer. The svg is written
+    without a date and with fixed element ids, so an unchanged plot gives an unchanged file.
+
+    Args:
+        fig (Figure): The figure to write
+        output_stems (Dict[str, str]): The path of the output files, without the file extension, for each format, e.g. {'png':..., 'svg':...}
+    """
+    for output_format, output_stem in output_stems.items():
+        buffer = BytesIO()
+        if output_format == 'svg':
+            with matplotlib.rc_context({'svg.hashsalt':'motifs'}):
+                fig.savefig(buffer, format='svg', metadata={'Date':None})
+        else:
+            fig.savefig(buffer, format=output_format)
+        with open(f"{output_stem}.{output_format}", 'wb') as f:
+            f.write(buffer.getbuffer())
+        # the png is also written as base64 encoded text, which can be embedded directly in a page
+        if output_format == 'png':
+            with open(f"{output_stem}.txt", 'w') as f:
+                f.write(base64.b64encode(buffer.getbuffer()).decode("ascii"))
+
+
+def plot_output_paths(output_stems:Dict[str, str]) -> List[str]:
+    """
+    This function returns the paths of the files written for a plot by write_plot_outputs
+
+    Args:
+        output_stems (Dict[str, str]): The path of the output files, without the file extension, for each format
+
+    Returns:
+        List[str]: The paths of the output files
+    """
+    output_paths = [f"{output_stem}.{output_format}" for output_format, output_stem in output_stems.items()]
+    if 'png' in output_stems:
+        output_paths.append(f"{output_stems['png']}.txt")
+    return output_paths
+
+
+def render_plots(render_function:Callable, tasks:List[Tuple], workers:int=1, figures_per_worker:int=50) -> List[Any]:
+    """
+    This function renders a set of plots, either serially or spread across a pool of worker processes
+
+    Worker processes use the headless Agg backend, which is also what matplotlib uses to write PNG files from the main process, so the output
+    is the same either way. Each worker is replaced after it has rendered figures_per_worker figures, which bounds the memory that matplotlib
+    can build up in a long lived process.
+
+    Args:
+        render_function (Callable): The function which renders a single plot, it must be defined at the top level of a module
+        tasks (List[Tuple]): The arguments for each call of the render function
+        workers (int): The number of worker processes, 1 renders the plots in the current process
+        figures_per_worker (int): The number of figures a worker process renders before it is replaced
+
+    Returns:
+        List[Any]: The return value of the render function for each task, in the same order as the tasks
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        return [render_function(*task) for task in tasks]
+    with multiprocessing.Pool(processes=min(workers, len(tasks)), initializer=use_headless_backend, maxtasksperchild=figures_per_worker) as pool:
+        return pool.starmap(render_function, tasks, chunksize=1)
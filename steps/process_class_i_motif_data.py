@@ -1,14 +1,23 @@
-from typing import Dict
-import requests
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import resource
+import os
+import sys
+
+import numpy as np
 
 from pipeline import create_folder
 
-from helpers.files import write_json
+from helpers.files import write_json, read_json
 
-alleles = {}
-peptides = {}
-amino_acid_distributions = {}
-peptide_length_distributions = {}
+from motif_accumulator import MotifAccumulator, is_current_state, load_accumulator, read_state_pairs
+from compilation_cache import CompilationCache, load_compilation_cache
+from warehouse import write_table, write_sparse_matrix, write_shards, columnar_folder, shards_folder
+from peptide_index import build_peptide_index, peptide_index_folder
+from incremental import file_fingerprints
+from packed_peptides import PEPTIDE_ENCODING, is_packable, pack_sequences, unpack_peptides, word_count
+from peptide_overlaps import incidence_matrix
 
 
 def slugify_hla_motif_atlas_allele(allele:str) -> str:
@@ -24,118 +33,293 @@ def slugify_hla_motif_atlas_allele(allele:str) -> str:
     return f"hla_{allele[0]}_{allele[1:3]}_{allele[3:]}".lower()
 
 
-def add_allele_and_peptide(allele_number:str, peptide:str, peptide_length:str) -> bool:
+def read_atlas_records(filepath:str, start:int=0, end:Optional[int]=None) -> Iterator[Tuple[str,str]]:
+    """
+    This function streams the allele and peptide from each data line of the MHC Motif Atlas peptide file
+
+    The file is read one line at a time so memory use does not grow with the size of the file. If a byte range is given, only the lines which
+    begin inside that range are read, so that a set of adjoining ranges covers every line exactly once
+
+    Args:
+        filepath (str): The path to the cached MHC Motif Atlas peptide file
+        start (int): The byte offset of the start of the range to read
+        end (Optional[int]): The byte offset of the end of the range to read, or None to read to the end of the file
+
+    Yields:
+        Tuple[str,str]: The allele name and peptide sequence for each data line
+    """
+    with open(filepath, 'rb') as f:
+        if start == 0:
+            # skip the header line
+            position = len(f.readline())
+        else:
+            # skip the rest of the line which started in the previous range
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            data = line.decode('utf-8').strip().split('\t')
+            # ignore any blank lines, e.g. at the end of the file
+            if len(data) < 2:
+                continue
+            yield data[0], data[1]
+
+
+def shard_byte_ranges(filepath:str, shard_count:int) -> List[Tuple[int,int]]:
     """
-    This function adds the allele number, peptide and peptide length to the relevant dictionary
+    This function splits a file into a number of adjoining byte ranges of roughly equal size
 
     Args:
-        allele_number (str): The slugified allele number
-        peptide (str): The peptide sequence
-        peptide_length (str): The peptide length
+        filepath (str): The path to the file
+        shard_count (int): The number of byte ranges to create
 
     Returns:
-        bool: Whether the peptide was added to the dictionary
-    """                    
-    # if the allele number is not in the dictionary, add it
-    if allele_number not in alleles:
-        alleles[allele_number] = {}
-    # if the peptide length is not in the part of the dictionary for this allele, add it
-    if peptide_length not in alleles[allele_number]:
-        alleles[allele_number][peptide_length] = []
-    # add the peptide to the list of peptides for this allele and peptide length
-    if peptide not in alleles[allele_number][peptide_length]:
-        alleles[allele_number][peptide_length].append(peptide)
-        return True
-    else:
-        return False
+        List[Tuple[int,int]]: The start and end byte offsets of each range
+    """
+    file_size = os.path.getsize(filepath)
+    boundaries = [file_size * i // shard_count for i in range(shard_count + 1)]
+    return [(boundaries[i], boundaries[i + 1]) for i in range(shard_count)]
 
 
-def add_peptide(peptide:str, allele_number:str):
+def peak_memory_mb() -> float:
     """
-    This function adds the peptide to the relevant dictionary
-    
+    This function returns the peak resident memory of the current process in megabytes
+
+    Returns:
+        float: The peak resident memory in megabytes
+    """
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return round(peak_memory / (1024 * 1024), 1)
+    return round(peak_memory / 1024, 1)
+
+
+def ingest_atlas_records(accumulator:MotifAccumulator, records:Iterator[Tuple[str,str]]) -> Tuple[Set[str], Set[str]]:
+    """
+    This function adds the human alleles and their peptides from a stream of atlas records to an accumulator
+
+    Lines whose peptide can not be packed, e.g. one with a lowercase or modified residue, are skipped and counted in the accumulator
+
     Args:
-        peptide (str): The peptide sequence
-        allele_number (str): The slugified allele number
+        accumulator (MotifAccumulator): The accumulator to add the peptides to
+        records (Iterator[Tuple[str,str]]): The allele name and peptide sequence for each data line
+
+    Returns:
+        Tuple[Set[str], Set[str]]: The alleles which had a new peptide added, and the peptides which were added to an allele
+    """
+    changed_alleles = set()
+    changed_peptides = set()
+    for allele, peptide in records:
+        # currently only capturing the human alleles and their peptides
+        if not 'H2' in allele:
+            allele_number = slugify_hla_motif_atlas_allele(allele)
+            if not is_packable(peptide):
+                accumulator.invalid_peptides += 1
+            elif accumulator.add(allele_number, peptide):
+                changed_alleles.add(allele_number)
+                changed_peptides.add(peptide)
+        accumulator.lines_processed += 1
+    return changed_alleles, changed_peptides
+
+
+def pair_keys(allele_ids:np.ndarray, packed:np.ndarray) -> np.ndarray:
     """
-    # if the peptide sequence is not in the dictionary, add it 
-    if peptide not in peptides:
-        peptides[peptide] = []
-    # add the allele number to the list of alleles for this peptide
-    if allele_number not in peptides[peptide]:
-        peptides[peptide].append(allele_number) 
-    pass
+    This function returns a key for each allele and packed peptide pair, which can be compared with numpy's set functions
 
+    Args:
+        allele_ids (np.ndarray): The allele id of each pair
+        packed (np.ndarray): The packed peptide of each pair, a uint64 array with the shape (pairs, words)
 
-def add_to_amino_acid_distribution(allele_number:str, peptide:str, peptide_length:str):
+    Returns:
+        np.ndarray: The keys, one fixed width byte string holding the allele id and the packed peptide of each pair
     """
-    This function adds the amino acid distribution for the peptide to the relevant dictionary
+    keys = np.ascontiguousarray(np.concatenate([allele_ids.astype(np.uint64)[:, None], packed], axis=1))
+    return keys.view(np.dtype((np.void, keys.shape[1] * keys.itemsize))).ravel()
+
+
+def apply_atlas_diff(accumulator:MotifAccumulator, records:Iterator[Tuple[str,str]], previous_pairs:Tuple[List[str], np.ndarray, np.ndarray]) -> Tuple[Set[str], Set[str]]:
+    """
+    This function updates an accumulator built from a previous version of the atlas file to match the current version
+
+    The allele and peptide pairs in the file are packed into an index of keys and compared with the index of the pairs saved with the 
+    accumulator, so only the pairs which are no longer in the file are removed and only the new pairs are added. The pairs which are in both
+    are never unpacked or added again.
 
     Args:
-        allele_number (str): The slugified allele number
-        peptide (str): The peptide sequence
-        peptide_length (str): The peptide length
-    """
-    if not allele_number in amino_acid_distributions:
-        amino_acid_distributions[allele_number] = {}
-    if not peptide_length in amino_acid_distributions[allele_number]:
-        amino_acid_distributions[allele_number][peptide_length] = {}
-
-    j = 1
-    for amino_acid in peptide:
-        position = str(j)
-        if not position in amino_acid_distributions[allele_number][peptide_length]:
-            amino_acid_distributions[allele_number][peptide_length][position] = {}
-        if not amino_acid in amino_acid_distributions[allele_number][peptide_length][position]:
-            amino_acid_distributions[allele_number][peptide_length][position][amino_acid] = {'count':0, 'percentage':None}
-        amino_acid_distributions[allele_number][peptide_length][position][amino_acid]['count'] += 1
-        j+=1     
-    pass
-
-
-def process_peptide_length_distribution(allele_number:str):
-    """
-    This function processes the peptide length distribution for the allele
-    
+        accumulator (MotifAccumulator): The accumulator built from the previous version of the file
+        records (Iterator[Tuple[str,str]]): The allele name and peptide sequence for each data line of the current version
+        previous_pairs (Tuple[List[str], np.ndarray, np.ndarray]): The allele numbers, and the allele id and packed peptide of each pair in the
+            accumulator, as returned by read_state_pairs
+
+    Returns:
+        Tuple[Set[str], Set[str]]: The alleles which had a peptide added or removed, and the peptides which were added to or removed from an allele
+    """
+    allele_numbers, previous_allele_ids, previous_peptides = previous_pairs
+    # the alleles keep the ids they have in the saved state, any new alleles are numbered after them
+    allele_ids = {allele_number:i for i, allele_number in enumerate(allele_numbers)}
+    atlas_allele_ids = {}
+
+    # the alleles and peptides in the current file, in file order
+    pair_allele_ids = []
+    pair_peptides = []
+    lines_processed = 0
+    invalid_peptides = 0
+    for allele, peptide in records:
+        # currently only capturing the human alleles and their peptides
+        if not 'H2' in allele:
+            if not is_packable(peptide):
+                invalid_peptides += 1
+            else:
+                if allele not in atlas_allele_ids:
+                    atlas_allele_ids[allele] = allele_ids.setdefault(slugify_hla_motif_atlas_allele(allele), len(allele_ids))
+                pair_allele_ids.append(atlas_allele_ids[allele])
+                pair_peptides.append(peptide)
+        lines_processed += 1
+    allele_numbers = list(allele_ids)
+
+    # both sets of pairs are packed to the same width and compared as keys
+    sequences = np.array(pair_peptides, dtype=bytes)
+    words = max(word_count(sequences.dtype.itemsize), previous_peptides.shape[1])
+    previous_peptides = np.pad(previous_peptides, ((0, 0), (0, words - previous_peptides.shape[1])))
+    atlas_keys = pair_keys(np.array(pair_allele_ids, dtype=np.int64), pack_sequences(sequences, words))
+    previous_keys = pair_keys(previous_allele_ids, previous_peptides)
+    is_removed = ~np.isin(previous_keys, atlas_keys)
+    is_added = ~np.isin(atlas_keys, previous_keys)
+
+    changed_alleles = set()
+    changed_peptides = set()
+    # only the removed pairs are unpacked, they are removed in the order they were added to the accumulator
+    for allele_id, peptide in zip(previous_allele_ids[is_removed].tolist(), unpack_peptides(previous_peptides[is_removed]).tolist()):
+        accumulator.remove(allele_numbers[allele_id], peptide)
+        changed_alleles.add(allele_numbers[allele_id])
+        changed_peptides.add(peptide)
+    # and the new pairs are added in file order
+    for i in np.flatnonzero(is_added).tolist():
+        allele_number = allele_numbers[pair_allele_ids[i]]
+        if accumulator.add(allele_number, pair_peptides[i]):
+            changed_alleles.add(allele_number)
+            changed_peptides.add(pair_peptides[i])
+    accumulator.lines_processed = lines_processed
+    accumulator.invalid_peptides = invalid_peptides
+    return changed_alleles, changed_peptides
+
+
+def atlas_snapshot(filepath:str, previous_snapshot:Optional[Dict]=None) -> Tuple[Dict, bool]:
+    """
+    This function records the size and content hash of the atlas file, and whether it is the previous version with lines appended
+
+    The file is hashed in a single pass, the hash of the part of the file the size of the previous version is checked against the previous
+    hash on the way through
+
     Args:
-        allele_number (str): The slugified allele number
-    """
-    # set a counter for the total number of peptides for this allele to 0
-    allele_peptide_count = 0
-    # create a dictionary for the peptide length distribution for this allele
-    peptide_length_distributions[allele_number] = {'total':0,'lengths':{}}
-    # iterate through the peptide lengths for this allele
-    for peptide_length in alleles[allele_number]:
-        # add the peptide length to the dictionary
-        peptide_length_distributions[allele_number]['lengths'][peptide_length] = {
-            'count':len(alleles[allele_number][peptide_length]),
-            'percentage':None
-        }
-        # add the number of peptides for this length to the total number of peptides for this allele
-        allele_peptide_count += len(alleles[allele_number][peptide_length])
-    # set the total number of peptides for this allele in the dictionary   
-    peptide_length_distributions[allele_number]['total'] = allele_peptide_count
-    # iterate through the peptide lengths for this allele
-    for peptide_length in peptide_length_distributions[allele_number]['lengths']:
-        this_length = peptide_length_distributions[allele_number]['lengths'][peptide_length]
-        # set the percentage of peptides for this length
-        this_length['percentage'] = this_length['count'] / allele_peptide_count * 100
-    pass
+        filepath (str): The path to the cached MHC Motif Atlas peptide file
+        previous_snapshot (Optional[Dict]): The snapshot of the version of the file processed last time
+
+    Returns:
+        Tuple[Dict, bool]: The snapshot of the file, and whether the previous version is the start of this version
+    """
+    digest = hashlib.sha256()
+    prefix_size = previous_snapshot['size'] if previous_snapshot else None
+    is_appended = False
+    position = 0
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            # split the chunk at the end of the previous version of the file, so the hash of that part can be checked
+            if prefix_size is not None and position < prefix_size <= position + len(chunk):
+                split = prefix_size - position
+                digest.update(chunk[:split])
+                # lines can only have been appended if the previous version ended with a complete line
+                is_appended = digest.hexdigest() == previous_snapshot['sha256'] and chunk[split - 1:split] == b'\n'
+                digest.update(chunk[split:])
+            else:
+                digest.update(chunk)
+            position += len(chunk)
+    return {'size':position, 'sha256':digest.hexdigest()}, is_appended
+
+
+def output_paths(output_folder:str, compilation_names:List[str]) -> List[str]:
+    """
+    This function returns the paths of the files and folders written by the processing step
+
+    Args:
+        output_folder (str): The path to the warehouse folder
+        compilation_names (List[str]): The names of the data compilations
+
+    Returns:
+        List[str]: The paths of the outputs, the columnar folder also holds tables written by later steps so only this step's tables are listed
+    """
+    tables = ['peptides', 'allele_peptides', 'amino_acid_distributions', 'peptide_length_distributions', 'allele_peptide_incidence']
+    paths = [f"{output_folder}/{compilation}.json" for compilation in compilation_names]
+    paths.append(f"{output_folder}/amino_acid_counts.npz")
+    paths.extend(f"{columnar_folder(output_folder)}/{table_name}.{extension}" for table_name in tables for extension in ['npz', 'json'])
+    paths.extend([shards_folder(output_folder), peptide_index_folder(output_folder)])
+    return paths
 
 
-def process_amino_acid_distribution(allele_number:str):
+def write_outputs(accumulator:MotifAccumulator, compilation_cache:CompilationCache, output_folder:str, compilation_names:List[str],
+                  changed_alleles:Optional[Set[str]], verbose:bool) -> Tuple[int, int, Dict[str, Dict[str, np.ndarray]]]:
     """
-    This function processes the amino acid distribution for the peptides bound by the allele
+    This function writes the data compilations, columnar tables, peptide index and shards built from the accumulator to the warehouse
 
     Args:
-        allele_number (str): The slugified allele number
+        accumulator (MotifAccumulator): The accumulator
+        compilation_cache (CompilationCache): The JSON text of the data compilations, updated from the accumulator
+        output_folder (str): The path to the warehouse folder
+        compilation_names (List[str]): The names of the data compilations
+        changed_alleles (Optional[Set[str]]): The alleles which have changed since the shards were last written, or None if every allele has
+        verbose (bool): Whether to print verbose output
+
+    Returns:
+        Tuple[int, int, Dict[str, Dict[str, np.ndarray]]]: The number of shards in the warehouse, the number of peptides indexed and the columns
+        of each table
     """
-    for peptide_length in amino_acid_distributions[allele_number]:
-        for position in amino_acid_distributions[allele_number][peptide_length]:
-            for amino_acid in amino_acid_distributions[allele_number][peptide_length][position]:
-                this_amino_acid = amino_acid_distributions[allele_number][peptide_length][position][amino_acid]
-                this_amino_acid['percentage'] = this_amino_acid['count'] / peptide_length_distributions[allele_number]['lengths'][peptide_length]['count'] * 100
-    pass
+    amino_acids = accumulator.amino_acid_counts.amino_acids
+
+    # write the files to the output directory
+    create_folder(output_folder, verbose)
+    for compilation in compilation_names:
+        compilation_cache.write(f"{output_folder}/{compilation}.json", compilation)
+    # the count tensor is also saved so that later steps can use the matrix directly
+    accumulator.amino_acid_counts.save(f"{output_folder}/amino_acid_counts.npz")
+
+    # the same data is written as columnar tables, which is the format the later steps read from
+    tables, dictionaries = accumulator.tables()
+    for table_name, columns in tables.items():
+        write_table(output_folder, table_name, columns, dictionaries, verbose)
+    # the allele by peptide incidence matrix is written alongside the tables, for the analyses of the peptides shared between alleles
+    incidence = incidence_matrix(tables['allele_peptides'], len(dictionaries['allele_id']), len(tables['peptides']['peptide']))
+    write_sparse_matrix(output_folder, 'allele_peptide_incidence', incidence, {'allele_id':dictionaries['allele_id']}, verbose)
+
+    # the peptide index lets a peptide, or peptides which contain it or are close to it, be looked up without loading peptides.json
+    indexed_peptides = build_peptide_index(output_folder, tables['peptides']['peptide'], tables['allele_peptides'], dictionaries['allele_id'], amino_acids, verbose)
+
+    # and as a shard for each allele and peptide length, for the steps which only need some of the alleles or lengths, only the shards for
+    # the alleles which have changed are rewritten
+    shard_count = write_shards(output_folder, accumulator.shards(changed_alleles), amino_acids, verbose, list(accumulator.peptide_store.alleles), changed_alleles)
+    return shard_count, indexed_peptides, tables
+
+
+def process_atlas_shard(filepath:str, start:int, end:int, amino_acids:List[str]) -> MotifAccumulator:
+    """
+    This function processes one byte range of the atlas file, it is run in a worker process when the step is run with more than one job
+
+    Args:
+        filepath (str): The path to the cached MHC Motif Atlas peptide file
+        start (int): The byte offset of the start of the range
+        end (int): The byte offset of the end of the range
+        amino_acids (List[str]): The list of amino acids
+
+    Returns:
+        MotifAccumulator: The accumulator for this byte range
+    """
+    accumulator = MotifAccumulator(amino_acids)
+    ingest_atlas_records(accumulator, read_atlas_records(filepath, start, end))
+    # count any queued peptides before the accumulator is sent back to the main process
+    accumulator.amino_acid_counts.flush()
+    return accumulator
 
 
 def process_class_i_motif_data(**kwargs) -> Dict[str,str]:
@@ -154,6 +338,11 @@ def process_class_i_motif_data(**kwargs) -> Dict[str,str]:
         force (bool): Whether to force the step to run ignoring any previous results.
         output_path (str): The path to the output directory.
         console (Console): A Rich console object for printing Rich output.
+        jobs (int): The number of worker processes to split the atlas file across (defaults to 1, processing the file serially).
+
+    If the step has run before, only the changes to the atlas file since then are applied to the saved counts. Lines appended to the file are
+    read on their own, any other change is applied as the difference between the allele and peptide pairs in the file and in the saved state.
+    If the file and the outputs are unchanged the step returns straight away. The force flag processes the whole file again.
     """
     config = kwargs['config']
     verbose = kwargs['verbose']
@@ -161,63 +350,101 @@ def process_class_i_motif_data(**kwargs) -> Dict[str,str]:
     output_path = kwargs['output_path']
     console = kwargs['console']
     function_name = kwargs['function_name']
+    jobs = int(kwargs.get('jobs') or 1)
 
     # open the cached dataset
     filename = config['CONSTANTS']['MHC_MOTIF_ATLAS_CLASS_I_FILENAME']    
     filepath = f"{config['PATHS']['TMP_PATH']}/{filename}"
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-    
-    
+    amino_acids = config['CONSTANTS']['AMINO_ACIDS']
 
-    # iterate through the lines and process the data (first round)
-    i = 0
-    for line in lines:
-        if i != 0:
-            data = line.strip().split('\t')
-            allele = data[0]
-            peptide = data[1]
-            peptide_length = str(len(peptide))
-
-            # currently only capturing the human alleles and their peptides
-            if not 'H2' in allele:
-                allele_number = slugify_hla_motif_atlas_allele(allele)
-                
-                # the add function returns true if the peptide was added to the allele dictionary (and is not a duplicate)
-                peptide_added = add_allele_and_peptide(allele_number, peptide, peptide_length)
-                
-                # if the peptide is unique
-                if peptide_added:
-                    # we can add the amino acids at each position of the peptide to the amino acid distribution
-                    add_to_amino_acid_distribution(allele_number, peptide, peptide_length)
-
-                # and add the peptide to the peptide dictionary
-                add_peptide(peptide, allele_number)
-
-                
-        i+=1 
-
-    # iterate through the data for the second time to turn counts into percentages
-    j = 0
-    for allele in alleles:
-
-        # for each allele we need to process the peptide length distribution and the amino acid distribution
-        process_peptide_length_distribution(allele)
-        process_amino_acid_distribution(allele)
-
-        # if the verbose flag is set, print the data for this allele
+    # the output folder holds the state saved by the previous run, which is updated with just the changes to the file where possible
+    output_folder = f"{output_path}/{config['PATHS']['PIPELINE_WAREHOUSE_FOLDER']}"
+    state_filepath = f"{output_folder}/ingest_state"
+    snapshot_filepath = f"{output_folder}/ingest_snapshot.json"
+    cache_filepath = f"{output_folder}/compilation_cache"
+
+    previous_snapshot = None
+    if not force and is_current_state(state_filepath) and os.path.exists(snapshot_filepath):
+        previous_snapshot = read_json(snapshot_filepath)
+        # a state saved with different amino acids, or with the peptides encoded differently, can not be updated
+        if previous_snapshot['amino_acids'] != amino_acids or previous_snapshot.get('peptide_encoding') != PEPTIDE_ENCODING:
+            previous_snapshot = None
+    snapshot, is_appended = atlas_snapshot(filepath, previous_snapshot)
+    snapshot['amino_acids'] = amino_acids
+    snapshot['peptide_encoding'] = PEPTIDE_ENCODING
+
+    compilation_names = config['CONSTANTS']['DATA_COMPILATIONS']
+    is_unchanged = previous_snapshot is not None and snapshot['sha256'] == previous_snapshot['sha256']
+    if is_unchanged and 'summary' in previous_snapshot and previous_snapshot.get('outputs') == file_fingerprints(output_paths(output_folder, compilation_names)):
+        # the file is unchanged and the outputs are as the last run left them, so there is nothing to do and the saved state is not even loaded
         if verbose:
+            print ("The MHC Motif Atlas file is unchanged since the last run, the outputs are up to date")
+        return {
+            **previous_snapshot['summary'],
+            'ingest_mode':'unchanged',
+            'changed_allele_count':0,
+            'jobs':jobs,
+            'peak_memory_mb':peak_memory_mb()
+        }
+
+    if is_unchanged:
+        # the file is unchanged but some of the outputs are missing or have been changed, so the saved state is used to write them all again
+        ingest_mode = 'unchanged'
+        accumulator = load_accumulator(state_filepath)
+        changed_alleles = changed_peptides = None
+    elif previous_snapshot and is_appended:
+        # lines have been added to the end of the file, so only the new lines are read
+        ingest_mode = 'appended'
+        accumulator = load_accumulator(state_filepath)
+        changed_alleles, changed_peptides = ingest_atlas_records(accumulator, read_atlas_records(filepath, previous_snapshot['size']))
+    elif previous_snapshot:
+        # the file has changed in some other way, so the pairs in the file are compared with the saved state and only the differences are applied
+        ingest_mode = 'diff'
+        accumulator = load_accumulator(state_filepath)
+        changed_alleles, changed_peptides = apply_atlas_diff(accumulator, read_atlas_records(filepath), read_state_pairs(state_filepath))
+    else:
+        ingest_mode = 'full'
+        if jobs > 1:
+            # split the file into byte ranges and process each in a worker process, the accumulators are merged in file order
+            # so the output is the same as processing the file serially
+            byte_ranges = shard_byte_ranges(filepath, jobs)
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                shards = executor.map(process_atlas_shard, [filepath] * jobs, [start for start, end in byte_ranges], [end for start, end in byte_ranges], [amino_acids] * jobs)
+                accumulator = next(shards)
+                for shard in shards:
+                    accumulator.merge(shard)
+        else:
+            # stream through the lines and process the data (first round)
+            accumulator = MotifAccumulator(amino_acids)
+            ingest_atlas_records(accumulator, read_atlas_records(filepath))
+
+        changed_alleles = changed_peptides = None
+
+    peptide_store = accumulator.peptide_store
+    lines_processed = accumulator.lines_processed
+
+    # the JSON text of the compilations is kept from the last run, only the entries of the changed alleles and peptides are built and encoded again
+    compilation_cache = CompilationCache() if changed_alleles is None else load_compilation_cache(cache_filepath, previous_snapshot['sha256'])
+    entries_encoded = compilation_cache.update(accumulator, changed_alleles, changed_peptides)
+
+    # if the verbose flag is set, print the data for each allele
+    if verbose:
+        # turn the counts into percentages, the amino acid counts are turned into percentages in a single pass over the count tensor
+        compilations = accumulator.allele_compilations()
+        amino_acid_distributions = compilations['amino_acid_distributions']
+        peptide_length_distributions = compilations['peptide_length_distributions']
+        for allele in peptide_store.alleles:
             console.print (allele)
             console.print (peptide_length_distributions[allele])  
             console.print (amino_acid_distributions[allele])
-        j+=1      
     
     # output some information on the output of the pipeline
     if verbose:
         # print some stats
-        print (f"Number of peptides in dataset: {len(lines) -1}")
-        print (f"Number of HLA alleles for which there is motif data: {len(alleles)}")
-        print (f"Number of unique peptides: {len(peptides)}")
+        print (f"Number of peptides in dataset: {lines_processed}")
+        print (f"Number of HLA alleles for which there is motif data: {len(peptide_store.alleles)}")
+        print (f"Number of unique peptides: {len(peptide_store.peptides)}")
+        print (f"Encoded the compilation entries of {entries_encoded['allele_entries_encoded']} alleles and {entries_encoded['peptide_blocks_encoded']} blocks of peptides")
 
         # print some example data
         console.print ('HLA-A*02:01 / P2')
@@ -225,19 +452,47 @@ def process_class_i_motif_data(**kwargs) -> Dict[str,str]:
         console.print ('HLA-A*02:01 / P9')
         console.print (amino_acid_distributions['hla_a_02_01']['9']['9'])
 
-    # write the files to the output directory
-    output_folder = f"{output_path}/{config['PATHS']['PIPELINE_WAREHOUSE_FOLDER']}"
-    create_folder(output_folder, verbose)
-    for compilation in config['CONSTANTS']['DATA_COMPILATIONS']:
-        filepath = f"{output_folder}/{compilation}.json"
-        write_json(filepath, eval(compilation))
+    tables = None
+    if changed_alleles is not None and not changed_alleles and 'summary' in previous_snapshot and previous_snapshot.get('outputs') == file_fingerprints(output_paths(output_folder, compilation_names)):
+        # no allele gained or lost a peptide, e.g. every new line was a duplicate, so the outputs written by the last run are still up to date
+        shard_count = previous_snapshot['summary']['shard_count']
+        indexed_peptides = previous_snapshot['summary']['indexed_peptides']
+    else:
+        shard_count, indexed_peptides, tables = write_outputs(accumulator, compilation_cache, output_folder, compilation_names, changed_alleles, verbose)
+
+    changed_alleles = set(peptide_store.alleles) if changed_alleles is None else changed_alleles
+
+    # save the state, the cached JSON text and the snapshot of the file they were built from for the next run. The snapshot records what the
+    # outputs looked like when they were written, so the next run can tell they are still in place without reading them
+    accumulator.save(state_filepath, tables)
+    compilation_cache.save(cache_filepath, snapshot['sha256'])
+    snapshot['summary'] = {
+        'allele_count':len(peptide_store.alleles),
+        'peptide_count':len(peptide_store.peptides),
+        'lines_processed':lines_processed,
+        'shard_count':shard_count,
+        'indexed_peptides':indexed_peptides,
+        # residues outside the amino acid list are not in the amino acid distributions, so the number left out is recorded
+        'unknown_residue_count':accumulator.amino_acid_counts.unknown_residues,
+        'invalid_peptide_count':accumulator.invalid_peptides
+    }
+    snapshot['outputs'] = file_fingerprints(output_paths(output_folder, compilation_names))
+    write_json(snapshot_filepath, snapshot, pretty=True)
+
 
+    if verbose and accumulator.invalid_peptides:
+        print (f"{accumulator.invalid_peptides} lines were skipped as their peptide has characters other than the capital letters A to Z")
+    if verbose and accumulator.amino_acid_counts.unknown_residues:
+        print (f"{accumulator.amino_acid_counts.unknown_residues} residues are not in the amino acid list and are left out of the amino acid distributions")
 
     # create the action log which will be included in the log file for this run of the pipeline
     action_log = {
-        'allele_count':len(alleles),
-        'peptide_count':len(peptides),
-        'lines_processed':len(lines)-1
+        **snapshot['summary'],
+        'ingest_mode':ingest_mode,
+        'changed_allele_count':len(changed_alleles),
+        **entries_encoded,
+        'jobs':jobs,
+        'peak_memory_mb':peak_memory_mb()
     }
     
     return action_log
\ No newline at end of file
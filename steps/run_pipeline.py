@@ -1,33 +1,66 @@
-from typing import Dict
+from typing import Any, Dict
 
 from pipeline import Pipeline
 
 from steps import steps
+from incremental import incremental_steps
+from scheduler import StepScheduler
 
+import argparse
+import toml
 
-def run_pipeline(**kwargs) -> Dict:
-    pipeline = Pipeline()
 
-    pipeline.load_steps(steps)
+def run_pipeline(max_workers:int=4, **kwargs) -> Dict:
+    pipeline = Pipeline()
 
-    #pipeline.run_step('1') # Download Class I data from the MHC Motif Atlas
-    #pipeline.run_step('2') # Process Class I data from the MHC Motif Atlas
-    #pipeline.run_step('3') # Create sorted amino acid distribution tables for each allele
-    #pipeline.run_step('4') # Create simplified motifs for each allele
-    #pipeline.run_step('5') # Create logoplots for each allele (for each length)
-    #pipeline.run_step('6') # Create peptide length distribution plots for each allele
-    pipeline.run_step('7') # Cluster motifs
-    #pipeline.run_step('8') # Create a table representation of the data for use in datasette
+    # each step only runs if the content of its inputs has changed since it last ran (or if the force flag is set)
+    # steps which don't depend on each other are run at the same time, up to max_workers at once
+    scheduler = StepScheduler(pipeline, incremental_steps(steps), max_workers=max_workers)
 
-    #pipeline.run_step('9') # Create text descriptions for each allele - not yet developed
+    scheduler.run([
+        '1', # Download Class I data from the MHC Motif Atlas
+        '2', # Process Class I data from the MHC Motif Atlas
+        '3', # Create sorted amino acid distribution tables for each allele
+        '4', # Create simplified motifs for each allele
+        '5', # Create logoplots for each allele (for each length)
+        '6', # Create peptide length distribution plots for each allele
+        '7', # Cluster motifs
+        '8', # Create a table representation of the data for use in datasette
+        '11', # Build scoring matrices for scoring peptides against each allele
+        '12', # Find the peptides shared between alleles and rank the peptides by promiscuity
+        '13', # Build core motifs for each allele from its peptides of every length
+        #'9', # Create text descriptions for each allele - not yet developed
+        #'10', # Sweep the clustering parameters - run on demand to choose the clustering constants
+    ])
     
     action_logs = pipeline.finalise()
 
     return action_logs
 
+def command_line_argument(name:str, arguments_file:str='arguments.toml') -> Any:
+    """
+    This function reads one of the arguments defined in the arguments file from the command line, before the pipeline is created
+
+    Args:
+        name (str): The name of the argument in the arguments file, e.g. WORKERS
+        arguments_file (str): The path to the arguments file
+
+    Returns:
+        Any: The value of the argument, or its default if it is not given
+    """
+    argument = toml.load(arguments_file)['ARGUMENTS'][name]
+    types = {'int':int, 'float':float, 'str':str}
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(f"-{argument['FLAG']}", f"--{argument['VARIABLE_NAME']}", action=argument['ACTION'], type=types[argument.get('TYPE', 'str')], default=argument['DEFAULT'])
+    # the other arguments are left for the pipeline to parse
+    known_arguments, _ = parser.parse_known_args()
+    return getattr(known_arguments, argument['VARIABLE_NAME'])
+
+
 def main():
 
-    output = run_pipeline()
+    # the scheduler is created before any step runs, so the number of steps to run at the same time is read from the command line here
+    output = run_pipeline(max_workers=command_line_argument('WORKERS'))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,200 @@
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import functools
+import multiprocessing
+import queue
+import traceback
+
+
+def artifacts_overlap(output:str, input:str) -> bool:
+    """
+    This function returns whether an input artifact of one step is, or is inside, or contains an output artifact of another step
+
+    Args:
+        output (str): The output artifact path template
+        input (str): The input artifact path template
+
+    Returns:
+        bool: Whether the artifacts overlap
+    """
+    return output == input or input.startswith(f"{output}/") or output.startswith(f"{input}/")
+
+
+def step_dependencies(steps:Dict[str, Dict], step_numbers:List[str]) -> Dict[str, Set[str]]:
+    """
+    This function derives the dependency graph of a set of steps from their declared inputs and outputs
+
+    A step depends on another step if one of its inputs is an output of the other step. Steps which are not in the set are ignored, their
+    outputs are assumed to already exist.
+
+    Args:
+        steps (Dict[str, Dict]): The step definitions
+        step_numbers (List[str]): The steps to be run
+
+    Returns:
+        Dict[str, Set[str]]: The steps which each step depends on
+    """
+    dependencies = {}
+    for step_number in step_numbers:
+        dependencies[step_number] = set()
+        for other_step_number in step_numbers:
+            if other_step_number == step_number:
+                continue
+            for output in steps[other_step_number].get('outputs', []):
+                if any(artifacts_overlap(output, input) for input in steps[step_number].get('inputs', [])):
+                    dependencies[step_number].add(other_step_number)
+    return dependencies
+
+
+class StepScheduler():
+    """
+    This class runs a set of pipeline steps in dependency order, running steps which do not depend on each other at the same time
+
+    Each concurrent step runs in its own forked process, which calls run_step on its copy of the pipeline. The action log is sent back to
+    the main process and replayed through run_step there, so it is included in finalise() in the same way as for a step run directly. A step
+    run in a forked process gets its share of the jobs argument, the number of worker processes it may use for its own pool, so the steps
+    running at the same time do not each start a full sized pool.
+
+    Attributes:
+        pipeline (Pipeline): The pipeline the steps are run on
+        steps (Dict[str, Dict]): The step definitions
+        max_workers (int): The maximum number of steps to run at the same time
+        poll_seconds (float): The number of seconds to wait for a result before checking that the worker processes are still alive
+        in_worker (bool): Whether this copy of the scheduler is in a forked worker process
+    """
+
+    def __init__(self, pipeline, steps:Dict[str, Dict], max_workers:int=1, poll_seconds:float=1.0):
+        self.pipeline = pipeline
+        self.steps = steps
+        self.max_workers = max(1, max_workers)
+        self.poll_seconds = poll_seconds
+        self.in_worker = False
+        # the action logs of steps which ran in a worker process, waiting to be replayed in the main process
+        self.completed_logs = {}
+        # the action log of the step run by a worker process
+        self.worker_logs = {}
+        self.pipeline.load_steps({step_number:{**step, 'function':self.run_or_replay(step_number, step['function'])} for step_number, step in steps.items()})
+
+
+    def run_or_replay(self, step_number:str, function:Callable) -> Callable:
+        """
+        This function wraps a step function so that the action log of a step which ran in a worker process is replayed instead of running the step again
+
+        Args:
+            step_number (str): The number of the step
+            function (Callable): The step function
+
+        Returns:
+            Callable: The wrapped step function
+        """
+        @functools.wraps(function)
+        def wrapped_function(**kwargs) -> Dict:
+            if step_number in self.completed_logs:
+                return self.completed_logs.pop(step_number)
+            if self.in_worker and kwargs.get('jobs'):
+                # up to max_workers steps run at the same time, so each uses its share of the worker processes for its own pool
+                kwargs['jobs'] = max(1, int(kwargs['jobs']) // self.max_workers)
+            action_log = function(**kwargs)
+            self.worker_logs[step_number] = action_log
+            return action_log
+        return wrapped_function
+
+
+    def run_in_worker(self, step_number:str, results:multiprocessing.Queue):
+        """
+        This function runs a step in a worker process and sends the action log, or the error, back to the main process
+
+        Args:
+            step_number (str): The number of the step
+            results (multiprocessing.Queue): The queue for the results
+        """
+        self.in_worker = True
+        try:
+            self.pipeline.run_step(step_number)
+            results.put((step_number, self.worker_logs.get(step_number), None))
+        except Exception:
+            results.put((step_number, None, traceback.format_exc()))
+
+
+    def next_result(self, results:multiprocessing.Queue, running:Dict[str, multiprocessing.Process]) -> Tuple[str, Optional[Dict], Optional[str]]:
+        """
+        This function waits for a worker process to send back its result, checking that the running worker processes are still alive
+
+        A worker process which is killed, for example for running out of memory, never sends a result, so the queue is read with a timeout and
+        the worker processes are checked whenever it is empty
+
+        Args:
+            results (multiprocessing.Queue): The queue for the results
+            running (Dict[str, multiprocessing.Process]): The worker process running each step
+
+        Returns:
+            Tuple[str, Optional[Dict], Optional[str]]: The step number, the action log and the error of the step which finished
+
+        Raises:
+            RuntimeError: If a worker process exited without sending back a result
+        """
+        while True:
+            try:
+                return results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                exited = {step_number:process.exitcode for step_number, process in running.items() if process.exitcode is not None}
+                if not exited:
+                    continue
+            # a worker process sends its result before it exits, so if the result is not on the queue now the worker process died without one
+            try:
+                return results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                step_number, exitcode = next(iter(exited.items()))
+                raise RuntimeError(f"Step {step_number} stopped with exit code {exitcode} before it finished")
+
+
+    def run(self, step_numbers:List[str]):
+        """
+        This function runs the steps, starting each one as soon as the steps it depends on have finished
+
+        Args:
+            step_numbers (List[str]): The steps to run
+        """
+        dependencies = step_dependencies(self.steps, step_numbers)
+        remaining = list(step_numbers)
+        finished = set()
+        running = {}
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+
+        while remaining or running:
+            ready = [step_number for step_number in remaining if dependencies[step_number] <= finished]
+            if not ready and not running:
+                raise ValueError(f"The steps {remaining} have circular dependencies")
+
+            # a step which is the only one that can run is run in the main process, so it can use its own pool of worker processes
+            if ready and not running and (len(ready) == 1 or self.max_workers == 1):
+                step_number = ready[0]
+                remaining.remove(step_number)
+                self.pipeline.run_step(step_number)
+                finished.add(step_number)
+                continue
+
+            # start as many of the ready steps as the concurrency limit allows
+            for step_number in ready[:self.max_workers - len(running)]:
+                remaining.remove(step_number)
+                process = context.Process(target=self.run_in_worker, args=(step_number, results))
+                process.start()
+                running[step_number] = process
+
+            # wait for a step to finish, then replay its action log into the pipeline
+            try:
+                step_number, action_log, error = self.next_result(results, running)
+            except RuntimeError:
+                for process in running.values():
+                    process.terminate()
+                raise
+            running.pop(step_number).join()
+            if error is not None:
+                for process in running.values():
+                    process.terminate()
+                raise RuntimeError(f"Step {step_number} failed\n{error}")
+            self.completed_logs[step_number] = action_log
+            self.pipeline.run_step(step_number)
+            finished.add(step_number)
@@ -0,0 +1,131 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import itertools
+import os
+import sqlite3
+import statistics
+import time
+
+
+# Pragmas used while a database is being built. The database is written to a temporary file which is only moved into place once the load has
+# committed, so there is nothing to protect with a rollback journal or by syncing to disk, and a failed load just leaves the old database.
+LOAD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144'
+]
+
+
+def create_table_sql(table_name:str, schema:List[Tuple[str, str]]) -> str:
+    """
+    This function returns the CREATE TABLE statement for a table with an explicit schema
+
+    Args:
+        table_name (str): The name of the table
+        schema (List[Tuple[str, str]]): The name and SQLite type (and any constraints) of each column
+
+    Returns:
+        str: The CREATE TABLE statement
+    """
+    columns = ',\n    '.join(f'"{column_name}" {column_type}' for column_name, column_type in schema)
+    return f'CREATE TABLE "{table_name}" (\n    {columns}\n)'
+
+
+def insert_rows(connection:sqlite3.Connection, table_name:str, schema:List[Tuple[str, str]], rows:Iterable[Tuple], batch_size:int=10000) -> int:
+    """
+    This function inserts rows into a table in batches, so the rows can be streamed from a generator without all being held in memory
+
+    Args:
+        connection (sqlite3.Connection): The database connection
+        table_name (str): The name of the table
+        schema (List[Tuple[str, str]]): The name and SQLite type of each column
+        rows (Iterable[Tuple]): The rows, with a value for each column in schema order
+        batch_size (int): The number of rows to pass to each executemany call
+
+    Returns:
+        int: The number of rows inserted
+    """
+    placeholders = ', '.join('?' for column in schema)
+    insert_sql = f'INSERT INTO "{table_name}" VALUES ({placeholders})'
+    row_count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        connection.executemany(insert_sql, batch)
+        row_count += len(batch)
+    return row_count
+
+
+def build_database(db_filename:str, tables:List[Tuple[str, List[Tuple[str, str]], Iterator[Tuple]]], statements:Optional[List[str]]=None) -> Dict[str, int]:
+    """
+    This function builds a SQLite database from a set of tables, and swaps it into place once it is complete
+
+    All the rows are loaded in a single transaction into a temporary file next to the database, with pragmas which make the load fast. Any
+    further statements (e.g. to create indexes or views) are run after the rows are loaded, when it is cheaper to build indexes.
+
+    Args:
+        db_filename (str): The path to the database file
+        tables (List[Tuple[str, List[Tuple[str, str]], Iterator[Tuple]]]): The name, schema and rows of each table
+        statements (Optional[List[str]]): Any SQL statements to run once the tables are loaded
+
+    Returns:
+        Dict[str, int]: The number of rows loaded into each table
+    """
+    tmp_filename = f"{db_filename}.tmp"
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+
+    row_counts = {}
+    connection = sqlite3.connect(tmp_filename, isolation_level=None)
+    try:
+        for pragma in LOAD_PRAGMAS:
+            connection.execute(pragma)
+        connection.execute('BEGIN')
+        for table_name, schema, rows in tables:
+            connection.execute(create_table_sql(table_name, schema))
+            row_counts[table_name] = insert_rows(connection, table_name, schema, rows)
+        for statement in statements or []:
+            connection.execute(statement)
+        connection.execute('COMMIT')
+        connection.execute('ANALYZE')
+    finally:
+        connection.close()
+
+    # the finished database replaces the old one in a single step, so a reader never sees a partly built database
+    os.replace(tmp_filename, db_filename)
+    return row_counts
+
+
+def time_queries(db_filename:str, queries:Dict[str, str], repeats:int=5) -> Dict[str, Dict]:
+    """
+    This function times a set of queries against a database, and records how SQLite plans to run each one
+
+    Args:
+        db_filename (str): The path to the database file
+        queries (Dict[str, str]): The SQL for each query, keyed by a name for the query
+        repeats (int): The number of times to run each query, the median time is reported
+
+    Returns:
+        Dict[str, Dict]: The median time in milliseconds, the number of rows returned and the query plan for each query
+    """
+    timings = {}
+    connection = sqlite3.connect(db_filename)
+    try:
+        for query_name, query in queries.items():
+            durations = []
+            for i in range(repeats):
+                start_time = time.perf_counter()
+                rows = connection.execute(query).fetchall()
+                durations.append(time.perf_counter() - start_time)
+            timings[query_name] = {
+                'median_ms':round(statistics.median(durations) * 1000, 3),
+                'rows':len(rows),
+                'plan':[detail for id, parent, notused, detail in connection.execute(f"EXPLAIN QUERY PLAN {query}")]
+            }
+    finally:
+        connection.close()
+    return timings
@@ -6,6 +6,10 @@ from build_logoplots import build_logoplots
 from build_peptide_length_distribution_plots import build_peptide_length_distribution_plots
 from build_text_descriptions import build_text_descriptions
 from cluster_motifs import cluster_motifs
+from sweep_cluster_parameters import sweep_cluster_parameters
+from build_scoring_matrices import build_scoring_matrices
+from build_peptide_overlaps import build_peptide_overlaps
+from build_core_motifs import build_core_motifs
 from build_table_representation import build_table_representation
 
 
@@ -18,7 +22,9 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':[],
+        'outputs':['{tmp_path}/{MHC_MOTIF_ATLAS_CLASS_I_FILENAME}']
     },
     '2':{
         'function':process_class_i_motif_data,
@@ -27,7 +33,27 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':['{tmp_path}/{MHC_MOTIF_ATLAS_CLASS_I_FILENAME}'],
+        'outputs':[
+            '{output_path}/motifs/alleles.json',
+            '{output_path}/motifs/peptides.json',
+            '{output_path}/motifs/amino_acid_distributions.json',
+            '{output_path}/motifs/peptide_length_distributions.json',
+            '{output_path}/motifs/amino_acid_counts.npz',
+            '{output_path}/motifs/columnar/peptides.npz',
+            '{output_path}/motifs/columnar/peptides.json',
+            '{output_path}/motifs/columnar/allele_peptides.npz',
+            '{output_path}/motifs/columnar/allele_peptides.json',
+            '{output_path}/motifs/columnar/amino_acid_distributions.npz',
+            '{output_path}/motifs/columnar/amino_acid_distributions.json',
+            '{output_path}/motifs/columnar/peptide_length_distributions.npz',
+            '{output_path}/motifs/columnar/peptide_length_distributions.json',
+            '{output_path}/motifs/columnar/allele_peptide_incidence.npz',
+            '{output_path}/motifs/columnar/allele_peptide_incidence.json',
+            '{output_path}/motifs/shards',
+            '{output_path}/motifs/peptide_index'
+        ]
     },
     '3':{
         'function':build_sorted_amino_acid_distributions,
@@ -36,7 +62,16 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':[
+            '{output_path}/motifs/columnar/amino_acid_distributions.npz',
+            '{output_path}/motifs/columnar/amino_acid_distributions.json'
+        ],
+        'outputs':[
+            '{output_path}/motifs/sorted_amino_acid_distributions.json',
+            '{output_path}/motifs/columnar/sorted_amino_acid_distributions.npz',
+            '{output_path}/motifs/columnar/sorted_amino_acid_distributions.json'
+        ]
     },
     '4':{
         'function':build_simplified_motifs,
@@ -45,7 +80,9 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':['{output_path}/motifs/shards'],
+        'outputs':['{output_path}/motifs/simplified_motifs.json']
     },
     '5':{
         'function':build_logoplots,
@@ -54,7 +91,9 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':['{output_path}/motifs/shards'],
+        'outputs':['{output_path}/motifs/logoplots']
     },
     '6':{
         'function':build_peptide_length_distribution_plots,
@@ -63,7 +102,12 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':[
+            '{output_path}/motifs/columnar/peptide_length_distributions.npz',
+            '{output_path}/motifs/columnar/peptide_length_distributions.json'
+        ],
+        'outputs':['{output_path}/motifs/lengthplots']
     },
     '7':{
         'function':cluster_motifs,
@@ -72,7 +116,14 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':['{output_path}/motifs/shards'],
+        'outputs':[
+            '{output_path}/motifs/distances',
+            '{output_path}/motifs/clusters',
+            '{output_path}/motifs/columnar/motif_clusters.npz',
+            '{output_path}/motifs/columnar/motif_clusters.json'
+        ]
     },
     '8':{
         'function':build_table_representation,
@@ -81,7 +132,21 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':[
+            '{output_path}/motifs/shards',
+            '{output_path}/motifs/columnar/peptides.npz',
+            '{output_path}/motifs/columnar/allele_peptides.npz',
+            '{output_path}/motifs/columnar/allele_peptides.json',
+            '{output_path}/motifs/columnar/peptide_length_distributions.npz',
+            '{output_path}/motifs/columnar/peptide_length_distributions.json',
+            '{output_path}/motifs/columnar/allele_overlaps.npz',
+            '{output_path}/motifs/columnar/peptide_promiscuity.npz'
+        ],
+        'outputs':[
+            '{output_path}/motifs/motifs.csv',
+            '{output_path}/motifs/motifs.db'
+        ]
     },
     '9':{
         'function':build_text_descriptions,
@@ -90,6 +155,77 @@ steps = {
         'is_multi': False,
         'multi_param': None,
         'multi_options': None,
-        'has_progress': False
+        'has_progress': False,
+        'inputs':[],
+        'outputs':[]
+    },
+    '10':{
+        'function':sweep_cluster_parameters,
+        'title_template':'the output to compare clustering parameters for the motifs.',
+        'title_verb':['Processing', 'Processes'],
+        'is_multi': False,
+        'multi_param': None,
+        'multi_options': None,
+        'has_progress': False,
+        'inputs':[
+            '{output_path}/motifs/shards',
+            '{output_path}/motifs/distances'
+        ],
+        'outputs':[
+            '{output_path}/motifs/distances',
+            '{output_path}/motifs/clusters/sweep_cache',
+            '{output_path}/motifs/columnar/cluster_sweep.npz',
+            '{output_path}/motifs/columnar/cluster_sweep.json'
+        ]
+    },
+    '11':{
+        'function':build_scoring_matrices,
+        'title_template':'the output to build scoring matrices for scoring peptides against each allele.',
+        'title_verb':['Processing', 'Processes'],
+        'is_multi': False,
+        'multi_param': None,
+        'multi_options': None,
+        'has_progress': False,
+        'inputs':['{output_path}/motifs/shards'],
+        'outputs':[
+            '{output_path}/motifs/columnar/scoring_matrices.npz',
+            '{output_path}/motifs/columnar/scoring_matrices.json'
+        ]
+    },
+    '12':{
+        'function':build_peptide_overlaps,
+        'title_template':'the output to find the peptides shared between alleles.',
+        'title_verb':['Processing', 'Processes'],
+        'is_multi': False,
+        'multi_param': None,
+        'multi_options': None,
+        'has_progress': False,
+        'inputs':[
+            '{output_path}/motifs/columnar/allele_peptide_incidence.npz',
+            '{output_path}/motifs/columnar/allele_peptide_incidence.json',
+            '{output_path}/motifs/columnar/peptides.npz'
+        ],
+        'outputs':[
+            '{output_path}/motifs/columnar/allele_overlaps.npz',
+            '{output_path}/motifs/columnar/allele_overlaps.json',
+            '{output_path}/motifs/columnar/peptide_promiscuity.npz',
+            '{output_path}/motifs/columnar/peptide_promiscuity.json'
+        ]
+    },
+    '13':{
+        'function':build_core_motifs,
+        'title_template':'the output to build a core motif for each allele from its peptides of every length.',
+        'title_verb':['Processing', 'Processes'],
+        'is_multi': False,
+        'multi_param': None,
+        'multi_options': None,
+        'has_progress': False,
+        'inputs':['{output_path}/motifs/shards'],
+        'outputs':[
+            '{output_path}/motifs/columnar/core_motifs.npz',
+            '{output_path}/motifs/columnar/core_motifs.json',
+            '{output_path}/motifs/columnar/core_frames.npz',
+            '{output_path}/motifs/columnar/core_frames.json'
+        ]
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,185 @@
+from typing import Dict, List, Optional, Tuple
+
+from warehouse import ShardedWarehouse, write_table
+from motif_distances import motif_features, cached_distance_matrix
+
+import multiprocessing
+import time
+import warnings
+
+import hdbscan
+import joblib
+import numpy as np
+
+
+def cluster_validity(distances:np.ndarray, cluster_labels:np.ndarray, dimensions:int) -> Optional[float]:
+    """
+    This function returns the density based cluster validity (DBCV) of a clustering, which lies between -1 and 1, higher is better
+
+    Args:
+        distances (np.ndarray): The precomputed distances between the motifs
+        cluster_labels (np.ndarray): The cluster labels, -1 for outliers
+        dimensions (int): The number of dimensions of the motif features
+
+    Returns:
+        Optional[float]: The validity, or None if it is undefined for this clustering (e.g. there are fewer than two clusters)
+    """
+    if len(set(cluster_labels.tolist()) - {-1}) < 2:
+        return None
+    with warnings.catch_warnings():
+        # motifs which are identical to each other give zero distances, which the validity index warns about
+        warnings.simplefilter('ignore', RuntimeWarning)
+        try:
+            validity = hdbscan.validity.validity_index(distances, cluster_labels, metric='precomputed', d=dimensions)
+        except AssertionError:
+            # the validity index is undefined when a cluster is too small to have any internal nodes in its spanning tree, which hdbscan
+            # reports with an assertion
+            return None
+    return None if np.isnan(validity) else float(validity)
+
+
+def sweep_min_cluster_sizes(distances_filepath:str, cache_folder:str, min_samples:int, min_cluster_sizes:List[int], dimensions:int) -> List[Dict]:
+    """
+    This function clusters the motifs of one distance matrix with each minimum cluster size, for one value of min_samples
+
+    The core distances and the single linkage tree depend on the distances and min_samples but not on the minimum cluster size, so they are
+    computed by the first fit and read from the joblib cache by the others. The cache is kept between sweeps, so adding a minimum cluster size to
+    the grid only condenses the existing trees.
+
+    Args:
+        distances_filepath (str): The path to the memory mapped distance matrix
+        cache_folder (str): The path to the joblib cache for the single linkage trees
+        min_samples (int): The number of neighbours used for the core distance of each motif
+        min_cluster_sizes (List[int]): The minimum cluster sizes to try
+        dimensions (int): The number of dimensions of the motif features
+
+    Returns:
+        List[Dict]: The clusters found, outliers, validity scores and time taken for each minimum cluster size
+    """
+    distances = np.load(distances_filepath, mmap_mode='r')
+    # HDBSCAN reads the memory mapped matrix as it is, it is only copied into memory if it was not written as float64
+    if distances.dtype != np.float64:
+        distances = distances.astype(np.float64)
+    memory = joblib.Memory(cache_folder, verbose=0)
+    results = []
+    for min_cluster_size in min_cluster_sizes:
+        start_time = time.perf_counter()
+        clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples, metric='precomputed', gen_min_span_tree=True, memory=memory)
+        cluster_labels = clusterer.fit_predict(distances)
+        cluster_count = len(set(cluster_labels.tolist()) - {-1})
+        results.append({
+            'min_cluster_size':min_cluster_size,
+            'min_samples':min_samples,
+            'clusters':cluster_count,
+            'outliers':int(np.sum(cluster_labels == -1)),
+            # the relative validity is a fast approximation of DBCV from the minimum spanning tree, only comparable between settings
+            'relative_validity':float(clusterer.relative_validity_) if cluster_count > 1 else None,
+            'validity_index':cluster_validity(distances, cluster_labels, dimensions),
+            'seconds':round(time.perf_counter() - start_time, 4)
+        })
+    return results
+
+
+def sweep_cluster_parameters(**kwargs) -> Dict[str,str]:
+    """
+    This function clusters the motifs with every combination of the distances, minimum cluster sizes and min_samples values in the sweep
+    constants, to help choose the clustering constants
+
+    The distance matrix for each peptide length and distance is computed once (or read from the cache used by the clustering step) and memory
+    mapped by the workers. The settings which share a distance matrix and min_samples value are run together in one worker so they share the
+    core distances and single linkage tree. The cluster count, outlier count and validity scores of each setting are written to the
+    cluster_sweep table in the columnar warehouse.
+
+    Args:
+        **kwargs: Arbitrary keyword arguments.
+
+    Returns:
+        Dict[str,str]: A dictionary containing the action log for this step.
+
+    Keyword Args:
+        config (dict): The configuration dictionary.
+        verbose (bool): Whether to print verbose output.
+        force (bool): Whether to force the step to run ignoring any previous results.
+        output_path (str): The path to the output directory.
+        console (Console): A Rich console object for printing Rich output.
+        jobs (int): The number of worker processes to run the sweep with (defaults to 1, running the settings serially).
+    """
+    config = kwargs['config']
+    verbose = kwargs['verbose']
+    force = kwargs['force']
+    output_path = kwargs['output_path']
+    console = kwargs['console']
+    function_name = kwargs['function_name']
+    jobs = int(kwargs.get('jobs') or 1)
+
+    constants = config['CONSTANTS']
+    min_cluster_sizes = constants['CLUSTER_SWEEP_MIN_CLUSTER_SIZES']
+
+    warehouse_folder = f"{output_path}/motifs"
+    cache_folder = f"{warehouse_folder}/clusters/sweep_cache"
+    shards = ShardedWarehouse(warehouse_folder)
+
+    # each task sweeps the minimum cluster sizes for one peptide length, distance and min_samples value
+    tasks = []
+    task_settings = []
+    for peptide_length in [str(peptide_length) for peptide_length in constants['CLUSTER_PEPTIDE_LENGTHS']]:
+        allele_labels, features = motif_features(shards, peptide_length)
+        if len(allele_labels) < 2:
+            continue
+        dimensions = features.shape[1] * features.shape[2]
+        for metric in constants['CLUSTER_SWEEP_METRICS']:
+            # the distance matrix is written once here, so the workers only read it
+            distances = cached_distance_matrix(warehouse_folder, metric, peptide_length, allele_labels, features, verbose)[0]
+            for min_samples in constants['CLUSTER_SWEEP_MIN_SAMPLES']:
+                tasks.append((distances.filename, cache_folder, min_samples, min_cluster_sizes, dimensions))
+                task_settings.append((peptide_length, metric))
+
+    start_time = time.perf_counter()
+    if jobs <= 1 or len(tasks) <= 1:
+        task_results = [sweep_min_cluster_sizes(*task) for task in tasks]
+    else:
+        with multiprocessing.Pool(processes=min(jobs, len(tasks))) as pool:
+            task_results = pool.starmap(sweep_min_cluster_sizes, tasks, chunksize=1)
+    sweep_seconds = round(time.perf_counter() - start_time, 3)
+
+    results = []
+    for (peptide_length, metric), setting_results in zip(task_settings, task_results):
+        for result in setting_results:
+            results.append({'peptide_length':int(peptide_length), 'metric':metric, **result})
+
+    metrics = constants['CLUSTER_SWEEP_METRICS']
+    columns = {
+        'peptide_length':np.array([result['peptide_length'] for result in results], dtype=np.int16),
+        'metric_id':np.array([metrics.index(result['metric']) for result in results], dtype=np.int32),
+        'min_cluster_size':np.array([result['min_cluster_size'] for result in results], dtype=np.int32),
+        'min_samples':np.array([result['min_samples'] for result in results], dtype=np.int32),
+        'clusters':np.array([result['clusters'] for result in results], dtype=np.int32),
+        'outliers':np.array([result['outliers'] for result in results], dtype=np.int32),
+        # settings with fewer than two clusters have no validity scores, these are stored as NaN
+        'relative_validity':np.array([np.nan if result['relative_validity'] is None else result['relative_validity'] for result in results], dtype=np.float64),
+        'validity_index':np.array([np.nan if result['validity_index'] is None else result['validity_index'] for result in results], dtype=np.float64),
+        'seconds':np.array([result['seconds'] for result in results], dtype=np.float64)
+    }
+    write_table(warehouse_folder, 'cluster_sweep', columns, {'metric_id':metrics}, verbose)
+
+    # the best setting for each peptide length is the one with the highest validity index
+    best_settings = {}
+    for result in results:
+        if result['validity_index'] is None:
+            continue
+        best = best_settings.get(result['peptide_length'])
+        if best is None or result['validity_index'] > best['validity_index']:
+            best_settings[result['peptide_length']] = result
+
+    if verbose:
+        for result in results:
+            print (f"{result['peptide_length']}mer {result['metric']} min_cluster_size={result['min_cluster_size']} min_samples={result['min_samples']}: {result['clusters']} clusters, {result['outliers']} outliers, validity {result['validity_index']}")
+
+    # create the action log which will be included in the log file for this run of the pipeline
+    action_log = {
+        'settings_evaluated':len(results),
+        'seconds':sweep_seconds,
+        'best_settings':{str(peptide_length):{key:best[key] for key in ['metric', 'min_cluster_size', 'min_samples', 'clusters', 'outliers', 'validity_index']} for peptide_length, best in best_settings.items()}
+    }
+
+    return action_log
@@ -0,0 +1,320 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from pipeline import create_folder
+
+from helpers.files import write_json, read_json
+
+from incremental import hash_content
+
+import os
+
+import numpy as np
+import scipy.sparse
+
+
+# Each table in the columnar warehouse is stored as an uncompressed .npz file with one array per column, alongside a small .json metadata sidecar.
+# Text columns which repeat (e.g. allele numbers and amino acids) are stored as integer ids, and the sidecar holds the labels for these columns.
+# Arrays in a .npz file are only read when they are accessed, so a step can load just the columns it needs. Sparse matrices are stored in the same
+# folder in scipy's .npz format, with a sidecar holding their shape and the labels for their rows or columns.
+
+
+def columnar_folder(warehouse_folder:str) -> str:
+    """
+    This function returns the folder for the columnar tables within the warehouse folder
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+
+    Returns:
+        str: The path to the columnar tables folder
+    """
+    return f"{warehouse_folder}/columnar"
+
+
+def write_table(warehouse_folder:str, table_name:str, columns:Dict[str, np.ndarray], dictionaries:Optional[Dict[str, List[str]]]=None, verbose:bool=False,
+                sources:Optional[Dict[str, str]]=None):
+    """
+    This function writes a table to the columnar warehouse
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        table_name (str): The name of the table
+        columns (Dict[str, np.ndarray]): The columns of the table, all the same length
+        dictionaries (Optional[Dict[str, List[str]]]): The labels for any integer id columns, keyed by column name
+        verbose (bool): Whether to print verbose output
+        sources (Optional[Dict[str, str]]): The content hashes of the tables or matrices the table was built from, keyed by their names, so a
+            reader can tell whether the table is out of date
+    """
+    folder = columnar_folder(warehouse_folder)
+    create_folder(folder, verbose)
+    np.savez(f"{folder}/{table_name}.npz", **columns)
+    metadata = {
+        'rows':len(next(iter(columns.values()))) if columns else 0,
+        'columns':{column_name:str(column.dtype) for column_name, column in columns.items()},
+        'dictionaries':dictionaries or {},
+        'sources':sources or {}
+    }
+    write_json(f"{folder}/{table_name}.json", metadata, pretty=True)
+
+
+def read_table_metadata(warehouse_folder:str, table_name:str) -> Dict:
+    """
+    This function reads the metadata sidecar for a table in the columnar warehouse
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        table_name (str): The name of the table
+
+    Returns:
+        Dict: The number of rows, the column types, the dictionaries for the integer id columns and the content hashes of its sources
+    """
+    return read_json(f"{columnar_folder(warehouse_folder)}/{table_name}.json")
+
+
+def read_table(warehouse_folder:str, table_name:str, columns:Optional[List[str]]=None) -> Dict[str, np.ndarray]:
+    """
+    This function reads some or all of the columns of a table in the columnar warehouse
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        table_name (str): The name of the table
+        columns (Optional[List[str]]): The columns to read, or None to read all of them
+
+    Returns:
+        Dict[str, np.ndarray]: The requested columns
+    """
+    with np.load(f"{columnar_folder(warehouse_folder)}/{table_name}.npz", allow_pickle=False) as table:
+        return {column_name:table[column_name] for column_name in (columns or table.files)}
+
+
+def read_dictionary(warehouse_folder:str, table_name:str, column_name:str) -> np.ndarray:
+    """
+    This function reads the labels for an integer id column of a table in the columnar warehouse
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        table_name (str): The name of the table
+        column_name (str): The name of the id column
+
+    Returns:
+        np.ndarray: The labels, indexed by id
+    """
+    return np.array(read_table_metadata(warehouse_folder, table_name)['dictionaries'][column_name], dtype=str)
+
+
+
+def write_sparse_matrix(warehouse_folder:str, matrix_name:str, matrix:scipy.sparse.spmatrix, dictionaries:Optional[Dict[str, List[str]]]=None, 
+                        verbose:bool=False):
+    """
+    This function writes a sparse matrix to the columnar warehouse, as an uncompressed .npz file of its CSR arrays with a .json metadata sidecar
+
+    The sidecar holds a content hash of the matrix and its labels, which tables built from the matrix record as their source
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        matrix_name (str): The name of the matrix
+        matrix (scipy.sparse.spmatrix): The sparse matrix
+        dictionaries (Optional[Dict[str, List[str]]]): The labels for the rows or columns of the matrix, keyed by the id they are labelled with
+        verbose (bool): Whether to print verbose output
+    """
+    folder = columnar_folder(warehouse_folder)
+    create_folder(folder, verbose)
+    matrix = matrix.tocsr()
+    scipy.sparse.save_npz(f"{folder}/{matrix_name}.npz", matrix, compressed=False)
+    metadata = {
+        'shape':list(matrix.shape),
+        'nonzero':int(matrix.nnz),
+        'dtype':str(matrix.dtype),
+        'dictionaries':dictionaries or {},
+        'content_hash':hash_content(np.array(matrix.shape, dtype=np.int64).tobytes(), matrix.indptr.tobytes(), matrix.indices.tobytes(), 
+                                    matrix.data.tobytes(), repr(sorted((dictionaries or {}).items())).encode('utf-8'))
+    }
+    write_json(f"{folder}/{matrix_name}.json", metadata, pretty=True)
+
+
+def read_sparse_matrix(warehouse_folder:str, matrix_name:str) -> scipy.sparse.csr_matrix:
+    """
+    This function reads a sparse matrix from the columnar warehouse
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        matrix_name (str): The name of the matrix
+
+    Returns:
+        scipy.sparse.csr_matrix: The sparse matrix
+    """
+    return scipy.sparse.load_npz(f"{columnar_folder(warehouse_folder)}/{matrix_name}.npz").tocsr()
+
+# The sharded warehouse holds one .npz file per allele and peptide length, with a manifest listing the shards. Steps which only need one length, 
+# or one allele, read just those shards. Each shard holds the peptides, packed by packed_peptides, and the precomputed position by amino acid
+# matrices (counts, percentages, probabilities and information content in bits), so later steps never need to recount the peptides.
+
+
+def shards_folder(warehouse_folder:str) -> str:
+    """
+    This function returns the folder for the allele and peptide length shards within the warehouse folder
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+
+    Returns:
+        str: The path to the shards folder
+    """
+    return f"{warehouse_folder}/shards"
+
+
+def write_shards(warehouse_folder:str, shards:Iterator[Tuple[str, str, Dict[str, np.ndarray]]], amino_acids:List[str], verbose:bool=False, 
+                 allele_numbers:Optional[List[str]]=None, changed_alleles:Optional[Set[str]]=None) -> int:
+    """
+    This function writes a shard for each allele and peptide length, and the manifest which indexes them
+
+    If only some alleles have changed since the shards were last written, just the shards for those alleles are rewritten and the manifest
+    entries for the other alleles are kept. The shards in the previous manifest which are not in the new one are deleted.
+
+    Args:
+        warehouse_folder (str): The path to the warehouse folder
+        shards (Iterator[Tuple[str, str, Dict[str, np.ndarray]]]): The allele number, peptide length and arrays for each shard to write
+        amino_acids (List[str]): The list of amino acids, which labels the amino acid axis of the shard matrices
+        verbose (bool): Whether to print verbose output
+        allele_numbers (Optional[List[str]]): Every allele in the warehouse, in order, needed when only the changed alleles are written
+        changed_alleles (Optional[Set[str]]): The alleles whose shards are being written, or None if the shards for every allele are written
+
+    Returns:
+        int: The number of shards in the warehouse
+    """
+    folder = shards_folder(warehouse_folder)
+    written = {}
+    for allele_number, peptide_length, arrays in shards:
+        create_folder(f"{folder}/{allele_number}", verbose)
+        shard_path = f"{allele_number}/{peptide_length}.npz"
+        np.savez(f"{folder}/{shard_path}", **arrays)
+        written.setdefault(allele_number, {})[peptide_length] = {
+            'path':shard_path,
+            'peptide_count':len(arrays['peptides']),
+            'content_hash':hash_content(*[np.ascontiguousarray(arrays[array_name]).tobytes() for array_name in sorted(arrays)])
+        }
+
+    manifest_filepath = f"{folder}/manifest.json"
+    previous_alleles = read_json(manifest_filepath)['alleles'] if os.path.exists(manifest_filepath) else {}
+    if changed_alleles is None:
+        manifest = {'amino_acids':amino_acids, 'alleles':written}
+    else:
+        # keep the entries of the unchanged alleles
+        manifest = {'amino_acids':amino_acids, 'alleles':{}}
+        for allele_number in allele_numbers:
+            manifest['alleles'][allele_number] = written.get(allele_number, {}) if allele_number in changed_alleles else previous_alleles[allele_number]
+
+    # remove the shards of any lengths or alleles which no longer have peptides, and the folders of alleles left with no shards
+    for allele_number, lengths in previous_alleles.items():
+        for peptide_length, shard in lengths.items():
+            if peptide_length not in manifest['alleles'].get(allele_number, {}) and os.path.exists(f"{folder}/{shard['path']}"):
+                os.remove(f"{folder}/{shard['path']}")
+        if allele_number not in manifest['alleles'] and os.path.isdir(f"{folder}/{allele_number}") and not os.listdir(f"{folder}/{allele_number}"):
+            os.rmdir(f"{folder}/{allele_number}")
+    write_json(manifest_filepath, manifest, pretty=True)
+    return sum(len(lengths) for lengths in manifest['alleles'].values())
+
+
+class ShardedWarehouse():
+    """
+    This class gives access to the allele and peptide length shards of the warehouse, loading each shard only when it is first used
+
+    Attributes:
+        folder (str): The path to the shards folder
+        manifest (Dict): The index of the shards
+    """
+
+    def __init__(self, warehouse_folder:str):
+        self.folder = shards_folder(warehouse_folder)
+        self.manifest = read_json(f"{self.folder}/manifest.json")
+        self.loaded = {}
+
+
+    @property
+    def alleles(self) -> List[str]:
+        """
+        The allele numbers in the warehouse, in warehouse order
+        """
+        return list(self.manifest['alleles'])
+
+
+    @property
+    def amino_acids(self) -> List[str]:
+        """
+        The amino acids which label the amino acid axis of the shard matrices
+        """
+        return self.manifest['amino_acids']
+
+
+    def lengths(self, allele_number:str) -> List[str]:
+        """
+        This function returns the peptide lengths with a shard for an allele
+
+        Args:
+            allele_number (str): The slugified allele number
+
+        Returns:
+            List[str]: The peptide lengths
+        """
+        return list(self.manifest['alleles'].get(allele_number, {}))
+
+
+    def has_shard(self, allele_number:str, peptide_length:str) -> bool:
+        """
+        This function returns whether there is a shard for an allele and peptide length
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide_length (str): The peptide length
+
+        Returns:
+            bool: Whether the shard exists
+        """
+        return peptide_length in self.manifest['alleles'].get(allele_number, {})
+
+
+    def peptide_count(self, allele_number:str, peptide_length:str) -> int:
+        """
+        This function returns the number of peptides in a shard, without loading it
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide_length (str): The peptide length
+
+        Returns:
+            int: The number of peptides
+        """
+        return self.manifest['alleles'][allele_number][peptide_length]['peptide_count']
+
+
+    def content_hash(self, allele_number:str, peptide_length:str) -> str:
+        """
+        This function returns the content hash of the arrays in a shard, without loading it
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide_length (str): The peptide length
+
+        Returns:
+            str: The content hash of the shard
+        """
+        return self.manifest['alleles'][allele_number][peptide_length]['content_hash']
+
+
+    def shard(self, allele_number:str, peptide_length:str) -> Dict[str, np.ndarray]:
+        """
+        This function returns the arrays for an allele and peptide length, loading them the first time they are used
+
+        Args:
+            allele_number (str): The slugified allele number
+            peptide_length (str): The peptide length
+
+        Returns:
+            Dict[str, np.ndarray]: The packed peptides, and the counts, percentages, probabilities and information matrices for the shard
+        """
+        key = (allele_number, peptide_length)
+        if key not in self.loaded:
+            shard_path = self.manifest['alleles'][allele_number][peptide_length]['path']
+            with np.load(f"{self.folder}/{shard_path}", allow_pickle=False) as shard:
+                self.loaded[key] = {array_name:shard[array_name] for array_name in shard.files}
+        return self.loaded[key]
@@ -0,0 +1,279 @@
+import gzip
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# the steps import each other as top level modules, as they do when the pipeline runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps'))
+
+from conditional_download import download_file, download_files, download_with_retries, metadata_path, partial_path, pooled_session
+
+
+# A local stand-in for the download server, which answers conditional requests with a 304, Range requests with a 206 (or a 416 if the range
+# starts past the end of the file) and compresses whole responses if the client accepts gzip.
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    body = b''
+    etag = '"v1"'
+    last_modified = 'Wed, 01 Jan 2025 00:00:00 GMT'
+    requests = []
+
+    def do_GET(self):
+        StandInHandler.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+
+        status = 200
+        body = self.body
+        headers = {'ETag':self.etag, 'Last-Modified':self.last_modified}
+        requested_range = self.headers.get('Range')
+        # a Range request for a different version of the file gets the whole file
+        if requested_range and self.headers.get('If-Range') in [self.etag, self.last_modified]:
+            start = int(requested_range.split('=')[1].rstrip('-'))
+            if start >= len(self.body):
+                status = 416
+                body = b''
+                headers['Content-Range'] = f"bytes */{len(self.body)}"
+            else:
+                status = 206
+                body = self.body[start:]
+                headers['Content-Range'] = f"bytes {start}-{len(self.body) - 1}/{len(self.body)}"
+        if status == 200 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConditionalDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/atlas.txt"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StandInHandler.body = b'Allele\tPeptide\n' + b''.join(f"A0{i % 7}01\tSIINFEKL{i}\n".encode('ascii') for i in range(20000))
+        StandInHandler.etag = '"v1"'
+        StandInHandler.requests = []
+        self.folder = tempfile.TemporaryDirectory()
+        self.filepath = os.path.join(self.folder.name, 'atlas.txt')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def read_file(self) -> bytes:
+        with open(self.filepath, 'rb') as f:
+            return f.read()
+
+    def write_partial(self, body:bytes, etag:str):
+        with open(partial_path(self.filepath), 'wb') as f:
+            f.write(body)
+        with open(metadata_path(partial_path(self.filepath)), 'w') as f:
+            json.dump({'url':self.url, 'etag':etag, 'last_modified':None}, f)
+
+    def test_download_then_not_modified(self):
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 200)
+        self.assertFalse(download_log['cache_hit'])
+        self.assertEqual(self.read_file(), StandInHandler.body)
+        # the transfer was compressed, so fewer bytes crossed the wire than were written
+        self.assertLess(download_log['bytes_transferred'], len(StandInHandler.body))
+        self.assertFalse(os.path.exists(partial_path(self.filepath)))
+
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 304)
+        self.assertTrue(download_log['cache_hit'])
+        self.assertEqual(StandInHandler.requests[-1]['If-None-Match'], '"v1"')
+        self.assertEqual(self.read_file(), StandInHandler.body)
+
+    def test_changed_file_is_downloaded_again(self):
+        download_file(self.url, self.filepath)
+        StandInHandler.body += b'B0702\tNEWPEPTIDE\n'
+        StandInHandler.etag = '"v2"'
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 200)
+        self.assertEqual(self.read_file(), StandInHandler.body)
+
+    def test_partial_download_is_resumed(self):
+        self.write_partial(StandInHandler.body[:1000], '"v1"')
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 206)
+        self.assertEqual(download_log['resumed_from'], 1000)
+        self.assertEqual(StandInHandler.requests[-1]['Range'], 'bytes=1000-')
+        self.assertEqual(download_log['bytes_transferred'], len(StandInHandler.body) - 1000)
+        self.assertEqual(self.read_file(), StandInHandler.body)
+
+    def test_partial_download_of_old_version_is_replaced(self):
+        self.write_partial(b'old version', '"v0"')
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 200)
+        self.assertEqual(download_log['resumed_from'], 0)
+        self.assertEqual(self.read_file(), StandInHandler.body)
+
+    def test_complete_partial_file_is_finished(self):
+        # the partial file holds the whole file, as if the last download stopped before the rename
+        self.write_partial(StandInHandler.body, '"v1"')
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 416)
+        self.assertIsNone(download_log['error'])
+        self.assertEqual(self.read_file(), StandInHandler.body)
+        self.assertFalse(os.path.exists(partial_path(self.filepath)))
+        self.assertTrue(os.path.exists(metadata_path(self.filepath)))
+
+    def test_overlong_partial_file_is_fetched_again(self):
+        self.write_partial(StandInHandler.body + b'extra bytes', '"v1"')
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 200)
+        self.assertNotIn('Range', StandInHandler.requests[-1])
+        self.assertEqual(self.read_file(), StandInHandler.body)
+
+    def test_sidecar_without_partial_file_is_ignored(self):
+        self.write_partial(b'', '"v1"')
+        os.remove(partial_path(self.filepath))
+        download_log = download_file(self.url, self.filepath)
+        self.assertEqual(download_log['http_status_code'], 200)
+        self.assertNotIn('Range', StandInHandler.requests[-1])
+        self.assertEqual(self.read_file(), StandInHandler.body)
+
+
+# A local stand-in for a set of download sources, where /missing returns a 404, /flaky returns a 503 until its failures run out and any other
+# path is served slowly while the number of requests being served at the same time is recorded.
+
+class SourcesHandler(http.server.BaseHTTPRequestHandler):
+    failures = 0
+    delay = 0.2
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+    paths = []
+
+    def do_GET(self):
+        with SourcesHandler.lock:
+            SourcesHandler.paths.append(self.path)
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if self.path == '/flaky' and SourcesHandler.failures:
+            SourcesHandler.failures -= 1
+            self.send_error(503)
+            return
+
+        with SourcesHandler.lock:
+            SourcesHandler.active += 1
+            SourcesHandler.max_active = max(SourcesHandler.max_active, SourcesHandler.active)
+        # the server waits on an event rather than sleeping, as the tests of the backoff replace time.sleep
+        threading.Event().wait(SourcesHandler.delay)
+        with SourcesHandler.lock:
+            SourcesHandler.active -= 1
+        body = f"Allele\tPeptide\nA0201\t{self.path.strip('/').upper()}\n".encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadFiles(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SourcesHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        SourcesHandler.failures = 0
+        SourcesHandler.active = 0
+        SourcesHandler.max_active = 0
+        SourcesHandler.paths = []
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def download(self, path:str) -> tuple:
+        return (path.strip('/'), f"{self.url}{path}", os.path.join(self.folder.name, f"{path.strip('/')}.txt"))
+
+    def test_server_error_is_retried_with_backoff(self):
+        SourcesHandler.failures = 2
+        # the waits between attempts are recorded rather than slept
+        with mock.patch('conditional_download.time.sleep') as sleep, pooled_session(1) as session:
+            download_log = download_with_retries(f"{self.url}/flaky", os.path.join(self.folder.name, 'flaky.txt'), session, retries=3, backoff=0.5)
+        self.assertIsNone(download_log['error'])
+        self.assertEqual(download_log['http_status_code'], 200)
+        self.assertEqual(download_log['attempts'], 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.5, 1.0])
+        self.assertEqual(SourcesHandler.paths, ['/flaky'] * 3)
+
+    def test_server_error_gives_up_after_the_retries(self):
+        SourcesHandler.failures = 10
+        with mock.patch('conditional_download.time.sleep') as sleep, pooled_session(1) as session:
+            download_log = download_with_retries(f"{self.url}/flaky", os.path.join(self.folder.name, 'flaky.txt'), session, retries=2, backoff=0.5)
+        self.assertEqual(download_log['error'], 'server_error')
+        self.assertEqual(download_log['attempts'], 3)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.5, 1.0])
+
+    def test_missing_file_is_not_retried(self):
+        with mock.patch('conditional_download.time.sleep') as sleep, pooled_session(1) as session:
+            download_log = download_with_retries(f"{self.url}/missing", os.path.join(self.folder.name, 'missing.txt'), session, retries=3)
+        self.assertEqual(download_log['error'], 'file_not_found')
+        self.assertEqual(download_log['http_status_code'], 404)
+        self.assertEqual(download_log['attempts'], 1)
+        sleep.assert_not_called()
+        self.assertEqual(SourcesHandler.paths, ['/missing'])
+
+    def test_concurrency_cap_is_respected(self):
+        downloads = [self.download(f"/source{i}") for i in range(6)]
+        source_logs = download_files(downloads, max_workers=2, retries=0)
+        self.assertTrue(all(source_log['error'] is None for source_log in source_logs.values()))
+        self.assertEqual(SourcesHandler.max_active, 2)
+        self.assertEqual(sorted(SourcesHandler.paths), sorted(f"/source{i}" for i in range(6)))
+
+    def test_each_source_is_logged_with_its_timings(self):
+        downloads = [self.download('/source'), self.download('/missing')]
+        source_logs = download_files(downloads, max_workers=4, retries=0)
+        self.assertEqual(list(source_logs), ['source', 'missing'])
+        self.assertIsNone(source_logs['source']['error'])
+        self.assertEqual(source_logs['missing']['error'], 'file_not_found')
+        # the slow source took at least the time the stand-in server waited before answering
+        self.assertGreaterEqual(source_logs['source']['seconds'], SourcesHandler.delay)
+        self.assertGreaterEqual(source_logs['source']['total_seconds'], source_logs['source']['seconds'])
+        for source_log in source_logs.values():
+            self.assertEqual(source_log['attempts'], 1)
+            self.assertIn('total_seconds', source_log)
+        with open(os.path.join(self.folder.name, 'source.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'Allele\tPeptide\nA0201\tSOURCE\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import logomaker
+
+# the steps import each other as top level modules, as they do when the pipeline runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps'))
+
+from logo_rendering import stack_glyphs, draw_logo
+
+
+AMINO_ACIDS = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
+
+
+# a nonamer information matrix with strong anchors at P2 and P9, a tall narrow letter (I) whose width is limited, and two amino acids with no
+# information, which are not drawn
+def known_information() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    information = rng.random((9, len(AMINO_ACIDS))) * 0.3
+    information[1, AMINO_ACIDS.index('L')] = 3.0
+    information[8, AMINO_ACIDS.index('V')] = 2.5
+    information[4, AMINO_ACIDS.index('I')] = 1.5
+    information[6, [AMINO_ACIDS.index('C'), AMINO_ACIDS.index('W')]] = 0
+    return information
+
+
+class TestLogoRendering(unittest.TestCase):
+
+    def setUp(self):
+        self.information = known_information()
+        self.fig, self.ax = plt.subplots()
+        info_mat = pd.DataFrame(self.information, columns=AMINO_ACIDS, index=range(1, len(self.information) + 1))
+        self.logo = logomaker.Logo(info_mat, ax=self.ax, vpad=0.1, color_scheme='chemistry', show_spines=False)
+
+    def tearDown(self):
+        plt.close(self.fig)
+
+    def test_glyphs_match_logomaker(self):
+        glyphs, ymax = stack_glyphs(self.information, AMINO_ACIDS)
+        # logomaker draws a glyph for every amino acid with some information at each position
+        self.assertEqual(len(glyphs), int(np.count_nonzero(self.information)))
+        for amino_acid, x, y, width, height in glyphs:
+            position = int(round(x + width / 2))
+            extents = self.logo.glyph_df.loc[position, amino_acid].patch.get_path().get_extents()
+            np.testing.assert_allclose([x, y, width, height], [extents.x0, extents.y0, extents.width, extents.height], atol=1e-9, err_msg=f"{amino_acid} at P{position}")
+        self.assertAlmostEqual(ymax, self.ax.get_ylim()[1])
+
+    def test_axes_limits_match_logomaker(self):
+        glyphs, ymax = stack_glyphs(self.information, AMINO_ACIDS)
+        fig, ax = plt.subplots()
+        draw_logo(ax, glyphs, len(self.information), ymax, {amino_acid:[0, 0, 0] for amino_acid in AMINO_ACIDS})
+        np.testing.assert_allclose(ax.get_xlim(), self.ax.get_xlim())
+        np.testing.assert_allclose(ax.get_ylim(), self.ax.get_ylim())
+        plt.close(fig)
+
+
+if __name__ == '__main__':
+    unittest.main()